@@ -1,28 +1,122 @@
 import logging
 import threading
+import queue
 import concurrent.futures as cf
 import time
 import random
 
-def thread_function(name, wait_time):
-    wait_time = random.randrange(5,15)
+# A three stage pipeline that keeps a producer, a pool of workers and a consumer busy at the same time.
+#
+#   fetch thread   pulls items from the source iterable and hands each one to the worker pool
+#   worker pool    runs transform on the items, several at once
+#   writer thread  passes the transformed items to consume, in the same order the source produced them
+#
+# The futures travel from the fetch thread to the writer thread through a bounded queue, so when the
+# writer falls behind the fetch thread blocks instead of piling up items in memory (backpressure).
+# An exception in any stage stops the other stages and is raised again from run().
+class StagedPipeline():
+    def __init__(self, source, transform, consume, workers=4, queue_size=8, use_processes=False):
+        self.source = source
+        self.transform = transform
+        self.consume = consume
+        self.workers = workers
+        self.queue_size = queue_size
+        self.use_processes = use_processes
+        self.items_done = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._errors = []
+
+    # put an item on the queue, giving up if another stage has failed in the meantime
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fetch(self, executor):
+        try:
+            for item in self.source:
+                if not self._put(executor.submit(self.transform, item)):
+                    break
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            self._put(None)
+
+    def _write(self):
+        try:
+            while True:
+                try:
+                    future = self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    # the fetch thread failed and could not queue its end marker
+                    if self._stop.is_set():
+                        break
+                    continue
+                if future is None:
+                    break
+                self.consume(future.result())
+                self.items_done += 1
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+            # drain the queue so the fetch thread is not left blocked on a full queue
+            while True:
+                try:
+                    future = self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    break
+                if future is None:
+                    break
+                future.cancel()
+
+    def run(self):
+        if self.use_processes:
+            executor = cf.ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            executor = cf.ThreadPoolExecutor(max_workers=self.workers)
+        with executor:
+            fetch_thread = threading.Thread(target=self._fetch, args=(executor,), name='pipeline-fetch')
+            write_thread = threading.Thread(target=self._write, name='pipeline-write')
+            fetch_thread.start()
+            write_thread.start()
+            fetch_thread.join()
+            write_thread.join()
+        if self._errors:
+            raise self._errors[0]
+        return self.items_done
+
+# group the items of an iterable into lists of at most batch_size items
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def thread_function(name):
+    wait_time = random.randrange(1, 3)
     logging.info('Thread {}: starting and waiting {}'.format(name, wait_time))
     time.sleep(wait_time)
     logging.info("Thread %s: finishing", name)
+    return name
 
 if __name__ == "__main__":
     format = "%(asctime)s: %(message)s"
     logging.basicConfig(format=format, level=logging.INFO,
                         datefmt="%H:%M:%S")
 
-    with cf.ThreadPoolExecutor(max_workers=3) as executor:
-    # with cf.ThreadPoolExecutor(max_workers=3) as executor:
-        logging.info('Starting')
-        executor.submit(thread_function, range(3))
-
+    logging.info('Starting')
+    pipeline = StagedPipeline(range(6), thread_function,
+                              lambda name: logging.info('Wrote {}'.format(name)),
+                              workers=3, queue_size=2)
+    pipeline.run()
     logging.info('Done')
-
-
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        for number, prime in zip(PRIMES, executor.map(is_prime, PRIMES)):
-            print('%d is prime: %s' % (number, prime))
@@ -0,0 +1,180 @@
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+from os import listdir
+from os import makedirs
+from os import remove
+from os import replace
+from os.path import isdir
+from os.path import isfile
+import numpy as np
+import pandas as pd
+
+import dir_mgmt_utils as dmu
+import ingest_manifest
+import partition_store as ps
+import operation as bs_ops
+import object_ids as oid
+import aggregate_manifest as am
+
+# The account index is an inverted index from every account in the day partitions to the
+# operations it appears in, in any of the operation's account columns (account, seller,
+# from_account/to_account, publisher, canceler, ...). Accounts are spread over account_shards
+# shards by their instance number, each day writes its posting lists to one part per shard:
+#   index/accounts/<shard>/<yyyymmdd>.npz    posting_dtype array sorted by account, operation
+#                                            type and row offset in the operation type's file
+#   index/accounts/days/<yyyymmdd>.json      the shards a day wrote and the fingerprint of the
+#                                            files it was indexed from
+# An account appearing in several columns of an operation gets one posting. Like the lifecycle
+# index a day is indexed on its own, parts first and the day entry last, so the loader indexes
+# its days as it finishes them and index_days only does the days that are new or changed since.
+#
+# get_account_history looks the account up in its shard and only reads the partitions (and for
+# Parquet files the row groups) its postings point to.
+
+account_shards = 64
+
+posting_dtype = np.dtype([('account', np.int64), ('op_key', np.int8), ('row', np.int32)])
+
+# the partition columns of each operation type that hold accounts
+account_cols = {op_key: [name for name, col in zip(ps.partition_column_names(op_class), op_class.cols)
+                         if op_class.col_sources[col][0] == 'account']
+                for op_key, op_class in bs_ops.supported_operations.items()}
+
+def get_shard_dir(shard):
+    shard_dir = dmu.get_index_dir('accounts') + '/{:03d}'.format(shard)
+    if not isdir(shard_dir):
+        makedirs(shard_dir, exist_ok=True)
+    return shard_dir
+
+def get_part_path(shard, day_dir):
+    return get_shard_dir(shard) + '/' + day_dir + '.npz'
+
+def get_entry_path(day_dir):
+    entry_dir = dmu.get_index_dir('accounts') + '/days'
+    if not isdir(entry_dir):
+        makedirs(entry_dir, exist_ok=True)
+    return entry_dir + '/' + day_dir + '.json'
+
+# the index entry of a day, None when the day was never indexed
+def read_day_entry(day_dir):
+    entry_path = get_entry_path(day_dir)
+    if not isfile(entry_path):
+        return None
+    with open(entry_path, 'rt') as entry_file:
+        return json.load(entry_file)
+
+def write_day_entry(entry):
+    entry_path = get_entry_path(entry['day'])
+    with open(entry_path + '.tmp', 'wt') as entry_file:
+        json.dump(entry, entry_file)
+    replace(entry_path + '.tmp', entry_path)
+
+def get_shards(account_codes):
+    return (account_codes & oid.instance_mask) % account_shards
+
+# the postings of a day sorted by account, operation type and row
+def read_day_postings(day_path):
+    parts = []
+    for op_key, cols in account_cols.items():
+        operations = ps.read_operations(day_path, op_key, cols)
+        for col in cols:
+            part = np.zeros(len(operations), dtype=posting_dtype)
+            part['account'] = operations[col].to_numpy()
+            part['op_key'] = op_key
+            part['row'] = np.arange(len(operations))
+            parts.append(part)
+    return np.unique(np.concatenate(parts))
+
+# index a day unless its operation files are unchanged since it was last indexed,
+# returns whether the day was indexed
+def index_day(day_dir, day_path):
+    fingerprint = am.get_day_fingerprint(day_path)
+    entry = read_day_entry(day_dir)
+    if entry is not None and entry['fingerprint'] == fingerprint:
+        return False
+    postings = read_day_postings(day_path)
+    shards = get_shards(postings['account'])
+    shard_order = np.argsort(shards, kind='stable')
+    postings = postings[shard_order]
+    day_shards, shard_starts = np.unique(shards[shard_order], return_index=True)
+    shard_ends = np.append(shard_starts[1:], len(postings))
+    for shard, shard_start, shard_end in zip(day_shards.tolist(), shard_starts.tolist(), shard_ends.tolist()):
+        part_path = get_part_path(shard, day_dir)
+        with open(part_path + '.tmp', 'wb') as part_file:
+            np.savez_compressed(part_file, postings=postings[shard_start:shard_end])
+        replace(part_path + '.tmp', part_path)
+    # a day indexed again can have left shards it wrote to before
+    if entry is not None:
+        for shard in set(entry['shards']) - set(day_shards.tolist()):
+            if isfile(get_part_path(shard, day_dir)):
+                remove(get_part_path(shard, day_dir))
+    write_day_entry({'day': day_dir, 'fingerprint': fingerprint, 'shards': day_shards.tolist(),
+                     'posting_cnt': len(postings)})
+    return True
+
+# index the loaded days from first_day on that are new or changed
+def index_days(first_day, days_to_model):
+    day_cnt = 0
+    for current_date in [first_day + timedelta(days=x) for x in range(0, days_to_model)]:
+        day_dir, day_path = dmu.get_daydir_daypath(current_date)
+        # stop at the first day the loader has not finished, its directory exists while it is still loading
+        if not ingest_manifest.is_day_complete(day_dir):
+            break
+        if index_day(day_dir, day_path):
+            logging.info('Indexed accounts of {}'.format(day_dir))
+            day_cnt += 1
+    logging.info('Indexed accounts of {} days'.format(day_cnt))
+    return day_cnt
+
+# the postings of an account (e.g. '1.2.12345') as a DataFrame of day directory, operation type
+# and row, ordered by day, from the days from start up to (not including) end
+def get_account_postings(account_id, start=None, end=None):
+    account_code = oid.encode_object_id(account_id)
+    shard_dir = get_shard_dir(int(get_shards(np.int64(account_code))))
+    first_day_dir = None if start is None else dmu.get_daydir_daypath(pd.Timestamp(start))[0]
+    end_day_dir = None if end is None else dmu.get_daydir_daypath(pd.Timestamp(end))[0]
+    day_dirs = []
+    day_postings = []
+    for file_name in sorted(listdir(shard_dir)):
+        day_dir = file_name[:-len('.npz')]
+        if not file_name.endswith('.npz') or (first_day_dir is not None and day_dir < first_day_dir) or \
+                (end_day_dir is not None and day_dir > end_day_dir):
+            continue
+        with np.load(shard_dir + '/' + file_name) as part:
+            postings = part['postings']
+        posting_start, posting_end = np.searchsorted(postings['account'], [account_code, account_code + 1])
+        if posting_end > posting_start:
+            day_dirs.append(np.full(posting_end - posting_start, day_dir, dtype=object))
+            day_postings.append(postings[posting_start:posting_end])
+    if not day_postings:
+        return pd.DataFrame({'day': np.empty(0, dtype=object), 'op_key': np.empty(0, dtype=np.int8),
+                             'row': np.empty(0, dtype=np.int32)})
+    postings = np.concatenate(day_postings)
+    return pd.DataFrame({'day': np.concatenate(day_dirs), 'op_key': postings['op_key'], 'row': postings['row']})
+
+# every operation of an account from start up to (not including) end in time order, with the ids
+# written out as strings. operation types have different columns, the columns an operation type
+# does not have are left empty
+def get_account_history(account_id, start=None, end=None):
+    postings = get_account_postings(account_id, start, end)
+    operation_frames = []
+    for (day_dir, op_key), rows in postings.groupby(['day', 'op_key'])['row']:
+        day_path = dmu.get_daydir_daypath(datetime.strptime(day_dir, '%Y%m%d'))[1]
+        operations = ps.read_operation_rows(day_path, op_key, rows.to_numpy())
+        operation_frames.append(ps.decode_operations(bs_ops.supported_operations[op_key], operations))
+    if not operation_frames:
+        return pd.DataFrame(columns=bs_ops.Operation.cols)
+    history = pd.concat(operation_frames, ignore_index=True)
+    if start is not None:
+        history = history[history['block_time'] >= start]
+    if end is not None:
+        history = history[history['block_time'] < end]
+    return history.sort_values(['block_time', 'operation_id'], ignore_index=True)
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s %(module)s:%(lineno)d %(message)s', level=logging.INFO)
+    first_day     = datetime(2016, 1, 1)   # first day to index
+    days_to_model = 940                    # days from first_day on, stops at the first day without data
+    index_days(first_day, days_to_model)
@@ -0,0 +1,60 @@
+import json
+from os import listdir
+from os import replace
+from os import stat
+from os.path import isfile
+
+import dir_mgmt_utils as dmu
+
+# The aggregate manifest records what the aggregate files of a market set were built from, so a
+# run only recomputes the days whose partitions changed. It holds the settings the rows depend
+# on (markets, granularities, columns, sketch error), the byte size of every aggregate file and,
+# for every aggregated day, the fingerprint of the day's operation files and the byte offset
+# where the day's rows start in each granularity's file. The days' rows are in date order, so
+# a day's rows run from its offset to the next day's offset (or the end of the file).
+
+def get_manifest_path(markets):
+    return dmu.create_aggregate_path('manifest', markets) + '.json'
+
+def new_manifest(settings):
+    return {
+        'settings': settings,
+        'sizes': {},
+        'days': {}
+    }
+
+# read the manifest of the market set, or a fresh one when the files were never built
+# or were built with different settings (any settings when settings is None)
+def read_manifest(markets, settings=None):
+    manifest_path = get_manifest_path(markets)
+    if not isfile(manifest_path):
+        return new_manifest(settings)
+    with open(manifest_path, 'rt') as manifest_file:
+        manifest = json.load(manifest_file)
+    if settings is not None and manifest['settings'] != settings:
+        return new_manifest(settings)
+    return manifest
+
+# write the manifest to a temporary file first so a crash never leaves a half written manifest
+def write_manifest(markets, manifest):
+    manifest_path = get_manifest_path(markets)
+    with open(manifest_path + '.tmp', 'wt') as manifest_file:
+        json.dump(manifest, manifest_file)
+    replace(manifest_path + '.tmp', manifest_path)
+
+# size and modification time of each finished operation file of a day
+def get_day_fingerprint(day_path):
+    fingerprint = {}
+    for file_name in sorted(listdir(day_path)):
+        if file_name.startswith('operation-') and not file_name.endswith(('.tmp', '.part')):
+            file_stat = stat(day_path + '/' + file_name)
+            fingerprint[file_name] = [file_stat.st_size, file_stat.st_mtime_ns]
+    return fingerprint
+
+# the files are only spliced when each one still has the size the manifest recorded,
+# anything else (a missing file, a run that stopped halfway) rebuilds them
+def files_match(manifest, file_paths):
+    for granularity, file_path in file_paths.items():
+        if not isfile(file_path) or stat(file_path).st_size != manifest['sizes'].get(granularity):
+            return False
+    return True
@@ -0,0 +1,295 @@
+import io
+import functools
+from datetime import timedelta
+from os import listdir
+from os import replace
+from os import stat
+from os.path import isfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import dir_mgmt_utils as dmu
+import aggregate_manifest as am
+import operation as bs_ops
+import asset
+import object_ids as oid
+
+# Reads the aggregate files bitshares_dataaggregation.py writes. The files of sparse granularities
+# only hold the buckets that had operations, read_aggregates puts the empty buckets back:
+#   rate columns (names ending in rate)     NaN
+#   every other column (counts, amounts)    0
+# which is what the aggregator writes for a bucket without operations, except that it writes
+# the missing rates as empty strings.
+
+# The aggregate cube holds the aggregates of every canonical market of asset.synonym_markets (and
+# so of every asset of those markets) in one Parquet file per granularity and month:
+#   aggregates/cube/<granularity>/<yyyymm>.parquet    a date column and a column per aggregate,
+#                                                     sorted by date
+# The aggregates of a market or asset do not depend on which other markets are aggregated with it,
+# so load assembles the columns of any market set by picking them from the cube, only reading
+# the months and columns asked for. Sparse granularities only store the buckets with operations.
+# Counts and amounts are int64, the other columns float64 with NaN for missing rates.
+
+cube_markets = list(asset.synonym_markets.keys())
+cube_cache_months = 64   # month files (per column selection) load keeps in memory
+
+# the aggregate columns of a market set, in the order the aggregator writes them
+def get_market_columns(markets):
+    asset_ids, market_asset_id_pairs = asset.distinct_asset_ids(markets)
+    return [column for op_key, op_class in bs_ops.supported_operations.items()
+            for column in op_class.get_agg_columns(asset_ids, market_asset_id_pairs)]
+
+def get_cube_path(granularity, month):
+    return dmu.get_aggregate_cube_dir(granularity) + '/' + month + '.parquet'
+
+def get_markets_path(granularity, month):
+    return dmu.get_aggregate_markets_dir(granularity) + '/' + month + '.parquet'
+
+def get_month(day_dir):
+    return day_dir[:6]
+
+def get_cube_type(column):
+    if column.endswith('count') or column.endswith('amount'):
+        return pa.int64()
+    return pa.float64()
+
+def get_cube_schema(columns):
+    return pa.schema([('date', pa.timestamp('ms'))] + [(column, get_cube_type(column)) for column in columns])
+
+# the aggregates of a day as a table of the cube's schema, dates holds the start of each bucket and
+# column_values the values of each column for every bucket (with '' for missing rates)
+def make_cube_day(dates, columns, column_values, sparse):
+    cube_values = []
+    for column, values in zip(columns, column_values):
+        values = np.asarray(values, dtype=object)
+        missing = values == ''
+        if missing.any():
+            values = np.where(missing, np.nan, values)
+        cube_values.append(values.astype(get_cube_type(column).to_pandas_dtype()))
+    if sparse:
+        has_values = np.zeros(len(dates), dtype=bool)
+        for values in cube_values:
+            has_values |= (values != 0) & ~np.isnan(values)
+        dates = np.asarray(dates)[has_values]
+        cube_values = [values[has_values] for values in cube_values]
+    return pa.table([pa.array(pd.to_datetime(np.asarray(dates)), pa.timestamp('ms'))] + cube_values,
+                    schema=get_cube_schema(columns))
+
+# writes the day tables of a granularity to month files, get_month_path gives the path of a month.
+# the days of a month are kept until a day of another month comes in (or close is called),
+# then the month file is written again with the new days replacing the ones it had
+class CubeWriter():
+    def __init__(self, granularity, schema, get_month_path=get_cube_path):
+        self.granularity = granularity
+        self.schema = schema
+        self.get_month_path = get_month_path
+        self._month = None
+        self._days = {}
+
+    def add_day(self, day_dir, day_table):
+        if self._month is not None and get_month(day_dir) != self._month:
+            self.flush()
+        self._month = get_month(day_dir)
+        self._days[day_dir] = day_table
+
+    def flush(self):
+        if self._month is None:
+            return
+        cube_path = self.get_month_path(self.granularity, self._month)
+        day_tables = dict(self._days)
+        if isfile(cube_path):
+            month_table = pq.read_table(cube_path)
+            if month_table.schema.equals(self.schema):
+                for day_dir, day_table in split_cube_days(month_table).items():
+                    day_tables.setdefault(day_dir, day_table)
+        month_table = pa.concat_tables([day_tables[day_dir] for day_dir in sorted(day_tables)])
+        pq.write_table(month_table, cube_path + '.tmp', compression='zstd', write_statistics=['date'])
+        replace(cube_path + '.tmp', cube_path)
+        self._month = None
+        self._days = {}
+
+    def close(self):
+        self.flush()
+
+# the rows of a month table per day directory
+def split_cube_days(month_table):
+    day_dirs = pd.to_datetime(month_table.column('date').to_numpy()).strftime('%Y%m%d').to_numpy()
+    day_tables = {}
+    for day_dir in np.unique(day_dirs):
+        day_tables[day_dir] = month_table.filter(pa.array(day_dirs == day_dir))
+    return day_tables
+
+# the months in a directory of month files as sorted yyyymm names
+def get_months(month_dir):
+    return sorted(file_name[:-len('.parquet')] for file_name in listdir(month_dir) if file_name.endswith('.parquet'))
+
+# the months from months that hold days from start up to end
+def get_range_months(months, start, end):
+    if start is not None:
+        months = [month for month in months if month >= get_month(dmu.get_daydir_daypath(pd.Timestamp(start))[0])]
+    if end is not None:
+        months = [month for month in months if month <= get_month(dmu.get_daydir_daypath(pd.Timestamp(end))[0])]
+    return months
+
+# a month of the cube with the columns asked for. the file's modification time is part of the key,
+# so a month the aggregator wrote again is read again
+@functools.lru_cache(maxsize=cube_cache_months)
+def read_cube_month(cube_path, mtime_ns, columns):
+    return pq.read_table(cube_path, columns=['date'] + list(columns)).to_pandas().set_index('date')
+
+def clear_cache():
+    read_cube_month.cache_clear()
+
+# the aggregates of granularity for markets from start up to (not including) end as a dataframe
+# indexed by date with a row for every bucket, with the columns asked for (every column of the
+# markets by default). without start or end the range starts or ends with the first or last day
+# in the cube
+def load(granularity, markets, start=None, end=None, columns=None):
+    market_columns = get_market_columns(markets)
+    if columns is None:
+        columns = market_columns
+    unknown_columns = set(columns) - set(market_columns)
+    if unknown_columns:
+        raise ValueError('columns {} are not aggregated for {}'.format(sorted(unknown_columns), markets))
+    months = get_range_months(get_months(dmu.get_aggregate_cube_dir(granularity)), start, end)
+    month_frames = []
+    for month in months:
+        cube_path = get_cube_path(granularity, month)
+        month_frames.append(read_cube_month(cube_path, stat(cube_path).st_mtime_ns, tuple(columns)))
+    aggregates = pd.concat(month_frames) if month_frames else \
+        pd.DataFrame(columns=list(columns), index=pd.DatetimeIndex([], name='date'), dtype=np.float64)
+    if start is None:
+        start = aggregates.index.min().normalize() if len(aggregates.index) else pd.Timestamp(0)
+    if end is None:
+        end = aggregates.index.max().normalize() + timedelta(days=1) if len(aggregates.index) else pd.Timestamp(start)
+    aggregates = aggregates[(aggregates.index >= start) & (aggregates.index < end)]
+    return densify(aggregates, granularity, start, end)
+
+# In all-markets mode the aggregator also writes the statistics of every market and asset that has
+# operations, whether it is a supported market or not, in a long format keyed by bucket and market:
+#   aggregates/markets/<granularity>/<yyyymm>.parquet    date, operation (the operation type key),
+#                                                        market and the union of the agg_stat_names
+# market is the market code (object_ids.encode_markets) of the asset pair of market operations,
+# the asset code of single asset operations and 0 for the others. only buckets with operations
+# have rows, the statistics an operation type does not have are 0 (counts and amounts) or NaN.
+
+market_stat_names = []
+for op_class in bs_ops.supported_operations.values():
+    market_stat_names += [name for name in op_class.agg_stat_names if name not in market_stat_names]
+
+def get_market_schema():
+    return pa.schema([('date', pa.timestamp('ms')), ('operation', pa.int64()), ('market', pa.int64())] +
+                     [(name, get_cube_type(name)) for name in market_stat_names])
+
+# the market frames (see Operation.get_agg_market_frame) of the operation types of a day as a table of
+# get_market_schema, buckets of unit_minutes minutes from current_date
+def make_market_day(current_date, unit_minutes, market_frames):
+    day_frames = []
+    for op_key, market_frame in market_frames.items():
+        day_frame = pd.DataFrame({'bucket': market_frame['bucket'].to_numpy(),
+                                  'operation': np.full(len(market_frame.index), op_key, dtype=np.int64),
+                                  'market': market_frame['market'].to_numpy().astype(np.int64)})
+        for name in market_stat_names:
+            dtype = get_cube_type(name).to_pandas_dtype()
+            if name in market_frame:
+                day_frame[name] = market_frame[name].to_numpy().astype(dtype)
+            else:
+                day_frame[name] = np.full(len(market_frame.index), np.nan if dtype == np.float64 else 0, dtype=dtype)
+        day_frames.append(day_frame)
+    market_day = pd.concat(day_frames, ignore_index=True).sort_values(['bucket', 'operation', 'market'])
+    market_day.insert(0, 'date', pd.Timestamp(current_date) +
+                      pd.to_timedelta(market_day['bucket']*unit_minutes, unit='min'))
+    return pa.Table.from_pandas(market_day.drop(columns='bucket'), schema=get_market_schema(), preserve_index=False)
+
+# the market statistics of granularity from start up to (not including) end, optionally only of the
+# operation types (keys of operation.supported_operations) asked for, with the market codes decoded
+# to 'base asset id/quote asset id' for market operations and the asset id for single asset operations
+def load_markets(granularity, start=None, end=None, operations=None):
+    markets_dir = dmu.get_aggregate_markets_dir(granularity)
+    month_frames = [pq.read_table(markets_dir + '/' + month + '.parquet').to_pandas()
+                    for month in get_range_months(get_months(markets_dir), start, end)]
+    if not month_frames:
+        return pd.DataFrame(columns=get_market_schema().names)
+    market_stats = pd.concat(month_frames, ignore_index=True)
+    if start is not None:
+        market_stats = market_stats[market_stats['date'] >= start]
+    if end is not None:
+        market_stats = market_stats[market_stats['date'] < end]
+    if operations is not None:
+        market_stats = market_stats[market_stats['operation'].isin(operations)]
+    market_names = np.zeros(len(market_stats.index), dtype=object)
+    for op_key, op_class in bs_ops.supported_operations.items():
+        is_op = (market_stats['operation'] == op_key).to_numpy()
+        if len(op_class.agg_key_cols) == 2:
+            market_names[is_op] = oid.decode_markets(market_stats['market'].to_numpy()[is_op])
+        elif len(op_class.agg_key_cols) == 1:
+            market_names[is_op] = oid.decode_object_ids(market_stats['market'].to_numpy()[is_op])
+        else:
+            market_names[is_op] = ''
+    return market_stats.assign(market=market_names).reset_index(drop=True)
+
+# the csv file of a granularity's aggregates of a market set
+def get_aggregate_file_path(granularity, markets):
+    return dmu.create_aggregate_path(granularity, markets) + '.testit.csv'
+
+# the value of a column in a bucket without operations
+def get_fill_value(column):
+    return np.nan if column.endswith('rate') else 0
+
+# the aggregates with a row for every bucket of granularity from start up to (not including) end
+def densify(aggregates, granularity, start, end):
+    unit_minutes = dmu.Granularity.unit_minutes[granularity]
+    # the first bucket that starts at or after start, the buckets start at midnight
+    day_start = pd.Timestamp(start).normalize()
+    start = day_start + (pd.Timestamp(start) - day_start).ceil('{}min'.format(unit_minutes))
+    dates = pd.date_range(start, end, freq=pd.Timedelta(minutes=unit_minutes), inclusive='left', name='date')
+    aggregates = aggregates.reindex(dates).fillna({column: get_fill_value(column) for column in aggregates.columns})
+    # the reindex turns the integer columns with missing buckets into floats
+    return aggregates.astype({column: np.int64 for column in aggregates.columns
+                              if get_cube_type(column) == pa.int64()})
+
+# the day directory of the first day that starts at or after a_date
+def get_first_day_dir(a_date):
+    day_start = pd.Timestamp(a_date).normalize()
+    if day_start < pd.Timestamp(a_date):
+        day_start += timedelta(days=1)
+    return dmu.get_daydir_daypath(day_start)[0]
+
+# the csv text of the days from start to end, the aggregate manifest's day offsets let it skip
+# the other days, without a manifest that matches the file the whole file is read
+def read_day_range(file_path, granularity, markets, start, end):
+    manifest = am.read_manifest(markets)
+    with open(file_path, 'rb') as aggregate_file:
+        if not am.files_match(manifest, {granularity: file_path}):
+            return aggregate_file.read().decode()
+        header = aggregate_file.readline()
+        day_offsets = [(day_dir, day['offsets'][granularity]) for day_dir, day in sorted(manifest['days'].items())]
+        range_start = len(header)
+        range_end = manifest['sizes'][granularity]
+        if start is not None:
+            first_day_dir = dmu.get_daydir_daypath(pd.Timestamp(start).normalize())[0]
+            range_start = next((offset for day_dir, offset in day_offsets if day_dir >= first_day_dir), range_end)
+        if end is not None:
+            end_day_dir = get_first_day_dir(end)
+            range_end = next((offset for day_dir, offset in day_offsets if day_dir >= end_day_dir), range_end)
+        aggregate_file.seek(range_start)
+        return (header + aggregate_file.read(max(range_end - range_start, 0))).decode()
+
+# the aggregates of granularity for markets from start up to (not including) end as a dataframe
+# indexed by date with a row for every bucket. without start or end the range starts or ends
+# with the first or last day in the file
+def read_aggregates(granularity, markets, start=None, end=None):
+    file_path = get_aggregate_file_path(granularity, markets)
+    if not isfile(file_path):
+        raise FileNotFoundError('no {} aggregates for {}, run bitshares_dataaggregation.py first'.format(
+            granularity, markets))
+    aggregates = pd.read_csv(io.StringIO(read_day_range(file_path, granularity, markets, start, end)),
+                             parse_dates=['date'], index_col='date')
+    if start is None:
+        start = aggregates.index.min().normalize() if len(aggregates.index) else pd.Timestamp(0)
+    if end is None:
+        end = aggregates.index.max().normalize() + timedelta(days=1) if len(aggregates.index) else pd.Timestamp(0)
+    aggregates = aggregates[(aggregates.index >= start) & (aggregates.index < end)]
+    return densify(aggregates, granularity, start, end)
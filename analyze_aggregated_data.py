@@ -13,6 +13,7 @@ import grainger_causality as gc
 import var_model_processing as vmp
 import bitshares_data_plotting as bdp
 import asset
+import aggregate_store as ags
 
 date_ranges = [
     [datetime(2016, 1, 1), datetime(2017, 2, 28)],
@@ -24,16 +25,16 @@ logging.basicConfig(
 markets = ['USD/CNY', 'USD/BTS', 'CNY/BTS']
 
 granularity = dmu.Granularity(dmu.Granularity.DAILY)
-file_path = dmu.create_aggregate_path(granularity.granularity, markets)
+# names the data source in the output, the granularity of the cube and the markets loaded from it
+source = '{} aggregate cube of {}'.format(granularity.granularity, ', '.join(markets))
 
-agg_ops = pd.read_csv(file_path)
-print(file_path)
+# the markets' columns of the aggregate cube, any market set can be loaded without aggregating again
+agg_ops = ags.load(granularity.granularity, markets)
+print(source)
 print(agg_ops.tail())
-agg_ops['date'] = agg_ops['date'].astype('datetime64[ns]')
-agg_ops = agg_ops.set_index('date')
 
 # missing value treatment
-logging.info('Handling N/A in data file {}'.format(file_path))
+logging.info('Handling N/A in the {}'.format(source))
 columns = agg_ops.columns
 for column in columns:
     # for the rates, interpolate across the N/As
@@ -53,7 +54,7 @@ columns = agg_ops.columns
 # what do we want to predict? Let's predict large moves
 # as a hand wave, lets look at standard devitaion in $ or Y per BTS standard deviation over 30 days
 logging.info(
-    'Getting standard deviation of median rates for {}'.format(file_path))
+    'Getting standard deviation of median rates for the {}'.format(source))
 window = granularity.window_days*granularity.units_per_day
 min_lag = granularity.min_lag_days*granularity.units_per_day
 endog_binary = pd.DataFrame(index=agg_ops.index)
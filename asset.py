@@ -1,7 +1,14 @@
+import functools
+import re
+
+import object_ids as oid
+
+# amounts are kept as integers in the asset's base units (satoshis), see asset_precisions for
+# turning them into whole asset units
 class Amount():
     def __init__(self, asset_json):
         self.asset_id = asset_json['asset_id']
-        self.amount = float(asset_json['amount'])
+        self.amount = int(asset_json['amount'])
 
 
 class Market():
@@ -73,6 +80,46 @@ synonym_markets = {
     'CNY/BTS': ['BTS/CNY', 'CNY/BTS']
 }
 
+# number of decimal places of the supported assets, an amount of 1 whole asset is 10**precision base units
+# assets missing here are shown in base units
+asset_precisions = {
+    supported_assets['BTS']: 5,
+    supported_assets['USD']: 4,
+    supported_assets['CNY']: 4,
+    supported_assets['BTC']: 8,
+    supported_assets['GDEX.BTC']: 8,
+    supported_assets['OPEN.BTC']: 8,
+    supported_assets['BRIDGE.BTC']: 8
+}
+
+# base units per whole asset for an asset id or asset code, 1 for assets without a known precision
+@functools.lru_cache(maxsize=None)
+def get_unit_scale(asset_id):
+    if not isinstance(asset_id, str):
+        asset_id = oid.decode_object_id(asset_id)
+    return 10 ** asset_precisions.get(asset_id, 0)
+
+# an amount in base units as a number of whole assets, for display only
+def to_display_amount(asset_id, amount):
+    return amount / get_unit_scale(asset_id)
+
+# a rate of base amount / quote amount in base units as whole base assets per whole quote asset
+def to_display_rate(base_asset_id, quote_asset_id, rate):
+    return rate * get_unit_scale(quote_asset_id) / get_unit_scale(base_asset_id)
+
+# asset id : asset name, for writing names instead of ids
+asset_names = {asset_id: name for name, asset_id in supported_assets.items()}
+
+# the name of an asset id or asset code, assets that are not supported keep their id
+def asset_name(asset_id):
+    if not isinstance(asset_id, str):
+        asset_id = oid.decode_object_id(asset_id)
+    return asset_names.get(asset_id, asset_id)
+
+# a column name with the asset ids in it replaced by the asset names
+def readable_column(column):
+    return re.sub(r'1\.3\.[0-9]+', lambda match: asset_name(match.group(0)), column)
+
 # get distinct list of assets IDs to be processed and market asset ID pairs
 def distinct_asset_ids(market_list):
     distinct_asset_ids    = {}
@@ -83,6 +130,9 @@ def distinct_asset_ids(market_list):
             synonyms = synonym_markets[market]
 
             for a_synonym in synonyms:
+                # synonyms without a supported market (e.g. GDEX.BTC/BTS) have no asset ids to aggregate
+                if a_synonym not in supported_markets:
+                    continue
                 # get the quote and base asset id
                 quote_asset_id = supported_markets[a_synonym][0]
                 base_asset_id  = supported_markets[a_synonym][1]
@@ -2,14 +2,24 @@ from datetime import datetime
 from datetime import timedelta
 import logging
 import pandas as pd
+import numpy as np
 
 from os import mkdir
+from os import remove
+from os import truncate
 from os.path import isdir
+from os.path import isfile
 import csv
+import shutil
 
 import dir_mgmt_utils as dmu
+import ingest_manifest
 import operation as bs_ops
+import partition_store as ps
 import asset
+import ThreadPoolTest as tpt
+import aggregate_manifest as am
+import aggregate_store as ags
 
 logging.basicConfig(format='%(asctime)s %(module)s:%(lineno)d %(message)s', level=logging.INFO)
 
@@ -21,6 +31,13 @@ supported_operations = bs_ops.supported_operations.keys()
 op_aggregated_dfs = bs_ops.make_aggregate_dfs()
 
 markets = ['USD/CNY', 'USD/BTS', 'CNY/BTS']
+asset_names_in_header = False   # write asset names from asset.supported_assets instead of asset ids in the headers
+aggregate_granularities = [dmu.Granularity.DAILY, dmu.Granularity.HOURLY, dmu.Granularity.MINUTE]   # each must divide a day in whole minutes
+sparse_granularities = [dmu.Granularity.MINUTE]   # only write the buckets with operations, aggregate_store.read_aggregates fills in the others
+minutes_per_day = 24*60
+quantile_sketch_error = None   # e.g. 0.01 for mergeable median sketches with about 1% rank error, None for exact medians
+bs_ops.quantile_sketch_error = quantile_sketch_error
+all_markets = False   # also write the statistics of every market and asset found, see aggregate_store.load_markets
 asset_ids, market_asset_id_pairs = asset.distinct_asset_ids(markets)
 logging.info('Distinct asset IDs       : {}'.format(asset_ids))
 logging.info('Distinct market asset IDs: {}'.format(market_asset_id_pairs))
@@ -33,6 +50,11 @@ for op_key, op_class in bs_ops.supported_operations.items():
     agg_cols_by_operation[op_key] = agg_cols
 logging.info('Processing columns: {}'.format(agg_cols_for_df))
 
+# every day is aggregated for all markets of the aggregate cube, the csv files of markets pick their columns from it
+cube_asset_ids, cube_market_asset_id_pairs = asset.distinct_asset_ids(ags.cube_markets)
+cube_cols = ags.get_market_columns(ags.cube_markets)
+agg_col_positions = [cube_cols.index(column) for column in agg_cols_for_df]
+
 # create the day, hour and minute dataframes
 # agg_day_df = pd.DataFrame(index=pd.date_range(first_day, periods=days_to_model, freq=pd.DateOffset(days=1)), columns=agg_cols_for_df)
 # agg_day_df.index.name = 'date'
@@ -44,107 +66,297 @@ logging.info('Processing columns: {}'.format(agg_cols_for_df))
 # agg_hour_ar = [None]*(days_to_model*24)
 # agg_min_ar = [None]*(days_to_model*24*60)
 
-# write the data to csv files
-daily_file_path = dmu.create_aggregate_path(
-    dmu.Granularity.DAILY, markets) + '.testit.csv'
-hourly_file_path = dmu.create_aggregate_path(
-    dmu.Granularity.HOURLY, markets) + '.testit.csv'
-minute_file_path = dmu.create_aggregate_path(
-    dmu.Granularity.MINUTE, markets) + '.testit.csv'
-logging.info('Creating aggregate files \n    {}\n    {}\n    {}'.format(
-    daily_file_path, hourly_file_path, minute_file_path))
-
-# open files to create
-daily_file = open(daily_file_path, 'wt')
-hourly_file = open(hourly_file_path, 'wt')
-minute_file = open(minute_file_path, 'wt')
-daily_writer = csv.writer(daily_file)
-hourly_writer = csv.writer(hourly_file)
-minute_writer = csv.writer(minute_file)
-
-# write the headers
-daily_writer.writerow(['date']+agg_cols_for_df)
-hourly_writer.writerow(['date']+agg_cols_for_df)
-minute_writer.writerow([']date']+agg_cols_for_df)
-
-day = 0
-for current_date in date_list:
-    logging.info('Aggregating operations for {}'.format(current_date))
-
-    this_day_values = []
-    day_dir, day_path = dmu.get_daydir_daypath(current_date)
+# the headers of the aggregate files
+header_cols = agg_cols_for_df
+if asset_names_in_header:
+    header_cols = [asset.readable_column(column) for column in agg_cols_for_df]
+
+# the minute sketches of the medians are kept next to the minute aggregates, a file per day
+def get_sketch_dir():
+    return dmu.create_aggregate_path(dmu.Granularity.MINUTE, markets) + '.sketches'
+
+def get_sketch_path(current_date):
+    return get_sketch_dir() + '/' + current_date.strftime('%Y-%m-%d') + '.npz'
 
-    # if the data directory does not exist, assume we are done
-    if not isdir(day_path):
-        break
+# store the sketches of the minute partials of a day, the arrays of each operation type are prefixed by its key
+def save_minute_sketches(minute_partials, current_date):
+    sketch_arrays = {}
+    for op_key, partials in minute_partials.items():
+        if partials.moment_names:
+            for array_name, array in partials.sketch_arrays().items():
+                sketch_arrays['{}_{}'.format(op_key, array_name)] = array
+    np.savez(get_sketch_path(current_date), **sketch_arrays)
 
+# the minute sketches of a day stored by save_minute_sketches, per operation type a DataFrame of the
+# sketches indexed by its key columns and minute (see BucketAggregation.sketch_stats). empty when the
+# day has no sketch file
+def read_minute_sketches(current_date):
+    sketch_path = get_sketch_path(current_date)
+    if not isfile(sketch_path):
+        return {}
+    with np.load(sketch_path) as sketch_file:
+        sketch_arrays = {array_name: sketch_file[array_name] for array_name in sketch_file.files}
+    minute_sketches = {}
+    for op_key in bs_ops.supported_operations.keys():
+        prefix = '{}_'.format(op_key)
+        op_arrays = {array_name[len(prefix):]: array for array_name, array in sketch_arrays.items()
+                     if array_name.startswith(prefix)}
+        if op_arrays:
+            minute_sketches[op_key] = bs_ops.BucketAggregation.sketch_stats(op_arrays)
+    return minute_sketches
+
+# the median of moments name (e.g. 'rate') of an operation type from start up to (not including) end,
+# merged from the stored minute sketches instead of the operations. returns a dictionary from each
+# key (a tuple of the key column values) to its median, within quantile_sketch_error over any range
+def get_range_medians(op_key, name, start, end):
+    merged_sketches = {}
+    current_date = datetime(start.year, start.month, start.day)
+    while current_date < end:
+        day_sketches = read_minute_sketches(current_date).get(op_key)
+        if day_sketches is not None:
+            first_minute = max((start - current_date) // timedelta(minutes=1), 0)
+            end_minute = min((end - current_date) // timedelta(minutes=1), minutes_per_day)
+            minutes = day_sketches.index.get_level_values('bucket')
+            day_sketches = day_sketches[(minutes >= first_minute) & (minutes < end_minute)]
+            key_levels = list(range(day_sketches.index.nlevels - 1))
+            keys = day_sketches.index.droplevel('bucket') if key_levels else [()]*len(day_sketches)
+            for key, sketch in zip(keys, day_sketches[name + '_sketch']):
+                key = key if isinstance(key, tuple) else (key,)
+                if key in merged_sketches:
+                    merged_sketches[key].merge(sketch)
+                else:
+                    merged_sketches[key] = sketch.copy()
+        current_date += timedelta(days=1)
+    return {key: sketch.median() for key, sketch in merged_sketches.items()}
+
+# aggregate a day of operations into mergeable per minute partials, one per operation type.
+# operations outside the day are left out
+def aggregate_minute_partials(sorted_operations_dict, current_date):
+    minute_partials = {}
+    for op_key, op_class in bs_ops.supported_operations.items():
+        operations = sorted_operations_dict[op_key]
+        buckets = ((operations['block_time'] - current_date) // timedelta(minutes=1)).to_numpy()
+        in_day = (buckets >= 0) & (buckets < minutes_per_day)
+        operations = operations[in_day].assign(bucket=buckets[in_day])
+        minute_partials[op_key] = op_class.get_agg_partials(operations, minutes_per_day)
+    return minute_partials
+
+# the values of the buckets of granularity from the partials rolled up to granularity.
+# returns the start time of each bucket and the bucket values of every column of cube_cols
+def aggregate_buckets(rolled_partials, current_date, granularity):
+    unit_minutes = dmu.Granularity.unit_minutes[granularity]
+    bucket_cnt = minutes_per_day // unit_minutes
+    bucket_values = []
+    for op_key, op_class in bs_ops.supported_operations.items():
+        bucket_values += op_class.get_agg_partial_values(
+            cube_asset_ids, cube_market_asset_id_pairs, rolled_partials[op_key])
+    return [current_date + timedelta(minutes=unit_minutes)*bucket for bucket in range(bucket_cnt)], bucket_values
+
+# a row per bucket with the bucket's start time followed by the values of agg_cols_for_df,
+# for sparse granularities only the buckets where some value differs from the 0 or '' of an empty bucket
+def get_csv_rows(dates, bucket_values, granularity):
+    bucket_values = [bucket_values[position] for position in agg_col_positions]
+    bucket_cnt = len(dates)
+    rows = np.empty((bucket_cnt, len(bucket_values) + 1), dtype=object)
+    rows[:, 0] = dates
+    for col, values in enumerate(bucket_values):
+        rows[:, col + 1] = values
+    if granularity in sparse_granularities:
+        has_values = np.zeros(bucket_cnt, dtype=bool)
+        for values in bucket_values:
+            has_values |= (values != 0) & (values != '')
+        rows = rows[has_values]
+    return rows.tolist()
+
+# aggregate the operations of a day, returns the csv rows, the aggregate cube table and in all-markets
+# mode the market table of each granularity of aggregate_granularities. only reads the day's partitions,
+# so days can be aggregated in any order and in separate processes
+def aggregate_day(current_date):
     logging.info('Processing Day {}'.format(current_date))
+    day_dir, day_path = dmu.get_daydir_daypath(current_date)
     sorted_operations_dict = {}
     for op_key, op_class in bs_ops.supported_operations.items():
-        file_path = day_path + '/operation-' + '{:02d}'.format(op_key) + '.csv'
-        operations = pd.read_csv(file_path)
-        operations['block_time'] = operations['block_time'].astype('datetime64[ns]') 
+        operations = ps.read_operations(day_path, op_key, ['block_time'] + op_class.agg_read_cols)
         sorted_operations = operations.sort_values(by=['block_time'])
         sorted_operations_dict[op_key] = sorted_operations
-    
-    this_day_values = []
-    for op_key, op_class in bs_ops.supported_operations.items():
-        this_day_values += op_class.get_agg_value_list(
-            asset_ids, market_asset_id_pairs, sorted_operations_dict[op_key])
-
-    # Add a new row to the day dataframe
-    # agg_day_df.loc[current_date] = this_day_values
-    # agg_day_ar[day] = [current_date] + this_day_values
-    daily_writer.writerow([current_date] + this_day_values)
-
-    # now lets process the hours
-    for hour in range(24):
-        this_hour_values = []
-        current_hour = datetime(current_date.year, current_date.month, current_date.day, hour)
-        # logging.info('Processing Hour {}'.format(current_hour))
-        for op_key, op_class in bs_ops.supported_operations.items():
-            op_operations = sorted_operations_dict[op_key]
-            hourly_operations = op_operations[(op_operations['block_time'] >= current_hour) & (op_operations['block_time'] < current_hour + timedelta(hours=1))]
-            this_hour_values += op_class.get_agg_value_list(
-                asset_ids, market_asset_id_pairs, hourly_operations)
-
-        # Add a new row to the day dataframe
-        # agg_hour_df.loc[current_hour] = this_hour_values
-        # agg_hour_ar[day*24 + hour] = [current_hour] + this_hour_values
-        hourly_writer.writerow([current_hour] + this_hour_values)
-
-        # and finally process by minutes
-        for minute in range(60):
-            this_minute_values = []
-            current_minute = datetime(current_date.year, current_date.month, current_date.day, hour, minute)
-            # logging.info('Processing Minute {}'.format(current_minute))
-            for op_key, op_class in bs_ops.supported_operations.items():
-                op_operations = sorted_operations_dict[op_key]
-                minute_operations = op_operations[(op_operations['block_time'] >= current_minute) & (op_operations['block_time'] < current_minute + timedelta(minutes=1))]
-                this_minute_values += op_class.get_agg_value_list(
-                    asset_ids, market_asset_id_pairs, minute_operations)
-
-            # Add a new row to the minute dataframe
-            # agg_minute_df.loc[current_minute] = this_minute_values
-            # agg_min_ar[((day*24 + hour)*60 + minute)] = [current_minute] + this_minute_values
-            minute_writer.writerow([current_minute] + this_minute_values)
-
-    # update the day count
-    day += 1
-
-daily_file.close()
-hourly_file.close()
-minute_file.close()
-
-# write the data to csv files
-daily_file_path = dmu.create_aggregate_path(dmu.Granularity.DAILY, markets)
-hourly_file_path = dmu.create_aggregate_path(dmu.Granularity.HOURLY, markets)
-minute_file_path = dmu.create_aggregate_path(dmu.Granularity.MINUTE, markets)
-
-# logging.warning('Writing aggregate data to {}'.format(daily_file_path))
-# print(agg_day_df)
-# agg_day_df.to_csv(path_or_buf=daily_file_path)
-# logging.warning('Writing aggregate data to {}'.format(hourly_file_path))
-# agg_hour_df.to_csv(path_or_buf=hourly_file_path)
-# logging.warning('Writing aggregate data to {}'.format(minute_file_path))
-# agg_minute_df.to_csv(path_or_buf=minute_file_path)
+
+    # the minutes are aggregated once, every granularity is rolled up from them
+    minute_partials = aggregate_minute_partials(sorted_operations_dict, current_date)
+    if quantile_sketch_error is not None:
+        save_minute_sketches(minute_partials, current_date)
+    granularity_rows = {}
+    cube_days = {}
+    market_days = {}
+    for granularity in aggregate_granularities:
+        unit_minutes = dmu.Granularity.unit_minutes[granularity]
+        rolled_partials = {op_key: partials.rollup(unit_minutes) for op_key, partials in minute_partials.items()}
+        dates, bucket_values = aggregate_buckets(rolled_partials, current_date, granularity)
+        granularity_rows[granularity] = get_csv_rows(dates, bucket_values, granularity)
+        cube_days[granularity] = ags.make_cube_day(dates, cube_cols, bucket_values, granularity in sparse_granularities)
+        if all_markets:
+            market_days[granularity] = ags.make_market_day(current_date, unit_minutes, {
+                op_key: op_class.get_agg_market_frame(rolled_partials[op_key])
+                for op_key, op_class in bs_ops.supported_operations.items()})
+    return current_date, granularity_rows, cube_days, market_days
+
+# the days of date_list up to the first one the ingest manifest does not list as complete, a day's
+# directory exists while the loader is still writing it
+def get_loaded_days():
+    for current_date in date_list:
+        day_dir, day_path = dmu.get_daydir_daypath(current_date)
+        if not ingest_manifest.is_day_complete(day_dir):
+            break
+        yield current_date
+
+# aggregate_day for a (date, changed) item of aggregate_days, days that did not change are left to the writer
+def aggregate_changed_day(day_item):
+    current_date, changed = day_item
+    if not changed:
+        return current_date, None, None, None
+    return aggregate_day(current_date)
+
+# aggregate the loaded days and write the rows of every granularity to its csv file.
+# with incremental set, the aggregate manifest tells which days changed since the files were written.
+# the files are cut at the first changed day, the days after it are written again, the changed ones
+# freshly aggregated and the others copied from the cut off rows, and the days before it are left alone.
+# in parallel mode the days are handed to max_workers processes, the pipeline hands the finished
+# days to the writers in date order (days finished early wait for the ones before them) and
+# holds at most max_days_in_flight days that are waiting, being aggregated or being written. besides
+# the queued days the fetch thread holds the day it is queueing and the writer the day it is writing,
+# so the queue gets two days less (at least one)
+def aggregate_days(parallel=False, max_workers=4, max_days_in_flight=8, incremental=True):
+    # write the data to csv files, one per granularity
+    aggregate_file_paths = {granularity: ags.get_aggregate_file_path(granularity, markets)
+                            for granularity in aggregate_granularities}
+    logging.info('Creating aggregate files \n    {}'.format('\n    '.join(aggregate_file_paths.values())))
+    if quantile_sketch_error is not None and not isdir(get_sketch_dir()):
+        mkdir(get_sketch_dir())
+
+    settings = {'first_day': first_day.strftime('%Y%m%d'), 'markets': markets,
+                'granularities': aggregate_granularities, 'sparse_granularities': sparse_granularities,
+                'columns': header_cols, 'cube_columns': cube_cols,
+                'quantile_sketch_error': quantile_sketch_error, 'all_markets': all_markets}
+    manifest = am.read_manifest(markets, settings)
+    if not incremental or not am.files_match(manifest, aggregate_file_paths):
+        manifest = am.new_manifest(settings)
+    old_days = manifest['days']
+    old_day_dirs = sorted(old_days)
+
+    # the loaded days with the fingerprints of their files, the first one that is new or changed starts the splice
+    days = []
+    for current_date in get_loaded_days():
+        day_dir, day_path = dmu.get_daydir_daypath(current_date)
+        fingerprint = am.get_day_fingerprint(day_path)
+        changed = day_dir not in old_days or old_days[day_dir]['fingerprint'] != fingerprint or \
+            not all(isfile(ags.get_cube_path(granularity, ags.get_month(day_dir))) for granularity in aggregate_granularities) or \
+            (all_markets and not all(isfile(ags.get_markets_path(granularity, ags.get_month(day_dir)))
+                                     for granularity in aggregate_granularities))
+        days.append((current_date, day_dir, fingerprint, changed))
+    splice_start = next((index for index, day_item in enumerate(days) if day_item[3]), len(days))
+    if splice_start == len(days) == len(old_day_dirs):
+        logging.info('Aggregates are up to date')
+        return 0
+    if splice_start < len(days):
+        logging.info('Aggregating {} changed days from {} on'.format(
+            sum(day_item[3] for day_item in days), days[splice_start][0]))
+    else:
+        logging.info('Removing the aggregates of {} days that are no longer loaded'.format(len(old_day_dirs) - len(days)))
+
+    # move the rows from the splice on to tail files, the unchanged days are copied back from there
+    aggregate_files = {}
+    tail_files = {}
+    splice_offsets = old_days[old_day_dirs[splice_start]]['offsets'] if splice_start < len(old_day_dirs) else manifest['sizes']
+    for granularity, file_path in aggregate_file_paths.items():
+        if not old_days:
+            aggregate_files[granularity] = open(file_path, 'wt')
+            continue
+        with open(file_path, 'rb') as aggregate_file, open(file_path + '.tail', 'wb') as tail_file:
+            aggregate_file.seek(splice_offsets[granularity])
+            shutil.copyfileobj(aggregate_file, tail_file)
+        truncate(file_path, splice_offsets[granularity])
+        aggregate_files[granularity] = open(file_path, 'at')
+        tail_files[granularity] = open(file_path + '.tail', 'rb')
+    aggregate_writers = {granularity: csv.writer(aggregate_file) for granularity, aggregate_file in aggregate_files.items()}
+    if not old_days:
+        for aggregate_writer in aggregate_writers.values():
+            aggregate_writer.writerow(['date']+header_cols)
+
+    cube_writers = {granularity: ags.CubeWriter(granularity, ags.get_cube_schema(cube_cols))
+                    for granularity in aggregate_granularities}
+    if all_markets:
+        cube_writers.update({(granularity, 'markets'): ags.CubeWriter(granularity, ags.get_market_schema(), ags.get_markets_path)
+                             for granularity in aggregate_granularities})
+    new_days = {day_dir: old_days[day_dir] for day_dir in old_day_dirs[:splice_start]}
+    fingerprints = {day_item[1]: day_item[2] for day_item in days}
+
+    # the rows of an unchanged day as they were written last time
+    def copy_day_rows(day_dir, granularity):
+        day_index = old_day_dirs.index(day_dir)
+        day_start = old_days[day_dir]['offsets'][granularity]
+        if day_index + 1 < len(old_day_dirs):
+            day_end = old_days[old_day_dirs[day_index + 1]]['offsets'][granularity]
+        else:
+            day_end = manifest['sizes'][granularity]
+        tail_files[granularity].seek(day_start - splice_offsets[granularity])
+        aggregate_files[granularity].write(tail_files[granularity].read(day_end - day_start).decode())
+
+    def write_day(day_rows):
+        current_date, granularity_rows, cube_days, market_days = day_rows
+        day_dir, day_path = dmu.get_daydir_daypath(current_date)
+        logging.info('Writing aggregates for {}'.format(current_date))
+        offsets = {}
+        for granularity, aggregate_writer in aggregate_writers.items():
+            offsets[granularity] = aggregate_files[granularity].tell()
+            if granularity_rows is None:
+                copy_day_rows(day_dir, granularity)
+            else:
+                aggregate_writer.writerows(granularity_rows[granularity])
+                cube_writers[granularity].add_day(day_dir, cube_days[granularity])
+                if all_markets:
+                    cube_writers[(granularity, 'markets')].add_day(day_dir, market_days[granularity])
+        new_days[day_dir] = {'fingerprint': fingerprints[day_dir], 'offsets': offsets}
+
+    day_items = [(current_date, changed) for current_date, day_dir, fingerprint, changed in days[splice_start:]]
+    try:
+        if parallel:
+            pipeline = tpt.StagedPipeline(day_items, aggregate_changed_day, write_day,
+                                          workers=max_workers, queue_size=max(max_days_in_flight - 2, 1),
+                                          use_processes=True)
+            day = pipeline.run()
+        else:
+            day = 0
+            for day_item in day_items:
+                write_day(aggregate_changed_day(day_item))
+                day += 1
+        for cube_writer in cube_writers.values():
+            cube_writer.close()
+        manifest['days'] = new_days
+        manifest['sizes'] = {granularity: aggregate_file.tell() for granularity, aggregate_file in aggregate_files.items()}
+    except BaseException:
+        # put the rows from the splice on back so the files match the manifest of the last run again,
+        # a tail file is only removed once it is copied back
+        for aggregate_file in aggregate_files.values():
+            aggregate_file.close()
+        for granularity, tail_file in tail_files.items():
+            truncate(aggregate_file_paths[granularity], splice_offsets[granularity])
+            tail_file.seek(0)
+            with open(aggregate_file_paths[granularity], 'ab') as aggregate_file:
+                shutil.copyfileobj(tail_file, aggregate_file)
+            tail_file.close()
+            remove(aggregate_file_paths[granularity] + '.tail')
+        raise
+    for aggregate_file in aggregate_files.values():
+        aggregate_file.close()
+    for granularity, tail_file in tail_files.items():
+        tail_file.close()
+        remove(aggregate_file_paths[granularity] + '.tail')
+    am.write_manifest(markets, manifest)
+    return day
+
+if __name__ == "__main__":
+    parallel           = False   # aggregate days in worker processes
+    max_workers        = 4       # number of days aggregated at once in parallel mode
+    max_days_in_flight = 8       # days aggregated, waiting or being written at most in parallel mode (at least 3)
+    incremental        = True    # only aggregate the days that changed since the last run
+    aggregate_days(parallel=parallel, max_workers=max_workers, max_days_in_flight=max_days_in_flight,
+                   incremental=incremental)
@@ -7,6 +7,8 @@ from elasticsearch.helpers import scan
 import pandas as pd
 import numpy as np
 import json
+import functools
+import math
 import bitshares_operations as bso
 from os import makedirs
 from os import mkdir
@@ -14,15 +16,25 @@ from os.path import isdir
 from pathlib import Path
 import logging
 import csv
+import time
+import concurrent.futures as cf
 
 import dir_mgmt_utils as dmu
+import ThreadPoolTest as tpt
+import partition_store as ps
+import ingest_manifest
+import lifecycle_index
+import account_index
+import raw_cache as rc
 import operation as bs_ops
 import asset
 
 # function to create the query for each day
 # takes a list of supported operation ids and the current day to query for
+# and optionally the list of _source fields to return instead of the full documents
+# and a market filter to push down to Elasticsearch
 #
-def current_day_query(supported_operation_ids, current_day):
+def current_day_query(supported_operation_ids, current_day, source_fields=None, market_filter=None):
     next_day = current_day + timedelta(days=1)
 
     aQuery = {
@@ -49,109 +61,390 @@ def current_day_query(supported_operation_ids, current_day):
             }
         }
     }
+    if source_fields is not None:
+        aQuery['_source'] = {'includes': source_fields}
+    if market_filter is not None:
+        aQuery['query']['bool']['filter'].append(market_query_clause(market_filter))
     return aQuery
 
+# query clause keeping the operation types that can't be filtered plus the operations whose op string
+# mentions one of the market filter's asset ids. this relies on operation_history.op being indexed as
+# text, where the standard analyzer keeps ids like 1.3.121 as one token, so it is only used when
+# es_market_clause is set. the loader's own filter still makes the exact decision after parsing
+def market_query_clause(market_filter):
+    return {
+        "bool": {
+            "should": [
+                {
+                    "terms": {
+                        "operation_type": market_filter.unfiltered_operation_ids()
+                    }
+                },
+                {
+                    "match": {
+                        "operation_history.op": " ".join(sorted(market_filter.asset_ids))
+                    }
+                }
+            ],
+            "minimum_should_match": 1
+        }
+    }
+
 logging.basicConfig(format='%(asctime)s %(module)s:%(lineno)d %(message)s', level=logging.WARNING)
 
-es = Elasticsearch(
-    [
-        'http://localhost:9200/'
-    ]
-)
-# s = Search(using=es)
-
-# here is where we will store the parsed data retrieved from Elasticsearch
-if not isdir(dmu.rootdir):
-    makedirs(dmu.rootdir)
-    logging.warning('created rootdir {}'.format(dmu.rootdir))
-
-# this dictionary will store the data paths that we have created or validated
-dir_dict = {}
-
-# set a current day that is before the advent of BitShares
-
-current_day = datetime(2015, 1, 1)                          # start absurdly early date to force first loop set up
-operation_day = datetime(2016, 1, 1)                       # first operation day
-day_dir, day_path = dmu.get_daydir_daypath(current_day)     # path components to storage location
-day_operation_cnt = 1                                       # day operation count > 0 to force first loop
-total_length = 0                                            # total count is just to keep track of total ops
-max_operations = 1000000000                                 # stop when we reach this operations count
+es_hosts       = ['http://localhost:9200/']                 # Elasticsearch nodes holding the bitshares-* indices
+es_index       = 'bitshares-*'                              # index pattern to scan
+scan_size      = 10000                                      # documents per scroll page
+docs_per_slice = 500000                                     # target documents per sliced scroll on busy days
+max_slices     = 8                                          # upper bound on sliced scrolls for one day
 log_frequency  = 1000000                                    # used for limiting logging of operation progress
-overwrite      = True                                       # indicates whether to overwrite earlier processing
-operation_type_query = current_day_query([*bs_ops.supported_operations], operation_day)
+checkpoint_frequency = 1000000                              # operations between checkpoints within a day
+parse_batch_size = 5000                                     # hits handed to a parse worker at a time
+parse_workers  = 4                                          # parse threads in the loader's pipeline
+pipeline_queue_size = 8                                     # parsed batches allowed to wait for the writer
+columnar_parse = True                                       # parse batches into typed columns instead of objects
+write_chunk_rows = 50000                                    # rows buffered per operation type before they are written
+partition_format = 'parquet'                                # day files as 'parquet', or 'csv' for the original CSV files
+index_lifecycles = True                                     # add each loaded day to the limit order lifecycle index
+index_accounts = True                                       # add each loaded day to the account index
 
-# keep going until we break out or we run out of operations
-while day_operation_cnt > 0:
-    logging.info(day_operation_cnt)
-    day_operation_cnt = 0
+# each worker process keeps its own Elasticsearch client, set up by init_worker
+es = None
+
+def create_es_client():
+    return Elasticsearch(es_hosts)
+
+# process pool initializer, gives every worker process its own Elasticsearch connection
+def init_worker():
+    global es
+    es = create_es_client()
+
+# decode the JSON string fields of an Elasticsearch hit in place
+def decode_hit(a_json_operation):
+    # parse the operation details structures from JSON string that elasticsearch doesn't understand
+    # with _source projection only the strings the operation's class reads are present
+    # and documents replayed from the raw cache have been decoded already
+    operation_history = a_json_operation['_source'].get('operation_history', {})
+    if isinstance(operation_history.get('op'), str):
+        operation_history['op'] = json.loads(operation_history['op'])
+    if isinstance(operation_history.get('operation_result'), str):
+        operation_history['operation_result'] = json.loads(operation_history['operation_result'])
+
+# decode an Elasticsearch hit and turn it into an Operation object
+def parse_hit(a_json_operation):
+    decode_hit(a_json_operation)
+    return bs_ops.parse_operation(a_json_operation)
 
-    # process each day
-    skip = False
-    for a_json_operation in scan(es,
-                                 query=operation_type_query,
-                                 size=10000,
-                                 index='bitshares-*'):
-                                #  index='bitshares-{:4d}-{:02d}'.format(index_year, index_month)):
-        # increment the count of operations in current day
-        day_operation_cnt += 1
-        total_length += 1
-
-        # parse the operation details structures from JSON string that elasticsearch doesn't understand
-        if 'operation_type' in a_json_operation['_source'].keys():
-            a_json_operation['_source']['operation_history']['op'] = json.loads(
-                a_json_operation['_source']['operation_history']['op'])
-            a_json_operation['_source']['operation_history']['operation_result'] = json.loads(
-                a_json_operation['_source']['operation_history']['operation_result'])
-        an_operation = bs_ops.parse_operation(a_json_operation)
-
-        # decide if we need to bump the aggregation to the next day, hour, or minute (only day for now)
-        operation_day = datetime(an_operation.block_time.year,
-                                 an_operation.block_time.month,
-                                 an_operation.block_time.day)
-
-        # update current day and create day directory if necessary and initialize daily tracking
-        if operation_day != current_day:
-            day_dir, day_path = dmu.get_daydir_daypath(operation_day)
-            if not day_dir in dir_dict:
-                if not isdir(day_path):
-                    mkdir(day_path)
-                    logging.warning('created day dir {}'.format(day_path))
-                logging.warning('set day key {}'.format(day_dir))
-                dir_dict[day_dir] = {}
-            current_day = operation_day
-
-            # if we don't want to re-process existing results, check to see if there are existing results
-            if not overwrite:
-                skip = True
-                for op_key in bs_ops.supported_operations.keys():
-                    file_path = Path(day_path + '/operation-' + '{:02d}'.format(op_key) + '.csv')
-                    if not file_path.is_file():
-                        skip = False
-                if skip:
-                    break
-
-            # create the dataframes for each of the supported operations
-            op_lists = bs_ops.make_empty_lists()
-            logging.debug("Processed {} operations".format(op_lists))
+# pick how many sliced scrolls to split a day into from its document count
+def pick_slice_count(doc_count):
+    slice_cnt = math.ceil(doc_count/docs_per_slice)
+    return min(max(slice_cnt, 1), max_slices)
+
+# turn a batch of Elasticsearch hits into a ColumnBatch (with columnar_parse) or a list of rows per
+# operation type, this is the parse stage of the loader's pipeline. returns them, the number of hits,
+# the batch's last operation id and the hits themselves, now decoded, for the raw cache
+# with a market filter, hits whose op string mentions none of the filter's assets are dropped before
+# they are decoded (unless decode_all is set because the raw cache needs every hit) and the rest are
+# filtered exactly once parsed
+def parse_batch(hits, market_filter=None, decode_all=False):
+    parse_hits = hits
+    if market_filter is not None:
+        parse_hits = [a_json_operation for a_json_operation in hits if market_filter.may_match(a_json_operation)]
+        if decode_all:
+            for a_json_operation in hits:
+                decode_hit(a_json_operation)
+
+    if columnar_parse:
+        for a_json_operation in parse_hits:
+            decode_hit(a_json_operation)
+        batches = bs_ops.parse_batches(parse_hits)
+        if market_filter is not None:
+            batches = {op_key: market_filter.filter_batch(batch) for op_key, batch in batches.items()}
+        return batches, len(hits), hits[-1]['_source']['operation_id_num'], hits
+
+    op_lists = bs_ops.make_empty_lists()
+    for a_json_operation in parse_hits:
+        an_operation = parse_hit(a_json_operation)
+        if market_filter is None or market_filter.matches(an_operation):
+            bs_ops.append_record(an_operation, op_lists)
+    return op_lists, len(hits), hits[-1]['_source']['operation_id_num'], hits
+
+# run a scan through the fetch / parse / write pipeline, write_batch receives the output of
+# parse_batch in scan order on the pipeline's writer thread
+def run_pipeline(hits, write_batch, market_filter=None, decode_all=False):
+    pipeline = tpt.StagedPipeline(tpt.batched(hits, parse_batch_size),
+                                  functools.partial(parse_batch, market_filter=market_filter,
+                                                    decode_all=decode_all),
+                                  write_batch,
+                                  workers=parse_workers,
+                                  queue_size=pipeline_queue_size)
+    pipeline.run()
+
+# run hits through the pipeline into the day's partition writer, copying them to the raw cache if given
+# returns the number of operations
+def load_hits(hits, day_label, writer, raw_writer=None, market_filter=None):
+    operation_cnt = 0
+
+    def write_batch(parsed):
+        nonlocal operation_cnt
+        batch_operations, batch_operation_cnt, last_operation_id, batch_hits = parsed
+        writer.append_lists(batch_operations)
+        if raw_writer is not None:
+            raw_writer.write(batch_hits)
 
         # print a ticker of operations processed
-        if total_length % log_frequency == 0:
-            logging.warning("Processed {} operations".format(total_length))
+        if (operation_cnt + batch_operation_cnt) // log_frequency > operation_cnt // log_frequency:
+            logging.warning("Processed {} operations for {}".format(
+                operation_cnt + batch_operation_cnt, day_label))
+        operation_cnt += batch_operation_cnt
+
+    run_pipeline(hits, write_batch, market_filter, raw_writer is not None)
+    return operation_cnt
+
+# scan one slice of a day's query (or the whole day when slice_cnt is 1) into the partition writer
+# returns the number of operations scanned
+def load_slice(operation_type_query, day_dir, writer, slice_id=0, slice_cnt=1, raw_writer=None, market_filter=None):
+    if slice_cnt > 1:
+        operation_type_query = dict(operation_type_query, slice={'id': slice_id, 'max': slice_cnt})
 
-        # append the processed operation to the dataframe aligned to that operation
-        bs_ops.append_record(an_operation, op_lists)
+    return load_hits(scan(es,
+                          query=operation_type_query,
+                          size=scan_size,
+                          index=es_index),
+                     '{} slice {}/{}'.format(day_dir, slice_id, slice_cnt),
+                     writer,
+                     raw_writer,
+                     market_filter)
 
-    # write out the dataframes for each supported operation type
-    if not skip:
-        for op_key, op_list in op_lists.items():
-            file_path = day_path + '/operation-' + '{:02d}'.format(op_key) + '.csv'
-            logging.warning(file_path)
-            np.savetxt(file_path, op_list, delimiter=",", fmt='%s')
-    # break
+# scan a day as slice_cnt sliced scrolls consumed concurrently, all writing to the same partition writer
+# returns the number of operations scanned
+def load_sliced(operation_type_query, day_dir, slice_cnt, writer, raw_writer=None, market_filter=None):
+    day_operation_cnt = 0
+    with cf.ThreadPoolExecutor(max_workers=slice_cnt) as executor:
+        futures = [executor.submit(load_slice, operation_type_query, day_dir, writer, slice_id, slice_cnt,
+                                   raw_writer, market_filter)
+                   for slice_id in range(slice_cnt)]
+        for future in futures:
+            day_operation_cnt += future.result()
+    return day_operation_cnt
+
+# scan a whole day in operation_id_num order, recording a checkpoint of the partition writer in the
+# manifest every checkpoint_frequency operations. a day with a checkpoint left by an earlier run
+# is resumed after the checkpoint's operation id (only days scanned from the start are copied to
+# the raw cache)
+def load_checkpointed(operation_type_query, day_dir, entry, writer, raw_writer=None, market_filter=None):
+    checkpoint = entry['checkpoint']
+    if checkpoint is not None:
+        logging.warning('resuming day {} after operation {}'.format(day_dir, checkpoint['operation_id']))
+        entry['doc_count'] = checkpoint['doc_count']
+        operation_type_query['query']['bool']['filter'].append(
+            {'range': {'operation_id_num': {'gt': checkpoint['operation_id']}}})
+    else:
+        entry['doc_count'] = 0
+    operation_type_query['sort'] = [{'operation_id_num': 'asc'}]
+
+    since_checkpoint = 0
+
+    # the writer stage, streams the parsed rows to the writer and checkpoints them
+    # batches arrive in scan order so the batch's last operation id is a safe resume point
+    def write_batch(parsed):
+        nonlocal since_checkpoint
+        batch_operations, batch_operation_cnt, last_operation_id, batch_hits = parsed
+        writer.append_lists(batch_operations)
+        if raw_writer is not None:
+            raw_writer.write(batch_hits)
+        entry['doc_count'] += batch_operation_cnt
+        since_checkpoint += batch_operation_cnt
+
+        if since_checkpoint >= checkpoint_frequency:
+            entry['checkpoint'] = writer.checkpoint(last_operation_id)
+            entry['checkpoint']['doc_count'] = entry['doc_count']
+            ingest_manifest.write_day_entry(entry)
+            since_checkpoint = 0
+            logging.warning("Processed {} operations for {}".format(entry['doc_count'], day_dir))
+
+    run_pipeline(scan(es,
+                      query=operation_type_query,
+                      size=scan_size,
+                      index=es_index,
+                      preserve_order=True),
+                 write_batch,
+                 market_filter,
+                 raw_writer is not None)
+
+# scan, parse and write a single day of operations
+# days the manifest lists as complete are skipped without querying Elasticsearch unless reload is set
+# when sliced is set, busy days are split into sliced scrolls sized from a _count of the day,
+# sliced days are not checkpointed and start over after a crash
+# source 'es' scans Elasticsearch and, with raw_cache set, keeps a copy of the documents in the raw
+# cache, source 'cache' replays the day from the raw cache without touching Elasticsearch
+# markets limits the stored operations to those aggregated for that list of markets, days loaded
+# for a different market list are loaded again. es_market_clause also pushes the filter down
+# to Elasticsearch, see market_query_clause, and turns off the raw cache for the day
+# rows are streamed to the day's files write_chunk_rows at a time, which only get their final
+# names once the day is complete. the files are written in partition_format, days stored in another
+# format are loaded again
+# returns the number of operations found for that day, 0 means there was nothing to load
+# and None means the day was skipped because it was already loaded
+def load_day(current_day, reload=False, sliced=False, source='es', raw_cache=False,
+             markets=None, es_market_clause=False):
+    global es
+    market_filter = None
+    if markets is not None:
+        market_filter = bs_ops.MarketFilter(markets)
+
+    day_dir, day_path = dmu.get_daydir_daypath(current_day)
+    entry = ingest_manifest.read_day_entry(day_dir)
+    entry_markets = None
+    if market_filter is not None:
+        entry_markets = market_filter.markets
+    if entry['markets'] != entry_markets and (entry['complete'] or entry['checkpoint'] is not None):
+        logging.warning('day {} was loaded for markets {}, loading again'.format(day_dir, entry['markets']))
+        entry = ingest_manifest.new_day_entry(day_dir)
+    if entry.get('format', 'csv') != partition_format and (entry['complete'] or entry['checkpoint'] is not None):
+        logging.warning('day {} was stored as {}, loading again'.format(day_dir, entry.get('format', 'csv')))
+        entry = ingest_manifest.new_day_entry(day_dir)
+    if entry['complete']:
+        if not reload:
+            logging.warning('skipping day {}, already loaded'.format(day_dir))
+            return None
+        entry = ingest_manifest.new_day_entry(day_dir)
+    entry['markets'] = entry_markets
+    entry['format'] = partition_format
+
+    if source == 'cache':
+        if not rc.has_raw_day(day_dir):
+            logging.warning('no raw cache for day {}'.format(day_dir))
+            return 0
+        entry['checkpoint'] = None
+        writer = ps.make_partition_writer(partition_format, day_path, write_chunk_rows)
+        entry['doc_count'] = load_hits(rc.read_raw_day(day_dir), day_dir, writer, market_filter=market_filter)
+    else:
+        if es is None:
+            es = create_es_client()
+        operation_type_query = current_day_query([*bs_ops.supported_operations], current_day,
+                                                 bs_ops.source_includes(),
+                                                 market_filter if es_market_clause else None)
+        slice_cnt = 1
+        if sliced and entry['checkpoint'] is None:
+            doc_count = es.count(index=es_index, body={'query': operation_type_query['query']})['count']
+            slice_cnt = pick_slice_count(doc_count)
+            logging.warning('day {} has {} operations, scanning {} slices'.format(day_dir, doc_count, slice_cnt))
+
+        raw_writer = None
+        if raw_cache and market_filter is not None and es_market_clause:
+            logging.warning('not caching day {}, Elasticsearch only returned the filtered markets'.format(day_dir))
+        elif raw_cache and entry['checkpoint'] is None:
+            raw_writer = rc.RawCacheWriter(day_dir)
 
-    # exit early if we exceed the max count of records to be processed
-    if total_length >= max_operations:
-        break
+        writer = ps.make_partition_writer(partition_format, day_path, write_chunk_rows, entry['checkpoint'])
+        try:
+            if slice_cnt > 1:
+                entry['doc_count'] = load_sliced(operation_type_query, day_dir, slice_cnt, writer,
+                                                 raw_writer, market_filter)
+            else:
+                load_checkpointed(operation_type_query, day_dir, entry, writer, raw_writer, market_filter)
+        except BaseException:
+            if raw_writer is not None:
+                raw_writer.abort()
+            raise
+
+        if raw_writer is not None:
+            if entry['doc_count'] > 0:
+                raw_writer.close()
+            else:
+                raw_writer.abort()
+
+    if entry['doc_count'] == 0:
+        writer.abort()
+        return 0
+    writer.close()
+    entry['op_counts'] = writer.op_counts
+    entry['max_operation_id'] = writer.max_operation_id
+    entry['complete'] = True
+    entry['checkpoint'] = None
+    ingest_manifest.write_day_entry(entry)
+    # a day that fails to index stays loaded, the indexes' index_days pick it up again
+    if index_lifecycles:
+        lifecycle_index.index_day(day_dir, day_path)
+    if index_accounts:
+        account_index.index_day(day_dir, day_path)
+    return entry['doc_count']
+
+# load a range of days by handing each day to a pool of worker processes
+# at most max_workers days are scanned at once, the rest wait in the pool's queue
+def load_days_parallel(first_day, days_to_load, max_workers=4, reload=False, sliced=False,
+                       source='es', raw_cache=False, markets=None, es_market_clause=False):
+    day_list = [first_day + timedelta(days=x) for x in range(0, days_to_load)]
+    start_time = time.time()
+    days_done = 0
+    empty_days = 0
+    skipped_days = 0
+    total_length = 0
+
+    with cf.ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+        futures = {executor.submit(load_day, a_day, reload, sliced, source, raw_cache,
+                                   markets, es_market_clause): a_day for a_day in day_list}
+        for future in cf.as_completed(futures):
+            a_day = futures[future]
+            try:
+                day_operation_cnt = future.result()
+            except Exception:
+                logging.exception('failed to load day {}'.format(a_day.strftime('%Y%m%d')))
+                continue
+            days_done += 1
+            if day_operation_cnt is None:
+                skipped_days += 1
+                day_operation_cnt = 0
+            elif day_operation_cnt == 0:
+                empty_days += 1
+            total_length += day_operation_cnt
+            elapsed = time.time() - start_time
+            logging.warning('Loaded {} ({} operations), {}/{} days, {} operations, {:.0f} ops/sec'.format(
+                a_day.strftime('%Y%m%d'), day_operation_cnt, days_done, len(day_list),
+                total_length, total_length/max(elapsed, 1)))
+
+    elapsed = time.time() - start_time
+    logging.warning('Finished {} days ({} skipped, {} empty, {} failed), {} operations in {:.0f} seconds'.format(
+        days_done, skipped_days, empty_days, len(day_list) - days_done, total_length, elapsed))
+    return total_length
+
+if __name__ == "__main__":
+    operation_day  = datetime(2016, 1, 1)                   # first operation day
+    days_to_load   = 940                                    # number of days to load in parallel mode
+    max_operations = 1000000000                             # stop when we reach this operations count
+    reload         = False                                  # re-scan days the ingest manifest lists as complete
+    parallel       = True                                   # load days in worker processes
+    max_workers    = 4                                      # number of days loaded at once in parallel mode
+    sliced         = False                                  # split busy days into sliced scrolls
+    source         = 'es'                                   # 'es' to scan Elasticsearch, 'cache' to replay the raw cache
+    raw_cache      = True                                   # keep a raw copy of scanned days for later re-parsing
+    markets        = None                                   # e.g. ['USD/CNY', 'USD/BTS', 'CNY/BTS'] to only keep those markets
+    es_market_clause = False                                # also filter the markets in the Elasticsearch query
+
+    # here is where we will store the parsed data retrieved from Elasticsearch
+    if not isdir(dmu.rootdir):
+        makedirs(dmu.rootdir)
+        logging.warning('created rootdir {}'.format(dmu.rootdir))
+
+    if parallel:
+        load_days_parallel(operation_day, days_to_load, max_workers=max_workers, reload=reload, sliced=sliced,
+                           source=source, raw_cache=raw_cache, markets=markets,
+                           es_market_clause=es_market_clause)
+    else:
+        # keep going one day at a time until we run out of operations
+        total_length = 0
+        day_operation_cnt = 1
+        while day_operation_cnt > 0:
+            day_operation_cnt = load_day(operation_day, reload, sliced, source, raw_cache,
+                                         markets, es_market_clause)
+            operation_day += timedelta(days=1)
+            if day_operation_cnt is None:
+                day_operation_cnt = 1
+                continue
+            total_length += day_operation_cnt
+            logging.warning("Processed {} operations".format(total_length))
 
-    # set up the query for the next day
-    operation_type_query = current_day_query([*bs_ops.supported_operations], current_day + timedelta(days=1))
+            # exit early if we exceed the max count of records to be processed
+            if total_length >= max_operations:
+                break
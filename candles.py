@@ -0,0 +1,190 @@
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+from os import replace
+from os.path import isfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import dir_mgmt_utils as dmu
+import ingest_manifest
+import partition_store as ps
+import object_ids as oid
+import aggregate_manifest as am
+import aggregate_store as ags
+
+logging.basicConfig(format='%(asctime)s %(module)s:%(lineno)d %(message)s', level=logging.INFO)
+
+# OHLCV candles of every market traded in the FillOrder partitions.
+#
+# Every match fills two orders and so has two fill_order operations, one paying each asset of the
+# market. A market's candles use the pair with the lower asset code first (the base asset) and
+# only the fill that pays the base asset, so every trade is counted once:
+#   price          base amount paid / quote amount received, in base units like the other rates
+#   base_volume    sum of the base amounts, quote_volume sum of the quote amounts (base units)
+#   vwap           base_volume/quote_volume
+#   open, close    price of the first and last trade (by minute, then operation id), high and low
+# A day's trades are turned into one minute candles in one vectorized pass, the longer intervals
+# are rolled up from those. Candles are only written for intervals with trades, to
+#   aggregates/candles/<interval>/<yyyymm>.parquet
+# and a manifest of the FillOrder file fingerprints lets a run only do new or changed days.
+
+fill_order_key = 4
+candle_intervals = {'1m': 1, '5m': 5, '15m': 15, '1h': 60, '4h': 240, '1d': 24*60}   # interval : minutes, each divides a day
+minutes_per_day = 24*60
+
+candle_schema = pa.schema([('date', pa.timestamp('ms')), ('market', pa.int64()),
+                           ('open', pa.float64()), ('high', pa.float64()), ('low', pa.float64()),
+                           ('close', pa.float64()), ('vwap', pa.float64()),
+                           ('base_volume', pa.int64()), ('quote_volume', pa.int64()), ('trades', pa.int64())])
+
+def get_candles_path(interval, month):
+    return dmu.get_aggregate_candles_dir(interval) + '/' + month + '.parquet'
+
+def get_manifest_path():
+    return dmu.rootdir + '/aggregates/candles/manifest.json'
+
+# the trades of a day, one row per match: market code, minute of the day, base and quote amounts
+# ordered by market, minute and operation id
+def read_trades(day_path, current_date):
+    fills = ps.read_operations(day_path, fill_order_key, ['operation_id', 'block_time', 'pays.asset_id', 'pays.amount',
+                                                          'receives.asset_id', 'receives.amount'])
+    pays_assets = fills['pays.asset_id'].to_numpy(dtype=np.int64)
+    receives_assets = fills['receives.asset_id'].to_numpy(dtype=np.int64)
+    minutes = ((fills['block_time'] - current_date) // timedelta(minutes=1)).to_numpy()
+    is_trade = (pays_assets < receives_assets) & (fills['receives.amount'].to_numpy() != 0) & \
+        (minutes >= 0) & (minutes < minutes_per_day)
+    trades = pd.DataFrame({'market': oid.encode_markets(pays_assets[is_trade], receives_assets[is_trade]),
+                           'minute': minutes[is_trade],
+                           'operation_id': fills['operation_id'].to_numpy()[is_trade],
+                           'base_amount': fills['pays.amount'].to_numpy(dtype=np.int64)[is_trade],
+                           'quote_amount': fills['receives.amount'].to_numpy(dtype=np.int64)[is_trade]})
+    return trades.sort_values(['market', 'minute', 'operation_id'], ignore_index=True)
+
+# the start of each run of equal (market, bucket) pairs in arrays sorted by market and bucket
+def get_group_starts(markets, buckets):
+    if len(markets) == 0:
+        return np.empty(0, dtype=np.int64)
+    is_start = np.ones(len(markets), dtype=bool)
+    is_start[1:] = (markets[1:] != markets[:-1]) | (buckets[1:] != buckets[:-1])
+    return np.flatnonzero(is_start)
+
+# the one minute candles of a day's trades as a dict of arrays, ordered by market and minute
+def make_minute_candles(trades):
+    markets = trades['market'].to_numpy()
+    minutes = trades['minute'].to_numpy()
+    base_amounts = trades['base_amount'].to_numpy()
+    quote_amounts = trades['quote_amount'].to_numpy()
+    prices = base_amounts/quote_amounts
+    starts = get_group_starts(markets, minutes)
+    ends = np.append(starts[1:], len(markets)) - 1
+    if len(starts) == 0:
+        empty_values = np.empty(0, dtype=np.float64)
+        return {'market': np.empty(0, dtype=np.int64), 'bucket': np.empty(0, dtype=np.int64),
+                'open': empty_values, 'high': empty_values, 'low': empty_values, 'close': empty_values,
+                'base_volume': np.empty(0, dtype=np.int64), 'quote_volume': np.empty(0, dtype=np.int64),
+                'trades': np.empty(0, dtype=np.int64)}
+    return {'market': markets[starts], 'bucket': minutes[starts],
+            'open': prices[starts], 'high': np.maximum.reduceat(prices, starts),
+            'low': np.minimum.reduceat(prices, starts), 'close': prices[ends],
+            'base_volume': np.add.reduceat(base_amounts, starts), 'quote_volume': np.add.reduceat(quote_amounts, starts),
+            'trades': np.diff(np.append(starts, len(markets)))}
+
+# merge the minute candles into candles of interval_minutes, they stay ordered by market and bucket
+def roll_up_candles(minute_candles, interval_minutes):
+    buckets = minute_candles['bucket'] // interval_minutes
+    starts = get_group_starts(minute_candles['market'], buckets)
+    if len(starts) == 0:
+        return dict(minute_candles, bucket=buckets)
+    ends = np.append(starts[1:], len(buckets)) - 1
+    return {'market': minute_candles['market'][starts], 'bucket': buckets[starts],
+            'open': minute_candles['open'][starts], 'high': np.maximum.reduceat(minute_candles['high'], starts),
+            'low': np.minimum.reduceat(minute_candles['low'], starts), 'close': minute_candles['close'][ends],
+            'base_volume': np.add.reduceat(minute_candles['base_volume'], starts),
+            'quote_volume': np.add.reduceat(minute_candles['quote_volume'], starts),
+            'trades': np.add.reduceat(minute_candles['trades'], starts)}
+
+# the candles of interval_minutes as a table of candle_schema
+def make_candle_table(candles, current_date, interval_minutes):
+    dates = pd.Timestamp(current_date) + pd.to_timedelta(candles['bucket']*interval_minutes, unit='min')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vwaps = candles['base_volume']/candles['quote_volume']
+    values = dict(candles, date=dates, vwap=vwaps)
+    return pa.Table.from_pydict({field.name: pa.array(np.asarray(values[field.name]), field.type)
+                                 for field in candle_schema}, schema=candle_schema)
+
+# the candle table of every interval of candle_intervals for a day
+def make_day_candles(day_path, current_date):
+    minute_candles = make_minute_candles(read_trades(day_path, current_date))
+    return {interval: make_candle_table(roll_up_candles(minute_candles, interval_minutes), current_date, interval_minutes)
+            for interval, interval_minutes in candle_intervals.items()}
+
+def read_candle_manifest():
+    if not isfile(get_manifest_path()):
+        return {'intervals': candle_intervals, 'days': {}}
+    with open(get_manifest_path(), 'rt') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest['intervals'] != candle_intervals:
+        return {'intervals': candle_intervals, 'days': {}}
+    return manifest
+
+def write_candle_manifest(manifest):
+    with open(get_manifest_path() + '.tmp', 'wt') as manifest_file:
+        json.dump(manifest, manifest_file)
+    replace(get_manifest_path() + '.tmp', get_manifest_path())
+
+# the fingerprint of a day's FillOrder files
+def get_fill_fingerprint(day_path):
+    fill_file_name = 'operation-{:02d}.'.format(fill_order_key)
+    return {file_name: file_stat for file_name, file_stat in am.get_day_fingerprint(day_path).items()
+            if file_name.startswith(fill_file_name)}
+
+# make the candles of the loaded days from first_day on whose FillOrder files are new or changed
+# since the last run, the month files of those days are written again with the days replaced
+def make_candles(first_day, days_to_model):
+    manifest = read_candle_manifest()
+    writers = {interval: ags.CubeWriter(interval, candle_schema, get_candles_path) for interval in candle_intervals}
+    day_cnt = 0
+    for current_date in [first_day + timedelta(days=x) for x in range(0, days_to_model)]:
+        day_dir, day_path = dmu.get_daydir_daypath(current_date)
+        # stop at the first day the loader has not finished, its directory exists while it is still loading
+        if not ingest_manifest.is_day_complete(day_dir):
+            break
+        fingerprint = get_fill_fingerprint(day_path)
+        if manifest['days'].get(day_dir) == fingerprint:
+            continue
+        logging.info('Making candles for {}'.format(current_date))
+        for interval, candle_table in make_day_candles(day_path, current_date).items():
+            writers[interval].add_day(day_dir, candle_table)
+        manifest['days'][day_dir] = fingerprint
+        day_cnt += 1
+    for writer in writers.values():
+        writer.close()
+    write_candle_manifest(manifest)
+    logging.info('Made candles for {} days'.format(day_cnt))
+    return day_cnt
+
+# the candles of interval from start up to (not including) end, optionally only of markets
+# (given as 'asset id/asset id' in either order), with the market names decoded, lower asset id first
+def load_candles(interval, start=None, end=None, markets=None):
+    candles_dir = dmu.get_aggregate_candles_dir(interval)
+    month_frames = [pq.read_table(candles_dir + '/' + month + '.parquet').to_pandas()
+                    for month in ags.get_range_months(ags.get_months(candles_dir), start, end)]
+    if not month_frames:
+        return pd.DataFrame(columns=candle_schema.names)
+    candles = pd.concat(month_frames, ignore_index=True)
+    if start is not None:
+        candles = candles[candles['date'] >= start]
+    if end is not None:
+        candles = candles[candles['date'] < end]
+    if markets is not None:
+        candles = candles[candles['market'].isin([oid.encode_canonical_market(market) for market in markets])]
+    return candles.assign(market=oid.decode_markets(candles['market'].to_numpy())).reset_index(drop=True)
+
+if __name__ == "__main__":
+    first_day     = datetime(2016, 1, 1)   # first day to make candles for
+    days_to_model = 940                    # days from first_day on, stops at the first day without data
+    make_candles(first_day, days_to_model)
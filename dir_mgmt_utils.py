@@ -1,4 +1,5 @@
 from os import mkdir
+from os import makedirs
 from os.path import isdir
 from  datetime import datetime
 import logging
@@ -8,21 +9,45 @@ rootdir='/Volumes/Samsung_T5/BitShares/ParsedData'
 # used to specify which aggregate to work on
 class Granularity:
     DAILY='daily'
+    FOUR_HOURLY='fourhourly'
     HOURLY='hourly'
+    FIVE_MINUTE='fiveminute'
     MINUTE='minute'
 
+    # minutes in one unit of each granularity, the aggregator builds every granularity
+    # from the minute aggregates, so a granularity only needs an entry here to be aggregated
+    unit_minutes = {
+        DAILY: 24*60,
+        FOUR_HOURLY: 4*60,
+        HOURLY: 60,
+        FIVE_MINUTE: 5,
+        MINUTE: 1
+    }
+
     def __init__(self, granularity):
         self.units_per_day = 1
         self.window_days = 90
         self.min_lag_days = 7
         self.granularity = Granularity.DAILY
         self.freq = 'D'
-        if granularity is Granularity.HOURLY:
+        if granularity is Granularity.FOUR_HOURLY:
+            self.units_per_day = 6
+            self.window_days = 60
+            self.min_lag_days = 7
+            self.granularity = Granularity.FOUR_HOURLY
+            self.freq = '4H'
+        elif granularity is Granularity.HOURLY:
             self.units_per_day = 24
             self.window_days = 30
             self.min_lag_days = 7
             self.granularity = Granularity.HOURLY
             self.freq = 'H'
+        elif granularity is Granularity.FIVE_MINUTE:
+            self.units_per_day = 24*12
+            self.window_days = 7
+            self.min_lag_days = 7
+            self.granularity = Granularity.FIVE_MINUTE
+            self.freq = '5T'
         elif granularity is Granularity.MINUTE:
             self.units_per_day = 24*60
             self.window_days = 7
@@ -37,6 +62,24 @@ def get_daydir_daypath(current_day):
     day_path = rootdir + '/' + day_dir
     return day_dir, day_path
 
+# get the path of one operation type's file within a day directory, partition_format is the file extension
+def get_operation_path(day_path, op_key, partition_format='csv'):
+    return day_path + '/operation-' + '{:02d}'.format(op_key) + '.' + partition_format
+
+# directory holding one ingest manifest entry per loaded day
+def get_ingest_manifest_dir():
+    manifest_dir = rootdir + '/manifest'
+    if not isdir(manifest_dir):
+        makedirs(manifest_dir, exist_ok=True)
+    return manifest_dir
+
+# directory holding the raw cache of scanned documents, one compressed file per day
+def get_raw_cache_dir():
+    raw_dir = rootdir + '/raw'
+    if not isdir(raw_dir):
+        makedirs(raw_dir, exist_ok=True)
+    return raw_dir
+
 def create_aggregate_path(aggregate_type, markets):
     agg_dir = rootdir + '/aggregates'
     if not isdir(agg_dir):
@@ -48,6 +91,41 @@ def create_aggregate_path(aggregate_type, markets):
 
     return agg_file_path
 
+# directory of the aggregate cube of a granularity, one file of every market's aggregates per month
+def get_aggregate_cube_dir(granularity):
+    cube_dir = rootdir + '/aggregates/cube/' + granularity
+    if not isdir(cube_dir):
+        makedirs(cube_dir, exist_ok=True)
+    return cube_dir
+
+# directory of the long market aggregates of a granularity, one file of every market found per month
+def get_aggregate_markets_dir(granularity):
+    markets_dir = rootdir + '/aggregates/markets/' + granularity
+    if not isdir(markets_dir):
+        makedirs(markets_dir, exist_ok=True)
+    return markets_dir
+
+# directory of the FillOrder candles of an interval, one file per month
+def get_aggregate_candles_dir(interval):
+    candles_dir = rootdir + '/aggregates/candles/' + interval
+    if not isdir(candles_dir):
+        makedirs(candles_dir, exist_ok=True)
+    return candles_dir
+
+# directory of the order book snapshots, one file per month, and the replay checkpoint
+def get_aggregate_book_dir():
+    book_dir = rootdir + '/aggregates/book'
+    if not isdir(book_dir):
+        makedirs(book_dir, exist_ok=True)
+    return book_dir
+
+# directory of one of the indexes built from the day partitions
+def get_index_dir(index_name):
+    index_dir = rootdir + '/index/' + index_name
+    if not isdir(index_dir):
+        makedirs(index_dir, exist_ok=True)
+    return index_dir
+
 def get_result_dir():
     return rootdir + '/results/'
 
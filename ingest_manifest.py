@@ -0,0 +1,55 @@
+import json
+from os import listdir
+from os import replace
+from os.path import isfile
+
+import dir_mgmt_utils as dmu
+
+# The ingest manifest records, for every day the loader has touched, whether the day is
+# complete, how many documents it held, the largest operation_id_num seen, the markets the
+# day was filtered to (None for all operations), the format its files are stored in
+# (entries without one are CSV) and, while a day is still being loaded,
+# the last checkpoint. Each day gets its own small JSON file so the
+# loader's worker processes never write to the same file.
+
+def get_entry_path(day_dir):
+    return dmu.get_ingest_manifest_dir() + '/' + day_dir + '.json'
+
+def new_day_entry(day_dir):
+    return {
+        'day': day_dir,
+        'complete': False,
+        'doc_count': 0,
+        'max_operation_id': None,
+        'op_counts': {},
+        'markets': None,
+        'format': None,
+        'checkpoint': None
+    }
+
+# read the manifest entry for a day, or a fresh entry when the day has never been loaded
+def read_day_entry(day_dir):
+    entry_path = get_entry_path(day_dir)
+    if not isfile(entry_path):
+        return new_day_entry(day_dir)
+    with open(entry_path, 'rt') as entry_file:
+        return json.load(entry_file)
+
+# write the entry to a temporary file first so a crash never leaves a half written entry
+def write_day_entry(entry):
+    entry_path = get_entry_path(entry['day'])
+    with open(entry_path + '.tmp', 'wt') as entry_file:
+        json.dump(entry, entry_file)
+    replace(entry_path + '.tmp', entry_path)
+
+def is_day_complete(day_dir):
+    return read_day_entry(day_dir)['complete']
+
+# dictionary of day directory : entry for every day in the manifest
+def read_manifest():
+    manifest = {}
+    for file_name in sorted(listdir(dmu.get_ingest_manifest_dir())):
+        if file_name.endswith('.json'):
+            entry = read_day_entry(file_name[:-len('.json')])
+            manifest[entry['day']] = entry
+    return manifest
@@ -0,0 +1,264 @@
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+from os import listdir
+from os import makedirs
+from os import remove
+from os import replace
+from os.path import isdir
+from os.path import isfile
+import numpy as np
+import pandas as pd
+
+import dir_mgmt_utils as dmu
+import ingest_manifest
+import partition_store as ps
+import object_ids as oid
+import aggregate_manifest as am
+
+# The lifecycle index maps every limit order (a 1.7 object) to its create, fill and cancel
+# events across the day partitions. Limit order ids are handed out in order, so the events of an
+# order are kept in the shard of its instance number, which mostly holds orders of a few days:
+#   index/lifecycle/<shard>/<yyyymmdd>.npz    the events of a day's orders of the shard, an
+#                                             event_dtype array sorted by order and time
+#   index/lifecycle/days/<yyyymmdd>.json      the shards a day wrote and the fingerprint of the
+#                                             files it was indexed from
+# A day is indexed on its own, shard parts first and the day entry last, each through a
+# temporary file, so the loader's worker processes index their days as they finish them and
+# index_days only does the days that are new or changed since.
+#
+# Event amounts are in base units of the asset the order sells: amount_to_sell.amount for the
+# create and pays.amount for a fill. The partitions store the market of a create as
+# min_to_receive/amount_to_sell and that of a fill as fill_base/fill_quote, so the events of one
+# order could carry either orientation. Every event's market is encoded from its two asset ids
+# (amount_to_sell/min_to_receive, pays/receives) with the lower asset code first instead.
+
+limit_order_create_key = 1
+limit_order_cancel_key = 2
+fill_order_key = 4
+limit_order_type = 7   # object type of limit orders, fills of call orders (1.8) are not indexed
+shard_bits = 20   # limit order instances per shard, as a power of 2
+index_version = 2   # days indexed by an older version are indexed again
+
+create_event = 0
+fill_event = 1
+cancel_event = 2
+event_names = np.array(['create', 'fill', 'cancel'], dtype=object)
+
+event_dtype = np.dtype([('limit_code', np.int64), ('time', 'datetime64[ms]'), ('operation_id', np.int64),
+                        ('event', np.int8), ('market', np.int64), ('amount', np.int64)])
+
+def get_shard_dir(shard):
+    shard_dir = dmu.get_index_dir('lifecycle') + '/{:06d}'.format(shard)
+    if not isdir(shard_dir):
+        makedirs(shard_dir, exist_ok=True)
+    return shard_dir
+
+def get_part_path(shard, day_dir):
+    return get_shard_dir(shard) + '/' + day_dir + '.npz'
+
+def get_entry_path(day_dir):
+    entry_dir = dmu.get_index_dir('lifecycle') + '/days'
+    if not isdir(entry_dir):
+        makedirs(entry_dir, exist_ok=True)
+    return entry_dir + '/' + day_dir + '.json'
+
+# the index entry of a day, None when the day was never indexed
+def read_day_entry(day_dir):
+    entry_path = get_entry_path(day_dir)
+    if not isfile(entry_path):
+        return None
+    with open(entry_path, 'rt') as entry_file:
+        return json.load(entry_file)
+
+def write_day_entry(entry):
+    entry_path = get_entry_path(entry['day'])
+    with open(entry_path + '.tmp', 'wt') as entry_file:
+        json.dump(entry, entry_file)
+    replace(entry_path + '.tmp', entry_path)
+
+# the fingerprint of a day's limit order files
+def get_order_fingerprint(day_path):
+    file_names = tuple('operation-{:02d}.'.format(op_key)
+                       for op_key in [limit_order_create_key, limit_order_cancel_key, fill_order_key])
+    return {file_name: file_stat for file_name, file_stat in am.get_day_fingerprint(day_path).items()
+            if file_name.startswith(file_names)}
+
+def get_shards(limit_codes):
+    return (limit_codes & oid.instance_mask) >> shard_bits
+
+# the limit order events of a day as an event_dtype array sorted by order and time
+def read_day_events(day_path):
+    create_asset_cols = ['amount_to_sell.asset_id', 'min_to_receive.asset_id']
+    fill_asset_cols = ['pays.asset_id', 'receives.asset_id']
+    creates = ps.read_operations(day_path, limit_order_create_key, ['operation_id', 'block_time', 'limit_id',
+                                                                    'amount_to_sell.amount'] + create_asset_cols)
+    fills = ps.read_operations(day_path, fill_order_key, ['operation_id', 'block_time', 'limit_id',
+                                                          'pays.amount'] + fill_asset_cols)
+    cancels = ps.read_operations(day_path, limit_order_cancel_key, ['operation_id', 'block_time', 'limit_id'])
+    parts = []
+    for operations, event, amount_col, asset_cols in [(creates, create_event, 'amount_to_sell.amount', create_asset_cols),
+                                                      (fills, fill_event, 'pays.amount', fill_asset_cols),
+                                                      (cancels, cancel_event, None, None)]:
+        part = np.zeros(len(operations), dtype=event_dtype)
+        part['limit_code'] = oid.parse_object_ids(operations['limit_id'].to_numpy())
+        part['time'] = operations['block_time'].to_numpy(dtype='datetime64[ms]')
+        part['operation_id'] = operations['operation_id'].to_numpy()
+        part['event'] = event
+        if amount_col is not None:
+            part['market'] = oid.encode_canonical_markets(operations[asset_cols[0]].to_numpy(dtype=np.int64),
+                                                          operations[asset_cols[1]].to_numpy(dtype=np.int64))
+            part['amount'] = operations[amount_col].to_numpy()
+        parts.append(part)
+    events = np.concatenate(parts)
+    events = events[((events['limit_code'] >> oid.instance_bits) & oid.type_mask) == limit_order_type]
+    return events[np.lexsort((events['operation_id'], events['time'], events['limit_code']))]
+
+# index a day unless its limit order files are unchanged since it was last indexed,
+# returns whether the day was indexed
+def index_day(day_dir, day_path):
+    fingerprint = get_order_fingerprint(day_path)
+    entry = read_day_entry(day_dir)
+    if entry is not None and entry['fingerprint'] == fingerprint and entry.get('version') == index_version:
+        return False
+    events = read_day_events(day_path)
+    shards = get_shards(events['limit_code'])
+    day_shards, shard_starts = np.unique(shards, return_index=True)
+    shard_ends = np.append(shard_starts[1:], len(events))
+    create_shards = np.unique(shards[events['event'] == create_event])
+    for shard, shard_start, shard_end in zip(day_shards.tolist(), shard_starts.tolist(), shard_ends.tolist()):
+        part_path = get_part_path(shard, day_dir)
+        with open(part_path + '.tmp', 'wb') as part_file:
+            np.savez(part_file, events=events[shard_start:shard_end])
+        replace(part_path + '.tmp', part_path)
+    # a day indexed again can have left shards it wrote to before
+    if entry is not None:
+        for shard in set(entry['shards']) - set(day_shards.tolist()):
+            if isfile(get_part_path(shard, day_dir)):
+                remove(get_part_path(shard, day_dir))
+    write_day_entry({'day': day_dir, 'version': index_version, 'fingerprint': fingerprint, 'shards': day_shards.tolist(),
+                     'create_shards': create_shards.tolist(), 'event_cnt': len(events)})
+    return True
+
+# index the loaded days from first_day on that are new or changed
+def index_days(first_day, days_to_model):
+    day_cnt = 0
+    for current_date in [first_day + timedelta(days=x) for x in range(0, days_to_model)]:
+        day_dir, day_path = dmu.get_daydir_daypath(current_date)
+        # stop at the first day the loader has not finished, its directory exists while it is still loading
+        if not ingest_manifest.is_day_complete(day_dir):
+            break
+        if index_day(day_dir, day_path):
+            logging.info('Indexed limit orders of {}'.format(day_dir))
+            day_cnt += 1
+    logging.info('Indexed limit orders of {} days'.format(day_cnt))
+    return day_cnt
+
+# every event of a shard sorted by order and time
+def read_shard(shard):
+    shard_dir = get_shard_dir(shard)
+    parts = []
+    for file_name in sorted(listdir(shard_dir)):
+        if file_name.endswith('.npz'):
+            with np.load(shard_dir + '/' + file_name) as part:
+                parts.append(part['events'])
+    if not parts:
+        return np.zeros(0, dtype=event_dtype)
+    events = np.concatenate(parts)
+    return events[np.lexsort((events['operation_id'], events['time'], events['limit_code']))]
+
+def events_to_frame(events):
+    return pd.DataFrame({'limit_id': oid.decode_object_ids(events['limit_code']),
+                         'time': events['time'].astype('datetime64[ns]'),
+                         'operation_id': events['operation_id'],
+                         'event': event_names[events['event']],
+                         'market': oid.decode_markets(events['market']),
+                         'amount': events['amount']})
+
+# the events of a limit order (e.g. '1.7.12345') in time order, only its shard is read
+def get_order_events(limit_id):
+    limit_code = oid.encode_object_id(limit_id)
+    events = read_shard(int(get_shards(np.int64(limit_code))))
+    start, end = np.searchsorted(events['limit_code'], [limit_code, limit_code + 1])
+    return events_to_frame(events[start:end])
+
+# one row per order created from start up to (not including) end with its market, creation time,
+# amount to sell and what became of it: the time of its first fill, the amount filled and the
+# time of its cancel (NaT when it had none)
+def get_lifecycles(start, end):
+    create_shards = set()
+    current_date = pd.Timestamp(start).normalize()
+    while current_date < end:
+        entry = read_day_entry(dmu.get_daydir_daypath(current_date)[0])
+        if entry is not None:
+            create_shards.update(entry['create_shards'])
+        current_date += timedelta(days=1)
+    lifecycles = [get_shard_lifecycles(read_shard(shard), start, end) for shard in sorted(create_shards)]
+    if not lifecycles:
+        return get_shard_lifecycles(np.zeros(0, dtype=event_dtype), start, end)
+    return pd.concat(lifecycles, ignore_index=True)
+
+# the time of the first event of each order among the events of is_event, NaT for orders without one
+def get_first_times(order_index, is_event, times, order_cnt):
+    first_times = np.full(order_cnt, np.iinfo(np.int64).max)
+    np.minimum.at(first_times, order_index[is_event], times[is_event])
+    first_times[first_times == np.iinfo(np.int64).max] = np.iinfo(np.int64).min   # NaT
+    return first_times.astype('datetime64[ms]').astype('datetime64[ns]')
+
+def get_shard_lifecycles(events, start, end):
+    is_create = (events['event'] == create_event) & (events['time'] >= np.datetime64(start, 'ms')) & \
+        (events['time'] < np.datetime64(end, 'ms'))
+    order_codes, order_index = np.unique(events['limit_code'], return_inverse=True)
+    is_fill = events['event'] == fill_event
+    times = events['time'].astype(np.int64)
+    filled_amounts = np.zeros(len(order_codes), dtype=np.int64)
+    np.add.at(filled_amounts, order_index[is_fill], events['amount'][is_fill])
+    first_fills = get_first_times(order_index, is_fill, times, len(order_codes))
+    cancels = get_first_times(order_index, events['event'] == cancel_event, times, len(order_codes))
+    creates = events[is_create]
+    created_orders = order_index[is_create]
+    return pd.DataFrame({'limit_code': creates['limit_code'],
+                         'market': creates['market'],
+                         'created': creates['time'].astype('datetime64[ns]'),
+                         'amount': creates['amount'],
+                         'first_fill': first_fills[created_orders],
+                         'filled_amount': filled_amounts[created_orders],
+                         'cancelled': cancels[created_orders]})
+
+# lifecycle statistics of the orders created from start up to end per market and bucket of freq
+# (a pandas frequency such as '1h'), by creation time:
+#   orders                        orders created
+#   filled_orders                 orders with at least one fill
+#   time_to_first_fill_median     seconds from creation to the first fill, of the filled orders
+#   time_to_first_fill_mean
+#   fraction_filled_mean          amount filled/amount to sell, of all orders
+#   cancelled_orders              orders cancelled
+#   cancel_after_median           seconds from creation to the cancel, of the cancelled orders
+#   cancel_after_mean
+# markets limits the statistics to those markets (given as 'asset id/asset id' in either order)
+def lifecycle_stats(start, end, freq='1h', markets=None):
+    lifecycles = get_lifecycles(start, end)
+    if markets is not None:
+        lifecycles = lifecycles[lifecycles['market'].isin([oid.encode_canonical_market(market) for market in markets])]
+    lifecycles = lifecycles.assign(
+        bucket=lifecycles['created'].dt.floor(freq),
+        time_to_first_fill=(lifecycles['first_fill'] - lifecycles['created']).dt.total_seconds(),
+        fraction_filled=np.minimum(lifecycles['filled_amount']/lifecycles['amount'], 1.0),
+        cancel_after=(lifecycles['cancelled'] - lifecycles['created']).dt.total_seconds())
+    stats = lifecycles.groupby(['market', 'bucket']).agg(
+        orders=('limit_code', 'size'),
+        filled_orders=('time_to_first_fill', 'count'),
+        time_to_first_fill_median=('time_to_first_fill', 'median'),
+        time_to_first_fill_mean=('time_to_first_fill', 'mean'),
+        fraction_filled_mean=('fraction_filled', 'mean'),
+        cancelled_orders=('cancel_after', 'count'),
+        cancel_after_median=('cancel_after', 'median'),
+        cancel_after_mean=('cancel_after', 'mean')).reset_index()
+    return stats.assign(market=oid.decode_markets(stats['market'].to_numpy()))
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s %(module)s:%(lineno)d %(message)s', level=logging.INFO)
+    first_day     = datetime(2016, 1, 1)   # first day to index
+    days_to_model = 940                    # days from first_day on, stops at the first day without data
+    index_days(first_day, days_to_model)
@@ -0,0 +1,77 @@
+import functools
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# BitShares object ids such as 1.3.121 (an asset) or 1.2.12345 (an account) are stored as int64
+# codes instead of strings. The space goes in the top 8 bits, the type in the next 8 and the
+# instance in the low 48, so the code of an id never depends on which ids were seen before:
+# every loader process and every day assign the same code to the same id without sharing a table.
+#
+# A market, a base/quote pair of assets, is coded as the two asset instance numbers side by side.
+
+instance_bits = 48
+type_bits = 8
+instance_mask = (1 << instance_bits) - 1
+type_mask = (1 << type_bits) - 1
+market_bits = 32
+market_mask = (1 << market_bits) - 1
+
+# the code of an object id string, ids repeat a lot so the codes are cached
+@functools.lru_cache(maxsize=1 << 20)
+def encode_object_id(object_id):
+    space, object_type, instance = object_id.split('.')
+    return (int(space) << (type_bits + instance_bits)) | (int(object_type) << instance_bits) | int(instance)
+
+def decode_object_id(code):
+    code = int(code)
+    return '{}.{}.{}'.format(code >> (type_bits + instance_bits),
+                             (code >> instance_bits) & type_mask,
+                             code & instance_mask)
+
+def encode_object_ids(object_ids):
+    return np.array([encode_object_id(object_id) for object_id in object_ids], dtype=np.int64)
+
+# codes of object id strings that rarely repeat, such as limit order ids, parsed in one vectorized
+# pass instead of through the cache of encode_object_id
+def parse_object_ids(object_ids):
+    parts = pc.list_flatten(pc.split_pattern(pa.array(object_ids, pa.string()), '.'))
+    parts = parts.cast(pa.int64()).to_numpy().reshape(-1, 3)
+    return (parts[:, 0] << (type_bits + instance_bits)) | (parts[:, 1] << instance_bits) | parts[:, 2]
+
+# object id strings of an array of codes, each distinct code is only decoded once
+def decode_object_ids(codes):
+    distinct_codes, code_index = np.unique(np.asarray(codes, dtype=np.int64), return_inverse=True)
+    object_ids = np.array([decode_object_id(code) for code in distinct_codes], dtype=object)
+    return object_ids[code_index.reshape(-1)]
+
+# market codes of arrays (or single values) of base and quote asset codes
+def encode_markets(base_codes, quote_codes):
+    return ((np.asarray(base_codes, dtype=np.int64) & market_mask) << market_bits) | \
+        (np.asarray(quote_codes, dtype=np.int64) & market_mask)
+
+# the code of a market given as 'base asset id/quote asset id'
+def encode_market(market):
+    base_asset_id, quote_asset_id = market.split('/')
+    return int(encode_markets(encode_object_id(base_asset_id), encode_object_id(quote_asset_id)))
+
+# market codes of arrays (or single values) of the two asset codes of a market in either order,
+# the lower asset code is taken as the base so both orientations of a market get the same code
+def encode_canonical_markets(asset_codes, other_asset_codes):
+    asset_codes = np.asarray(asset_codes, dtype=np.int64)
+    other_asset_codes = np.asarray(other_asset_codes, dtype=np.int64)
+    return encode_markets(np.minimum(asset_codes, other_asset_codes), np.maximum(asset_codes, other_asset_codes))
+
+# the canonical code of a market given as 'asset id/asset id' in either order
+def encode_canonical_market(market):
+    asset_id, other_asset_id = market.split('/')
+    return int(encode_canonical_markets(encode_object_id(asset_id), encode_object_id(other_asset_id)))
+
+def decode_market(code):
+    code = int(code)
+    return '1.3.{}/1.3.{}'.format(code >> market_bits, code & market_mask)
+
+def decode_markets(codes):
+    distinct_codes, code_index = np.unique(np.asarray(codes, dtype=np.int64), return_inverse=True)
+    markets = np.array([decode_market(code) for code in distinct_codes], dtype=object)
+    return markets[code_index.reshape(-1)]
@@ -1,11 +1,16 @@
 from datetime import datetime
 import pandas as pd
+import numpy as np
 import logging
 import math
 import traceback
+import re
 
 from asset import Amount
 from asset import Feed
+import asset
+import object_ids as oid
+import quantile_sketch as qs
 # import bitsharesbase.operationids
 
 # operation id : operation name dictionary for printing out readable data
@@ -64,6 +69,271 @@ operation_names = {
     52: 'custom_authority_delete_operation'
 }
 
+# path to the operation's details in a decoded _source
+op_path = ('operation_history', 'op', 1)
+
+# timestamps in the documents look like 2016-01-01T00:00:05, fromisoformat reads them
+# the same way strptime(..., '%Y-%m-%dT%H:%M:%S') does at a fraction of the cost
+def parse_timestamp(iso_string):
+    return datetime.fromisoformat(iso_string)
+
+# follow path into every item of a list of decoded documents
+def gather_values(items, path):
+    if len(path) == 1:
+        k0, = path
+        return [item[k0] for item in items]
+    if len(path) == 2:
+        k0, k1 = path
+        return [item[k0][k1] for item in items]
+    if len(path) == 3:
+        k0, k1, k2 = path
+        return [item[k0][k1][k2] for item in items]
+    values = []
+    for item in items:
+        for key in path:
+            item = item[key]
+        values.append(item)
+    return values
+
+# convert an array of ISO timestamp strings to datetime64 seconds in one vectorized pass
+def to_datetime64(iso_strings):
+    return np.asarray(iso_strings).astype('datetime64[s]')
+
+# seconds since the epoch for an array of datetime64 values
+def to_epoch_seconds(datetimes):
+    return datetimes.astype('datetime64[s]').astype(np.int64)
+
+# Mergeable statistics of an operation type's operations grouped on (aggregation key, time bucket).
+# operations has a bucket column holding the position (0 to bucket_cnt-1) of the time bucket each
+# operation falls in and is sorted by block_time, so the rows of every group are in time order.
+#
+# Every group keeps partial states that can be merged without going back to the operations:
+#   count                  the number of operations
+#   sums                   exact sums of integer columns
+#   moments of a column    count, mean and M2 (sum of squared deviations from the mean, merged
+#                          with Chan's method, which stays accurate where a plain sum of squares
+#                          would not), min, max, first and last of the values that are not NaN,
+#                          and the values themselves in time order for the exact median and last 10%
+# rollup merges the groups of consecutive buckets, so minute partials give the hours and days.
+#
+# With quantile_sketch_error set the values are replaced by a KLL sketch of them (see quantile_sketch)
+# and a sketch of the last 10% of them, so the medians merge in bounded memory. Only the median keeps
+# the rank error bound through rollups: the last 10% of a rolled up bucket is approximated from the
+# values of its trailing partials that lie inside it, and its median is not bounded by the error.
+quantile_sketch_error = None   # rank error of the median sketches, None keeps the exact values
+class BucketAggregation():
+    def __init__(self, operations, key_cols, bucket_cnt):
+        self.key_cols = key_cols
+        self.group_cols = key_cols + ['bucket']
+        self.bucket_cnt = bucket_cnt
+        self.sketch_k = None if quantile_sketch_error is None else qs.error_to_k(quantile_sketch_error)
+        self.sum_names = []
+        self.moment_names = []
+        self.finished_names = []
+        self.stats = None
+        self._key_stats = None
+        self._grouped = None
+        if operations is not None:
+            self._grouped = operations.groupby(self.group_cols, sort=False)
+            self.stats = self._grouped.size().to_frame('count')
+            self._group_ids = self._grouped.ngroup().to_numpy()
+
+    # keep the exact sum of col as name
+    def add_sum(self, name, col):
+        self.stats[name] = self._grouped[col].sum()
+        self.sum_names.append(name)
+
+    # keep the moments of col and its values as name
+    def add_moments(self, name, col):
+        values = self._grouped[col]
+        counts = values.count()
+        self.stats[name + '_count'] = counts
+        self.stats[name + '_mean'] = values.mean()
+        self.stats[name + '_m2'] = (values.var(ddof=0)*counts).fillna(0)
+        self.stats[name + '_min'] = values.min()
+        self.stats[name + '_max'] = values.max()
+        self.stats[name + '_first'] = values.first()
+        self.stats[name + '_last'] = values.last()
+        all_values = split_groups(self._group_ids, self._grouped.obj[col].to_numpy(), len(self.stats.index))
+        if self.sketch_k is None:
+            self.stats[name + '_values'] = all_values
+        else:
+            self.stats[name + '_sketch'] = [qs.KllSketch.from_values(self.sketch_k, values) for values in all_values]
+            self.stats[name + '_tail'] = [qs.KllSketch.from_values(self.sketch_k, last_tenth(values))
+                                          for values in all_values]
+        self.moment_names.append(name)
+
+    # merge every factor consecutive buckets into one, returns the merged BucketAggregation
+    def rollup(self, factor):
+        merged = BucketAggregation(None, self.key_cols, -(-self.bucket_cnt // factor))
+        merged.sketch_k = self.sketch_k
+        merged.sum_names = list(self.sum_names)
+        merged.moment_names = list(self.moment_names)
+        partials = self.stats.sort_index().reset_index()
+        partials['bucket'] = partials['bucket'] // factor
+        grouped = partials.groupby(self.group_cols, sort=False)
+        group_ids = grouped.ngroup().to_numpy()
+        merged.stats = grouped[['count'] + self.sum_names].sum()
+
+        for name in self.moment_names:
+            counts = partials[name + '_count'].to_numpy()
+            means = partials[name + '_mean'].to_numpy()
+            has_values = counts > 0
+            merged_counts = np.bincount(group_ids, weights=counts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                merged_means = np.bincount(group_ids, weights=np.where(has_values, counts*means, 0))/merged_counts
+                deviations = np.where(has_values, counts*(means - merged_means[group_ids])**2, 0)
+            merged.stats[name + '_count'] = merged_counts.astype(np.int64)
+            merged.stats[name + '_mean'] = merged_means
+            merged.stats[name + '_m2'] = np.bincount(group_ids, weights=partials[name + '_m2'].to_numpy() + deviations)
+            merged.stats[name + '_min'] = grouped[name + '_min'].min()
+            merged.stats[name + '_max'] = grouped[name + '_max'].max()
+            merged.stats[name + '_first'] = grouped[name + '_first'].first()
+            merged.stats[name + '_last'] = grouped[name + '_last'].last()
+            if self.sketch_k is None:
+                merged.stats[name + '_values'] = concatenate_groups(group_ids, partials[name + '_values'].to_numpy(),
+                                                                    len(merged.stats.index))
+            else:
+                merged.stats[name + '_sketch'], merged.stats[name + '_tail'] = merge_sketch_groups(
+                    group_ids, partials['count'].to_numpy(), partials[name + '_sketch'].to_numpy(),
+                    partials[name + '_tail'].to_numpy(), len(merged.stats.index))
+        return merged
+
+    # add the median, standard deviation and median of the last 10% of the values of moments name
+    # as name_median, name_std and name_last10pct, the last 10% counts operations whose value is NaN
+    def finish_moments(self, name):
+        if name in self.finished_names:
+            return
+        self.finished_names.append(name)
+        counts = self.stats[name + '_count'].to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.stats[name + '_std'] = np.where(counts > 1, np.sqrt(self.stats[name + '_m2'].to_numpy()/(counts - 1)), np.nan)
+        if self.sketch_k is None:
+            all_values = self.stats[name + '_values'].to_numpy()
+            self.stats[name + '_median'] = [nan_median(values) for values in all_values]
+            self.stats[name + '_last10pct'] = [nan_median(last_tenth(values)) for values in all_values]
+        else:
+            self.stats[name + '_median'] = [sketch.median() for sketch in self.stats[name + '_sketch']]
+            self.stats[name + '_last10pct'] = [sketch.median() for sketch in self.stats[name + '_tail']]
+        self._key_stats = None
+
+    # the sketches of the moments as flat arrays to store with np.savez, keyed by name + '_' + array name.
+    # the key column and bucket arrays give the group of each sketch
+    def sketch_arrays(self):
+        groups = self.stats.index.to_frame(index=False)
+        arrays = {col: groups[col].to_numpy() for col in self.group_cols}
+        arrays['k'] = np.array(self.sketch_k)
+        for name in self.moment_names:
+            for state in ['sketch', 'tail']:
+                for array_name, array in qs.pack_sketches(self.stats[name + '_' + state].to_numpy()).items():
+                    arrays['{}_{}_{}'.format(name, state, array_name)] = array
+        return arrays
+
+    # the sketches stored by sketch_arrays as a DataFrame indexed by the key columns and bucket,
+    # with a name_sketch and name_tail column of KllSketch objects per moment
+    @staticmethod
+    def sketch_stats(arrays):
+        names = [array_name[:-len('_sketch_counts')] for array_name in arrays if array_name.endswith('_sketch_counts')]
+        state_prefixes = tuple('{}_{}_'.format(name, state) for name in names for state in ['sketch', 'tail'])
+        group_cols = [array_name for array_name in arrays if array_name != 'k' and not array_name.startswith(state_prefixes)]
+        stats = pd.DataFrame({col: arrays[col] for col in group_cols})
+        for name in names:
+            for state in ['sketch', 'tail']:
+                stats[name + '_' + state] = qs.unpack_sketches(int(arrays['k']), *[
+                    arrays['{}_{}_{}'.format(name, state, array_name)]
+                    for array_name in ['counts', 'level_counts', 'level_sizes', 'values']])
+        return stats.set_index(group_cols)
+
+    # one value of the statistic name per bucket for the key (a tuple of the key column values),
+    # buckets without operations for the key get empty_value
+    def bucket_values(self, key, name, empty_value):
+        values = np.full(self.bucket_cnt, empty_value, dtype=object)
+        key_stats = self._get_key_stats().get(key)
+        if key_stats is not None:
+            values[key_stats.index.get_level_values('bucket').to_numpy()] = key_stats[name].to_numpy()
+        return values
+
+    def _get_key_stats(self):
+        if self._key_stats is None:
+            if not self.key_cols:
+                self._key_stats = {(): self.stats}
+            else:
+                key_levels = list(range(len(self.key_cols)))
+                self._key_stats = {key: key_stats for key, key_stats in self.stats.groupby(level=key_levels)}
+        return self._key_stats
+
+# the median of the values that are not NaN, NaN when there are none
+def nan_median(values):
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.nan
+    return np.median(values)
+
+# the last 10% of an array of values, at least one of them
+def last_tenth(values):
+    return values[len(values) - math.ceil(len(values)*0.10):]
+
+# the values of each group as an array per group (in the order of the values), group_ids numbers the groups 0 to group_cnt-1
+def split_groups(group_ids, values, group_cnt):
+    order = np.argsort(group_ids, kind='stable')
+    group_values = np.empty(group_cnt, dtype=object)
+    for group_id, values in enumerate(np.split(values[order], np.cumsum(np.bincount(group_ids, minlength=group_cnt))[:-1])):
+        group_values[group_id] = values
+    return group_values
+
+# the arrays of each group concatenated into one array per group, in the order of the arrays
+def concatenate_groups(group_ids, arrays, group_cnt):
+    group_arrays = [[] for group_id in range(group_cnt)]
+    for group_id, values in zip(group_ids, arrays):
+        group_arrays[group_id].append(values)
+    group_values = np.empty(group_cnt, dtype=object)
+    for group_id, arrays in enumerate(group_arrays):
+        group_values[group_id] = np.concatenate(arrays)
+    return group_values
+
+# the sketches and tail sketches of the partials merged per group, group_ids numbers the groups
+# 0 to group_cnt-1 and the partials of a group are in time order. the tail of a group is merged
+# only from values inside the group's last 10% of operations: the sketches of the trailing partials
+# that lie inside it and the tail sketch of the partial it starts in when that tail fits in the rest
+def merge_sketch_groups(group_ids, counts, sketches, tails, group_cnt):
+    group_partials = [[] for group_id in range(group_cnt)]
+    for partial, group_id in enumerate(group_ids):
+        group_partials[group_id].append(partial)
+    merged_sketches = np.empty(group_cnt, dtype=object)
+    merged_tails = np.empty(group_cnt, dtype=object)
+    for group_id, partials in enumerate(group_partials):
+        merged_sketches[group_id] = sketches[partials[0]].copy()
+        for partial in partials[1:]:
+            merged_sketches[group_id].merge(sketches[partial])
+        if len(partials) == 1:
+            merged_tails[group_id] = tails[partials[0]]
+            continue
+        tail_cnt = math.ceil(counts[partials].sum()*0.10)
+        merged_tails[group_id] = qs.KllSketch(sketches[partials[-1]].k)
+        for partial in reversed(partials):
+            if counts[partial] <= tail_cnt:
+                merged_tails[group_id].merge(sketches[partial])
+                tail_cnt -= counts[partial]
+                continue
+            if math.ceil(counts[partial]*0.10) <= tail_cnt:
+                merged_tails[group_id].merge(tails[partial])
+            break
+    return merged_sketches, merged_tails
+
+# count and amount sum per bucket of the operation types aggregated by a single asset
+def asset_amount_partials(operations, bucket_cnt, asset_col, amount_col):
+    aggregation = BucketAggregation(operations, [asset_col], bucket_cnt)
+    aggregation.add_sum('amount', amount_col)
+    return aggregation
+
+def asset_amount_partial_values(asset_ids, aggregation):
+    value_arrays = []
+    for asset_id in asset_ids:
+        key = (oid.encode_object_id(asset_id),)
+        value_arrays += [aggregation.bucket_values(key, 'count', 0),
+                         aggregation.bucket_values(key, 'amount', 0)]
+    return value_arrays
+
 # operation base class that captures the common attributes
 
 
@@ -73,12 +343,39 @@ class Operation():
         self.operation_id = operation_json['_source']['operation_id_num']
         self.operation_type = operation_json['_source']['operation_type']
         self.block_number = operation_json['_source']['block_data']['block_num']
-        self.block_time = datetime.strptime(
-            operation_json['_source']['block_data']['block_time'], '%Y-%m-%dT%H:%M:%S')
+        # kept as the ISO string and only turned into a datetime when block_time is used
+        self.block_time_iso = operation_json['_source']['block_data']['block_time']
+        self._block_time = None
+
+    @property
+    def block_time(self):
+        if self._block_time is None:
+            self._block_time = parse_timestamp(self.block_time_iso)
+        return self._block_time
 
     index = 'operation_id'
     cols = ['operation_id', 'account',
             'operation_type', 'block_number', 'block_time']
+    # where each column comes from for the columnar batch parser: (type, path into _source)
+    # a path of None marks a column derived from the others by derive_batch_columns
+    col_sources = {'operation_id': ('int', ('operation_id_num',)),
+                   'account': ('account', ('account_history', 'account')),
+                   'operation_type': ('int', ('operation_type',)),
+                   'block_number': ('int', ('block_data', 'block_num')),
+                   'block_time': ('datetime', ('block_data', 'block_time'))}
+    # the asset id column, or the two columns of an asset pair, an operation is aggregated by
+    # operations without one (limit order cancels, transfers from blind) are counted for every market
+    agg_key_cols = []
+    # the columns get_agg_value_list reads besides block_time, aggregation only loads these
+    agg_read_cols = []
+    # the statistics of the BucketAggregation written for every market (or asset) in all-markets mode
+    agg_stat_names = ['count']
+    # the _source fields read by __init__, used to project the Elasticsearch query
+    source_fields = ['account_history.account',
+                     'operation_id_num',
+                     'operation_type',
+                     'block_data.block_num',
+                     'block_data.block_time']
 
     def get_values_list(self):
         return [self.operation_id, self.account, self.operation_type, self.block_number, self.block_time]
@@ -87,6 +384,48 @@ class Operation():
     def empty_df(cls):
         return pd.DataFrame(columns=cls.cols)
 
+    # parse a list of decoded hits of this operation type into typed column arrays
+    # the values are gathered a column at a time and timestamps are kept as ISO strings
+    # until they are converted to datetime64 in one pass per column
+    @classmethod
+    def parse_batch(cls, hits):
+        batch = ColumnBatch(cls, len(hits))
+        sources = [a_json_operation['_source'] for a_json_operation in hits]
+        details = None
+        for col, (col_type, path) in cls.col_sources.items():
+            if path is None:
+                continue
+            if path[:len(op_path)] == op_path:
+                if details is None:
+                    details = gather_values(sources, op_path)
+                values = gather_values(details, path[len(op_path):])
+            else:
+                values = gather_values(sources, path)
+            if col_type in object_id_types:
+                values = oid.encode_object_ids(values)
+            elif col_type == 'datetime':
+                values = to_datetime64(values)
+            batch.columns[col][:] = values
+        cls.derive_batch_columns(batch)
+        return batch
+
+    # fill in the batch columns that are computed from other columns
+    @classmethod
+    def derive_batch_columns(cls, batch):
+        pass
+
+    # the values of get_values_list with the object ids and markets replaced by their codes
+    @classmethod
+    def encode_values(cls, values):
+        encoded_values = list(values)
+        for i, col in enumerate(cls.cols):
+            col_type = cls.col_sources[col][0]
+            if col_type in object_id_types:
+                encoded_values[i] = oid.encode_object_id(values[i])
+            elif col_type == 'market':
+                encoded_values[i] = oid.encode_market(values[i])
+        return encoded_values
+
     # return a list with only the column names as row 0
     @classmethod
     def empty_list(cls):
@@ -100,6 +439,47 @@ class Operation():
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         return []
 
+    # the mergeable statistics of the operations per aggregation key and time bucket, see BucketAggregation
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        return BucketAggregation(operations, cls.agg_key_cols, bucket_cnt)
+
+    # get_agg_value_list for every time bucket of a BucketAggregation from get_agg_partials
+    # (or a rollup of it), returns one array of bucket_cnt values per column of get_agg_columns
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        return []
+
+    # add the statistics that are computed from the merged partial states, call before reading them
+    @classmethod
+    def finish_agg_partials(cls, aggregation):
+        pass
+
+    # the agg_stat_names of every aggregation key and time bucket of a BucketAggregation as a long table,
+    # the key is in the market column as the market code of an asset pair, the code of a single asset
+    # or 0 for operation types that are not aggregated by asset
+    @classmethod
+    def get_agg_market_frame(cls, aggregation):
+        cls.finish_agg_partials(aggregation)
+        stats = aggregation.stats
+        if len(cls.agg_key_cols) == 2:
+            markets = oid.encode_markets(stats.index.get_level_values(0).to_numpy(),
+                                         stats.index.get_level_values(1).to_numpy())
+        elif len(cls.agg_key_cols) == 1:
+            markets = stats.index.get_level_values(0).to_numpy()
+        else:
+            markets = np.zeros(len(stats.index), dtype=np.int64)
+        market_frame = pd.DataFrame({'bucket': stats.index.get_level_values('bucket').to_numpy(), 'market': markets})
+        for name in cls.agg_stat_names:
+            market_frame[name] = stats[name].to_numpy()
+        return market_frame
+
+    # get_agg_value_list for every time bucket of operations at once
+    @classmethod
+    def get_agg_bucket_values(cls, asset_ids, market_asset_id_pairs, operations, bucket_cnt):
+        return cls.get_agg_partial_values(asset_ids, market_asset_id_pairs,
+                                          cls.get_agg_partials(operations, bucket_cnt))
+
 # operation that transfers an asset amount from once account to another
 
 
@@ -112,10 +492,19 @@ class Transfer(Operation):
             operation_json['_source']['operation_history']['op'][1]['amount'])
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['from_account',
                              'to_account',
                              'amount.asset_id',
                              'amount.amount']
+    agg_key_cols = ['amount.asset_id']
+    agg_read_cols = ['amount.asset_id', 'amount.amount']
+    agg_stat_names = ['count', 'amount']
+    col_sources = dict(Operation.col_sources, **{
+        'from_account': ('account', op_path + ('from',)),
+        'to_account': ('account', op_path + ('to',)),
+        'amount.asset_id': ('asset', op_path + ('amount', 'asset_id')),
+        'amount.amount': ('amount', op_path + ('amount', 'amount'))})
     agg_cols = []
 
     def get_values_list(self):
@@ -136,13 +525,22 @@ class Transfer(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id in asset_ids:
-            filtered_oerations = operations[operations['amount.asset_id'] == asset_id]
+            filtered_oerations = operations[operations['amount.asset_id'] == oid.encode_object_id(asset_id)]
             aggregates = filtered_oerations.agg(
                 {'amount.amount': ['count', 'sum']})
             value_list += [aggregates.iloc[0]['amount.amount'],
                            aggregates.iloc[1]['amount.amount']]
         return value_list
 
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        return asset_amount_partials(operations, bucket_cnt, 'amount.asset_id', 'amount.amount')
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        return Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation) + \
+            asset_amount_partial_values(asset_ids, aggregation)
+
 
 # operation that creates the ability for a counterparty to execute a transaction against an account
 
@@ -155,19 +553,19 @@ class LimitOrderCreate(Operation):
             operation_json['_source']['operation_history']['op'][1]['amount_to_sell'])
         self.min_to_receive = Amount(
             operation_json['_source']['operation_history']['op'][1]['min_to_receive'])
-        self.expiration = datetime.strptime(
-            operation_json['_source']['operation_history']['op'][1]['expiration'], '%Y-%m-%dT%H:%M:%S')
-        self.expiration_in_seconds = (datetime.strptime(
-            operation_json['_source']['operation_history']['op'][1]['expiration'],
-            '%Y-%m-%dT%H:%M:%S') - self.block_time).total_seconds()
+        self.expiration = parse_timestamp(
+            operation_json['_source']['operation_history']['op'][1]['expiration'])
+        self.expiration_in_seconds = (self.expiration - self.block_time).total_seconds()
         if self.expiration_in_seconds < 0:
-            self.expiration_in_seconds = -1
+            self.expiration_in_seconds = -1.0
         self.fill_or_kill = operation_json['_source']['operation_history']['op'][1]['fill_or_kill']
         self.market = self.min_to_receive.asset_id + '/' + self.amount_to_sell.asset_id
         self.min_rate = self.min_to_receive.amount/self.amount_to_sell.amount
         self.limit_id = operation_json['_source']['operation_history']['operation_result'][1]
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op',
+                                               'operation_history.operation_result']
     cols = Operation.cols + ['seller',
                              'amount_to_sell.asset_id',
                              'amount_to_sell.amount',
@@ -179,8 +577,36 @@ class LimitOrderCreate(Operation):
                              'market',
                              'min_rate',
                              'limit_id']
+    agg_key_cols = ['min_to_receive.asset_id', 'amount_to_sell.asset_id']
+    agg_read_cols = ['min_to_receive.asset_id', 'amount_to_sell.asset_id', 'min_to_receive.amount',
+                     'amount_to_sell.amount', 'min_rate', 'expiration_in_seconds']
+    agg_stat_names = ['count', 'sell_amount', 'minreceive_amount', 'rate_median', 'rate_mean', 'rate_max', 'rate_min', 'rate_std',
+                      'expiration_median', 'expiration_mean', 'pctnegativeexpiration']
+    col_sources = dict(Operation.col_sources, **{
+        'seller': ('account', op_path + ('seller',)),
+        'amount_to_sell.asset_id': ('asset', op_path + ('amount_to_sell', 'asset_id')),
+        'amount_to_sell.amount': ('amount', op_path + ('amount_to_sell', 'amount')),
+        'min_to_receive.asset_id': ('asset', op_path + ('min_to_receive', 'asset_id')),
+        'min_to_receive.amount': ('amount', op_path + ('min_to_receive', 'amount')),
+        'expiration': ('datetime', op_path + ('expiration',)),
+        'expiration_in_seconds': ('float', None),
+        'fill_or_kill': ('bool', op_path + ('fill_or_kill',)),
+        'market': ('market', None),
+        'min_rate': ('float', None),
+        'limit_id': ('str', ('operation_history', 'operation_result', 1))})
     agg_cols = []
 
+    @classmethod
+    def derive_batch_columns(cls, batch):
+        columns = batch.columns
+        expiration_in_seconds = (columns['expiration'] - columns['block_time']).astype(np.float64)
+        expiration_in_seconds[expiration_in_seconds < 0] = -1.0
+        columns['expiration_in_seconds'][:] = expiration_in_seconds
+        columns['market'][:] = oid.encode_markets(columns['min_to_receive.asset_id'],
+                                                  columns['amount_to_sell.asset_id'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns['min_rate'][:] = columns['min_to_receive.amount']/columns['amount_to_sell.amount']
+
     def get_values_list(self):
         return super().get_values_list() + [self.seller,
                                             self.amount_to_sell.asset_id,
@@ -217,8 +643,8 @@ class LimitOrderCreate(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id_pair in market_asset_id_pairs:
-            filtered_operations = operations[(operations['min_to_receive.asset_id'] == asset_id_pair[0]) &
-                                             (operations['amount_to_sell.asset_id'] == asset_id_pair[1])]
+            filtered_operations = operations[(operations['min_to_receive.asset_id'] == oid.encode_object_id(asset_id_pair[0])) &
+                                             (operations['amount_to_sell.asset_id'] == oid.encode_object_id(asset_id_pair[1]))]
 
             filtered_operation_cnt = len(filtered_operations.index)
             if filtered_operation_cnt != 0:
@@ -256,6 +682,39 @@ class LimitOrderCreate(Operation):
                 value_list += [0, 0, 0, '', '', '', '', '', 0, 0, 0]
         return value_list
 
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        operations = operations.assign(negative_expiration=operations['expiration_in_seconds'] < 0)
+        aggregation = BucketAggregation(operations, cls.agg_key_cols, bucket_cnt)
+        aggregation.add_sum('sell_amount', 'amount_to_sell.amount')
+        aggregation.add_sum('minreceive_amount', 'min_to_receive.amount')
+        aggregation.add_sum('negative_expirations', 'negative_expiration')
+        aggregation.add_moments('rate', 'min_rate')
+        aggregation.add_moments('expiration', 'expiration_in_seconds')
+        return aggregation
+
+    @classmethod
+    def finish_agg_partials(cls, aggregation):
+        aggregation.finish_moments('rate')
+        aggregation.finish_moments('expiration')
+        aggregation.stats['pctnegativeexpiration'] = \
+            aggregation.stats['negative_expirations']/aggregation.stats['count']
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        value_arrays = Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation)
+        cls.finish_agg_partials(aggregation)
+        for asset_id_pair in market_asset_id_pairs:
+            key = (oid.encode_object_id(asset_id_pair[0]), oid.encode_object_id(asset_id_pair[1]))
+            value_arrays += [aggregation.bucket_values(key, 'count', 0),
+                             aggregation.bucket_values(key, 'sell_amount', 0),
+                             aggregation.bucket_values(key, 'minreceive_amount', 0)]
+            for name in ['rate_median', 'rate_mean', 'rate_max', 'rate_min', 'rate_std']:
+                value_arrays += [aggregation.bucket_values(key, name, '')]
+            for name in ['expiration_median', 'expiration_mean', 'pctnegativeexpiration']:
+                value_arrays += [aggregation.bucket_values(key, name, 0)]
+        return value_arrays
+
 
 # operation that cancels a limit order
 
@@ -269,7 +728,11 @@ class LimitOrderCancel(Operation):
         # self.canceled_amount = Asset(operation_json['_source']['operation_history']['operation_result'][1])
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['canceler', 'limit_id']
+    col_sources = dict(Operation.col_sources, **{
+        'canceler': ('account', op_path + ('fee_paying_account',)),
+        'limit_id': ('str', op_path + ('order',))})
     agg_cols = []
 
     def get_values_list(self):
@@ -287,6 +750,12 @@ class LimitOrderCancel(Operation):
         value_list += [len(operations.index)]
         return value_list
 
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        value_arrays = Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation)
+        value_arrays += [aggregation.bucket_values((), 'count', 0)]
+        return value_arrays
+
 # # operation that updates an existing limit order
 
 
@@ -369,6 +838,7 @@ class FillOrder(Operation):
         self.limit_id = operation_json['_source']['operation_history']['op'][1]['order_id']
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['account',
                              'receives.asset_id',
                              'receives.amount',
@@ -382,8 +852,36 @@ class FillOrder(Operation):
                              'market',
                              'rate'
                              ]
+    agg_key_cols = ['fill_base.asset_id', 'fill_quote.asset_id']
+    agg_read_cols = ['fill_base.asset_id', 'fill_quote.asset_id', 'receives.amount', 'pays.amount', 'rate']
+    agg_stat_names = ['count', 'receives_amount', 'pays_amount', 'rate_median', 'rate_mean', 'rate_min', 'rate_max', 'rate_std',
+                      'rate_last10pct']
+    col_sources = dict(Operation.col_sources, **{
+        'account': ('account', op_path + ('account_id',)),
+        'receives.asset_id': ('asset', op_path + ('receives', 'asset_id')),
+        'receives.amount': ('amount', op_path + ('receives', 'amount')),
+        'pays.asset_id': ('asset', op_path + ('pays', 'asset_id')),
+        'pays.amount': ('amount', op_path + ('pays', 'amount')),
+        'fill_base.asset_id': ('asset', op_path + ('fill_price', 'base', 'asset_id')),
+        'fill_base.amount': ('amount', op_path + ('fill_price', 'base', 'amount')),
+        'fill_quote.asset_id': ('asset', op_path + ('fill_price', 'quote', 'asset_id')),
+        'fill_quote.amount': ('amount', op_path + ('fill_price', 'quote', 'amount')),
+        'limit_id': ('str', op_path + ('order_id',)),
+        'market': ('market', None),
+        'rate': ('float', None)})
     agg_cols = []
 
+    # rate is left as NaN (written as '') when the quote amount is 0
+    @classmethod
+    def derive_batch_columns(cls, batch):
+        columns = batch.columns
+        columns['market'][:] = oid.encode_markets(columns['fill_base.asset_id'],
+                                                  columns['fill_quote.asset_id'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns['rate'][:] = np.where(columns['fill_quote.amount'] != 0,
+                                          columns['fill_base.amount']/columns['fill_quote.amount'],
+                                          np.nan)
+
     def get_values_list(self):
         values = super().get_values_list()
         values += [
@@ -429,8 +927,8 @@ class FillOrder(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id_pair in market_asset_id_pairs:
-            filtered_operations = operations[(operations['fill_base.asset_id'] == asset_id_pair[0]) &
-                                             (operations['fill_quote.asset_id'] == asset_id_pair[1]) &
+            filtered_operations = operations[(operations['fill_base.asset_id'] == oid.encode_object_id(asset_id_pair[0])) &
+                                             (operations['fill_quote.asset_id'] == oid.encode_object_id(asset_id_pair[1])) &
                                              (operations['rate'] != 0)]
             filtered_operation_cnt = len(filtered_operations.index)
             if filtered_operation_cnt != 0:
@@ -459,6 +957,32 @@ class FillOrder(Operation):
                 value_list += [0, 0, 0, '', '', '', '', '', '']
         return value_list
 
+    # operations with a rate of 0 are left out, operations without a rate (NaN) are kept
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        aggregation = BucketAggregation(operations[operations['rate'] != 0], cls.agg_key_cols, bucket_cnt)
+        aggregation.add_sum('receives_amount', 'receives.amount')
+        aggregation.add_sum('pays_amount', 'pays.amount')
+        aggregation.add_moments('rate', 'rate')
+        return aggregation
+
+    @classmethod
+    def finish_agg_partials(cls, aggregation):
+        aggregation.finish_moments('rate')
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        value_arrays = Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation)
+        cls.finish_agg_partials(aggregation)
+        for asset_id_pair in market_asset_id_pairs:
+            key = (oid.encode_object_id(asset_id_pair[0]), oid.encode_object_id(asset_id_pair[1]))
+            value_arrays += [aggregation.bucket_values(key, 'count', 0),
+                             aggregation.bucket_values(key, 'receives_amount', 0),
+                             aggregation.bucket_values(key, 'pays_amount', 0)]
+            for name in ['rate_median', 'rate_mean', 'rate_min', 'rate_max', 'rate_std', 'rate_last10pct']:
+                value_arrays += [aggregation.bucket_values(key, name, '')]
+        return value_arrays
+
 
 # Schedules a market-issued asset for automatic settlement
 #
@@ -486,10 +1010,18 @@ class AssetSettle(Operation):
             operation_json['_source']['operation_history']['op'][1]['amount'])
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['account',
                              'amount.asset_id',
                              'amount.amount'
                              ]
+    agg_key_cols = ['amount.asset_id']
+    agg_read_cols = ['amount.asset_id', 'amount.amount']
+    agg_stat_names = ['count', 'amount']
+    col_sources = dict(Operation.col_sources, **{
+        'account': ('account', op_path + ('account',)),
+        'amount.asset_id': ('asset', op_path + ('amount', 'asset_id')),
+        'amount.amount': ('amount', op_path + ('amount', 'amount'))})
     agg_cols = []
 
     def get_values_list(self):
@@ -511,7 +1043,7 @@ class AssetSettle(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id in asset_ids:
-            filtered_operations = operations[operations['amount.asset_id'] == asset_id]
+            filtered_operations = operations[operations['amount.asset_id'] == oid.encode_object_id(asset_id)]
             filtered_operation_cnt = len(filtered_operations.index)
             if filtered_operation_cnt != 0:
                 aggregates = filtered_operations.agg({'amount.amount': ['sum']})
@@ -522,6 +1054,15 @@ class AssetSettle(Operation):
                 value_list += [0, 0]
         return value_list
 
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        return asset_amount_partials(operations, bucket_cnt, 'amount.asset_id', 'amount.amount')
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        return Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation) + \
+            asset_amount_partial_values(asset_ids, aggregation)
+
 # represents market maker publishing an asset price
 
 
@@ -534,6 +1075,7 @@ class AssetPublishFeed(Operation):
                          ['operation_history']['op'][1]['feed'])
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['publisher',
                              'asset_id',
                              'feed.settlement_price.base.asset_id',
@@ -547,8 +1089,34 @@ class AssetPublishFeed(Operation):
                              'feed.core_exchange_rate.quote.asset_id',
                              'feed.core_exchange_rate.quote.amount',
                              'rate']
+    agg_key_cols = ['feed.settlement_price.base.asset_id', 'feed.settlement_price.quote.asset_id']
+    agg_read_cols = ['feed.settlement_price.base.asset_id', 'feed.settlement_price.quote.asset_id', 'rate']
+    agg_stat_names = ['count', 'rate_median', 'rate_mean', 'rate_min', 'rate_max', 'rate_std', 'rate_last10pct']
+    col_sources = dict(Operation.col_sources, **{
+        'publisher': ('account', op_path + ('publisher',)),
+        'asset_id': ('asset', op_path + ('asset_id',)),
+        'feed.settlement_price.base.asset_id': ('asset', op_path + ('feed', 'settlement_price', 'base', 'asset_id')),
+        'feed.settlement_price.base.amount': ('amount', op_path + ('feed', 'settlement_price', 'base', 'amount')),
+        'feed.settlement_price.quote.asset_id': ('asset', op_path + ('feed', 'settlement_price', 'quote', 'asset_id')),
+        'feed.settlement_price.quote.amount': ('amount', op_path + ('feed', 'settlement_price', 'quote', 'amount')),
+        'feed.maintenance_collateral_ratio': ('int', op_path + ('feed', 'maintenance_collateral_ratio')),
+        'feed.maximum_short_squeeze_ratio': ('int', op_path + ('feed', 'maximum_short_squeeze_ratio')),
+        'feed.core_exchange_rate.base.asset_id': ('asset', op_path + ('feed', 'core_exchange_rate', 'base', 'asset_id')),
+        'feed.core_exchange_rate.base.amount': ('amount', op_path + ('feed', 'core_exchange_rate', 'base', 'amount')),
+        'feed.core_exchange_rate.quote.asset_id': ('asset', op_path + ('feed', 'core_exchange_rate', 'quote', 'asset_id')),
+        'feed.core_exchange_rate.quote.amount': ('amount', op_path + ('feed', 'core_exchange_rate', 'quote', 'amount')),
+        'rate': ('float', None)})
     agg_cols = []
 
+    @classmethod
+    def derive_batch_columns(cls, batch):
+        columns = batch.columns
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns['rate'][:] = np.where(columns['feed.settlement_price.quote.amount'] != 0,
+                                          columns['feed.settlement_price.base.amount'] /
+                                          columns['feed.settlement_price.quote.amount'],
+                                          np.nan)
+
     def get_values_list(self):
         values = super().get_values_list()
         values += [
@@ -593,8 +1161,8 @@ class AssetPublishFeed(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id_pair in market_asset_id_pairs:
-            filtered_operations = operations[(operations['feed.settlement_price.base.asset_id'] == asset_id_pair[0]) &
-                                             (operations['feed.settlement_price.quote.asset_id'] == asset_id_pair[1])]
+            filtered_operations = operations[(operations['feed.settlement_price.base.asset_id'] == oid.encode_object_id(asset_id_pair[0])) &
+                                             (operations['feed.settlement_price.quote.asset_id'] == oid.encode_object_id(asset_id_pair[1]))]
             filtered_operation_cnt = len(filtered_operations.index)
             if filtered_operation_cnt != 0:
                 last_10pct_row_cnt = math.ceil(filtered_operation_cnt*0.10)
@@ -615,6 +1183,27 @@ class AssetPublishFeed(Operation):
                 value_list += [0,'','','','','','']
         return value_list
 
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        aggregation = BucketAggregation(operations, cls.agg_key_cols, bucket_cnt)
+        aggregation.add_moments('rate', 'rate')
+        return aggregation
+
+    @classmethod
+    def finish_agg_partials(cls, aggregation):
+        aggregation.finish_moments('rate')
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        value_arrays = Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation)
+        cls.finish_agg_partials(aggregation)
+        for asset_id_pair in market_asset_id_pairs:
+            key = (oid.encode_object_id(asset_id_pair[0]), oid.encode_object_id(asset_id_pair[1]))
+            value_arrays += [aggregation.bucket_values(key, 'count', 0)]
+            for name in ['rate_median', 'rate_mean', 'rate_min', 'rate_max', 'rate_std', 'rate_last10pct']:
+                value_arrays += [aggregation.bucket_values(key, name, '')]
+        return value_arrays
+
 # Create a vesting balance.
 #
 # The chain allows a user to create a vesting balance. Normally, vesting balances are
@@ -636,11 +1225,20 @@ class VestingBalanceCreate(Operation):
             operation_json['_source']['operation_history']['op'][1]['amount'])
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['creator',
                              'owner',
                              'amount.asset_id',
                              'amount.amount'
                              ]
+    agg_key_cols = ['amount.asset_id']
+    agg_read_cols = ['amount.asset_id', 'amount.amount']
+    agg_stat_names = ['count', 'amount']
+    col_sources = dict(Operation.col_sources, **{
+        'creator': ('account', op_path + ('creator',)),
+        'owner': ('account', op_path + ('owner',)),
+        'amount.asset_id': ('asset', op_path + ('amount', 'asset_id')),
+        'amount.amount': ('amount', op_path + ('amount', 'amount'))})
     aggcols = []
 
     def get_values_list(self):
@@ -664,7 +1262,7 @@ class VestingBalanceCreate(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id in asset_ids:
-            filtered_operations = operations[operations['amount.asset_id'] == asset_id]
+            filtered_operations = operations[operations['amount.asset_id'] == oid.encode_object_id(asset_id)]
             filtered_operation_cnt = len(filtered_operations.index)
             if filtered_operation_cnt != 0:
                 aggregates = filtered_operations.agg({'amount.amount': ['sum']})
@@ -675,6 +1273,15 @@ class VestingBalanceCreate(Operation):
                 value_list += [0, 0]
         return value_list
 
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        return asset_amount_partials(operations, bucket_cnt, 'amount.asset_id', 'amount.amount')
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        return Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation) + \
+            asset_amount_partial_values(asset_ids, aggregation)
+
 
 # Withdraw from a vesting balance.
 #
@@ -692,11 +1299,20 @@ class VestingBalanceWithdraw(Operation):
             operation_json['_source']['operation_history']['op'][1]['amount'])
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['vesting_balance',
                              'asownerset_id',
                              'amount.asset_id',
                              'amount.amount'
                              ]
+    agg_key_cols = ['amount.asset_id']
+    agg_read_cols = ['amount.asset_id', 'amount.amount']
+    agg_stat_names = ['count', 'amount']
+    col_sources = dict(Operation.col_sources, **{
+        'vesting_balance': ('str', op_path + ('vesting_balance',)),
+        'asownerset_id': ('account', op_path + ('owner',)),
+        'amount.asset_id': ('asset', op_path + ('amount', 'asset_id')),
+        'amount.amount': ('amount', op_path + ('amount', 'amount'))})
     aggcols = []
 
     def get_values_list(self):
@@ -719,7 +1335,7 @@ class VestingBalanceWithdraw(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id in asset_ids:
-            filtered_operations = operations[operations['amount.asset_id'] == asset_id]
+            filtered_operations = operations[operations['amount.asset_id'] == oid.encode_object_id(asset_id)]
             filtered_operation_cnt = len(filtered_operations.index)
             if filtered_operation_cnt != 0:
                 aggregates = filtered_operations.agg({'amount.amount': ['sum']})
@@ -730,6 +1346,15 @@ class VestingBalanceWithdraw(Operation):
                 value_list += [0, 0]
         return value_list
 
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        return asset_amount_partials(operations, bucket_cnt, 'amount.asset_id', 'amount.amount')
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        return Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation) + \
+            asset_amount_partial_values(asset_ids, aggregation)
+
 
 # blind transfer, tells amount, not to whom
 
@@ -742,7 +1367,15 @@ class TransferToBlind(Operation):
         self.from_ = operation_json['_source']['operation_history']['op'][1]['from']
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['amount.asset_id', 'amount.amount', 'from_']
+    agg_key_cols = ['amount.asset_id']
+    agg_read_cols = ['amount.asset_id', 'amount.amount']
+    agg_stat_names = ['count', 'amount']
+    col_sources = dict(Operation.col_sources, **{
+        'amount.asset_id': ('asset', op_path + ('amount', 'asset_id')),
+        'amount.amount': ('amount', op_path + ('amount', 'amount')),
+        'from_': ('account', op_path + ('from',))})
     agg_cols = []
 
     def get_values_list(self):
@@ -762,7 +1395,7 @@ class TransferToBlind(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id in asset_ids:
-            filtered_operations = operations[operations['amount.asset_id'] == asset_id]
+            filtered_operations = operations[operations['amount.asset_id'] == oid.encode_object_id(asset_id)]
             filtered_operation_cnt = len(filtered_operations.index)
             if filtered_operation_cnt != 0:
                 aggregates = filtered_operations.agg({'amount.amount': ['sum']})
@@ -773,6 +1406,15 @@ class TransferToBlind(Operation):
                 value_list += [0, 0]
         return value_list
 
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        return asset_amount_partials(operations, bucket_cnt, 'amount.asset_id', 'amount.amount')
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        return Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation) + \
+            asset_amount_partial_values(asset_ids, aggregation)
+
 
 # blind transfer, tells who receives, not amount
 
@@ -784,8 +1426,14 @@ class TransferFromBlind(Operation):
 
     index = Operation.index
     cols = Operation.cols + ['asset_id']
+    col_sources = dict(Operation.col_sources, **{
+        'asset_id': ('str', None)})
     agg_cols = []
 
+    @classmethod
+    def derive_batch_columns(cls, batch):
+        batch.columns['asset_id'][:] = 'unknown'
+
     def get_values_list(self):
         return super().get_values_list() + [self.asset_id]
 
@@ -801,6 +1449,12 @@ class TransferFromBlind(Operation):
         value_list += [len(operations.index)]
         return value_list
 
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        value_arrays = Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation)
+        value_arrays += [aggregation.bucket_values((), 'count', 0)]
+        return value_arrays
+
 # override transfer: issues moves any assets where ever the issuer wants
 
 
@@ -814,12 +1468,22 @@ class OverrideTransfer(Operation):
             operation_json['_source']['operation_history']['op'][1]['amount'])
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['issuer',
                              'from',
                              'to',
                              'amount.asset_id',
                              'amount.amount'
                              ]
+    agg_key_cols = ['amount.asset_id']
+    agg_read_cols = ['amount.asset_id', 'amount.amount']
+    agg_stat_names = ['count', 'amount']
+    col_sources = dict(Operation.col_sources, **{
+        'issuer': ('account', op_path + ('issuer',)),
+        'from': ('account', op_path + ('from',)),
+        'to': ('account', op_path + ('to',)),
+        'amount.asset_id': ('asset', op_path + ('amount', 'asset_id')),
+        'amount.amount': ('amount', op_path + ('amount', 'amount'))})
     agg_cols = []
 
     def get_values_list(self):
@@ -839,7 +1503,7 @@ class OverrideTransfer(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id in asset_ids:
-            filtered_operations = operations[operations['amount.asset_id'] == asset_id]
+            filtered_operations = operations[operations['amount.asset_id'] == oid.encode_object_id(asset_id)]
             filtered_operation_cnt = len(filtered_operations.index)
             if filtered_operation_cnt != 0:
                 aggregates = filtered_operations.agg({'amount.amount': ['sum']})
@@ -850,6 +1514,15 @@ class OverrideTransfer(Operation):
                 value_list += [0, 0]
         return value_list
 
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        return asset_amount_partials(operations, bucket_cnt, 'amount.asset_id', 'amount.amount')
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        return Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation) + \
+            asset_amount_partial_values(asset_ids, aggregation)
+
 
 # transfers accumluated fees back to issuers balance
 
@@ -864,10 +1537,18 @@ class AssetClaimFees(Operation):
                    ['operation_history']['op'][1]['amount_to_claim'])
 
     index = Operation.index
+    source_fields = Operation.source_fields + ['operation_history.op']
     cols = Operation.cols + ['issuer',
                              'amount_to_claim.asset_id',
                              'amount_to_claim.amount'
                              ]
+    agg_key_cols = ['amount_to_claim.asset_id']
+    agg_read_cols = ['amount_to_claim.asset_id', 'amount_to_claim.amount']
+    agg_stat_names = ['count', 'amount']
+    col_sources = dict(Operation.col_sources, **{
+        'issuer': ('account', op_path + ('issuer',)),
+        'amount_to_claim.asset_id': ('asset', op_path + ('amount_to_claim', 'asset_id')),
+        'amount_to_claim.amount': ('amount', op_path + ('amount_to_claim', 'amount'))})
     agg_cols = []
 
     def get_values_list(self):
@@ -886,7 +1567,7 @@ class AssetClaimFees(Operation):
     def get_agg_value_list(cls, asset_ids, market_asset_id_pairs, operations):
         value_list = Operation.get_agg_value_list(asset_ids, market_asset_id_pairs, operations)
         for asset_id in asset_ids:
-            filtered_operations = operations[operations['amount_to_claim.asset_id'] == asset_id]
+            filtered_operations = operations[operations['amount_to_claim.asset_id'] == oid.encode_object_id(asset_id)]
             filtered_operation_cnt = len(filtered_operations.index)
             if filtered_operation_cnt != 0:
                 aggregates = filtered_operations.agg(
@@ -897,6 +1578,15 @@ class AssetClaimFees(Operation):
                 value_list += [0, 0]
         return value_list
 
+    @classmethod
+    def get_agg_partials(cls, operations, bucket_cnt):
+        return asset_amount_partials(operations, bucket_cnt, 'amount_to_claim.asset_id', 'amount_to_claim.amount')
+
+    @classmethod
+    def get_agg_partial_values(cls, asset_ids, market_asset_id_pairs, aggregation):
+        return Operation.get_agg_partial_values(asset_ids, market_asset_id_pairs, aggregation) + \
+            asset_amount_partial_values(asset_ids, aggregation)
+
 
 # dictionary of supported operations and their assocated Operation subclass
 supported_operations = {
@@ -926,6 +1616,15 @@ def parse_operation(operation_json):
     return op_class(operation_json)
 
 
+# distinct list of _source fields read by the supported operations, in first seen order
+def source_includes():
+    includes = {}
+    for op_class in supported_operations.values():
+        for field in op_class.source_fields:
+            includes[field] = field
+    return list(includes.values())
+
+
 def make_aggregate_dfs():
     aggregate_dfs = {}
     for op_key, op_class in supported_operations.items():
@@ -944,5 +1643,129 @@ def make_empty_lists():
 
 def append_record(operation, op_lists):
     if operation.operation_type in supported_operations.keys():
-        value_list = operation.get_values_list()
+        value_list = operation.encode_values(operation.get_values_list())
         op_lists[operation.operation_type].append(value_list)
+
+# column types holding object ids that are stored as codes
+object_id_types = ['asset', 'account']
+
+# numpy types of the column types used in col_sources, amounts are kept in the asset's base units
+# and asset and account ids and markets are stored as their object_ids codes
+batch_dtypes = {
+    'int': np.int64,
+    'float': np.float64,
+    'datetime': 'datetime64[s]',
+    'amount': np.int64,
+    'asset': np.int64,
+    'account': np.int64,
+    'market': np.int64,
+    'bool': np.bool_,
+    'str': object
+}
+
+# a batch of one operation type held as one preallocated array per column instead of one object per operation
+class ColumnBatch():
+    def __init__(self, op_class, size):
+        self.op_class = op_class
+        self.size = size
+        self.columns = {}
+        for col, (col_type, path) in op_class.col_sources.items():
+            self.columns[col] = np.empty(size, dtype=batch_dtypes[col_type])
+
+    # a new batch with only the rows where mask is True
+    def take(self, mask):
+        batch = ColumnBatch(self.op_class, 0)
+        batch.columns = {col: values[mask] for col, values in self.columns.items()}
+        batch.size = len(batch.columns[self.op_class.cols[0]])
+        return batch
+
+    # the batch as rows of plain python values, the same rows encode_values(get_values_list()) produces,
+    # for the csv partitions
+    def to_values_lists(self):
+        value_columns = []
+        for col in self.op_class.cols:
+            col_type, path = self.op_class.col_sources[col]
+            values = self.columns[col]
+            if col_type == 'datetime':
+                values = values.astype(object).tolist()
+            elif col_type == 'float' and path is None:
+                values = [value if value == value else '' for value in values.tolist()]
+            else:
+                values = values.tolist()
+            value_columns.append(values)
+        return [list(row) for row in zip(*value_columns)]
+
+# split a list of decoded hits by operation type and parse each supported type into a ColumnBatch
+def parse_batches(hits):
+    hits_by_type = {}
+    for a_json_operation in hits:
+        operation_type = a_json_operation['_source']['operation_type']
+        if operation_type in supported_operations:
+            hits_by_type.setdefault(operation_type, []).append(a_json_operation)
+    batches = {}
+    for op_key, type_hits in hits_by_type.items():
+        batches[op_key] = supported_operations[op_key].parse_batch(type_hits)
+    return batches
+
+# asset ids inside an undecoded op string
+asset_id_pattern = re.compile(r'"asset_id"\s*:\s*"(1\.3\.[0-9]+)"')
+
+# follow a dotted column name such as fill_base.asset_id through an operation's attributes
+def get_attribute_path(an_operation, col):
+    value = an_operation
+    for attribute in col.split('.'):
+        value = getattr(value, attribute)
+    return value
+
+# keeps only the operations that touch the assets or asset pairs aggregated for a list of markets
+# operation types without an aggregation key (limit order cancels, transfers from blind) are always kept
+class MarketFilter():
+    def __init__(self, markets):
+        self.markets = sorted(markets)
+        asset_ids, market_asset_id_pairs = asset.distinct_asset_ids(markets)
+        self.asset_ids = set(asset_ids)
+        self.asset_id_pairs = set(tuple(pair) for pair in market_asset_id_pairs)
+        self.asset_codes = oid.encode_object_ids(sorted(self.asset_ids))
+        self.market_codes = np.array([oid.encode_market(pair[0] + '/' + pair[1])
+                                      for pair in sorted(self.asset_id_pairs)], dtype=np.int64)
+
+    # cheap check on a hit whose op is still a JSON string,
+    # False only when none of the asset ids in the string belong to the markets
+    def may_match(self, a_json_operation):
+        op_class = supported_operations.get(a_json_operation['_source']['operation_type'])
+        if op_class is None or not op_class.agg_key_cols:
+            return True
+        op = a_json_operation['_source'].get('operation_history', {}).get('op')
+        if not isinstance(op, str):
+            return True
+        for asset_id in asset_id_pattern.findall(op):
+            if asset_id in self.asset_ids:
+                return True
+        return False
+
+    # exact check on a parsed Operation object
+    def matches(self, an_operation):
+        key_cols = an_operation.agg_key_cols
+        if not key_cols:
+            return True
+        key = tuple(get_attribute_path(an_operation, col) for col in key_cols)
+        if len(key) == 1:
+            return key[0] in self.asset_ids
+        return key in self.asset_id_pairs
+
+    # exact check on a ColumnBatch, returns the batch with only the matching rows
+    def filter_batch(self, batch):
+        key_cols = batch.op_class.agg_key_cols
+        if not key_cols:
+            return batch
+        if len(key_cols) == 1:
+            codes = batch.columns[key_cols[0]]
+            relevant_codes = self.asset_codes
+        else:
+            codes = oid.encode_markets(batch.columns[key_cols[0]], batch.columns[key_cols[1]])
+            relevant_codes = self.market_codes
+        return batch.take(np.isin(codes, relevant_codes))
+
+    # operation types that have no aggregation key and so can not be filtered
+    def unfiltered_operation_ids(self):
+        return [op_key for op_key, op_class in supported_operations.items() if not op_class.agg_key_cols]
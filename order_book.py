@@ -0,0 +1,394 @@
+from bisect import bisect_left
+from bisect import insort
+from datetime import datetime
+from datetime import timedelta
+import heapq
+import json
+import logging
+from os import replace
+from os.path import isfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import dir_mgmt_utils as dmu
+import ingest_manifest
+import partition_store as ps
+import object_ids as oid
+import asset
+import aggregate_store as ags
+
+logging.basicConfig(format='%(asctime)s %(module)s:%(lineno)d %(message)s', level=logging.INFO)
+
+# Replays the limit orders of the partitions into live order books and writes a snapshot of the
+# book of every market at the end of every minute.
+#
+# A market is a pair of assets with the lower asset code first (the base asset), like the candles.
+# An order selling the quote asset is an ask, one selling the base asset a bid, and prices are in
+# base units per quote unit:
+#   ask price    min_to_receive.amount/amount_to_sell.amount
+#   bid price    amount_to_sell.amount/min_to_receive.amount
+# The depth of a level is what its orders still have to sell, in quote units for asks and in base
+# units for bids, so depths stay exact integers.
+#
+# The events of a day are read column wise, sorted by block time and operation id and applied in
+# one pass:
+#   limit_order_create    adds the order (fill or kill orders never rest on the book)
+#   fill_order            takes pays.amount off the order, the order leaves when nothing is left
+#   limit_order_cancel    removes the order
+#   expiration            removes the order once the block time passes its expiration
+# Fills and cancels of orders that are not on the book (created before the replay started or in
+# a market not replayed) are skipped. Only the orders on the books are kept, so memory grows with
+# the books, not with the history. The books are checkpointed at the end of a run and the next
+# run picks up from there.
+#
+# Snapshots go to aggregates/book/<yyyymm>.parquet with the best bid and ask, the spread and the
+# price and depth of the book_levels best levels of each side.
+
+limit_order_create_key = 1
+limit_order_cancel_key = 2
+fill_order_key = 4
+minutes_per_day = 24*60
+book_levels = 10   # price levels per side in a snapshot
+expiration_slack = 2   # rebuild the expiration heap when it holds this many entries per live order
+sorted_chunk_size = 512   # keys per chunk of a SortedKeys list, chunks are split at twice this
+
+create_cols = ['operation_id', 'block_time', 'amount_to_sell.asset_id', 'amount_to_sell.amount',
+               'min_to_receive.asset_id', 'min_to_receive.amount', 'expiration', 'fill_or_kill', 'limit_id']
+fill_cols = ['operation_id', 'block_time', 'pays.amount', 'limit_id']
+cancel_cols = ['operation_id', 'block_time', 'limit_id']
+
+create_event = 0
+fill_event = 1
+cancel_event = 2
+
+bid_side = 0
+ask_side = 1
+
+def get_book_schema(levels):
+    fields = [('date', pa.timestamp('ms')), ('market', pa.int64()),
+              ('bid', pa.float64()), ('ask', pa.float64()), ('spread', pa.float64())]
+    for side in ['bid', 'ask']:
+        fields += [(side + '_price_' + str(level), pa.float64()) for level in range(1, levels + 1)]
+        fields += [(side + '_depth_' + str(level), pa.int64()) for level in range(1, levels + 1)]
+    return pa.schema(fields)
+
+def get_book_path(month):
+    return dmu.get_aggregate_book_dir() + '/' + month + '.parquet'
+
+def get_checkpoint_path():
+    return dmu.get_aggregate_book_dir() + '/checkpoint'
+
+# the codes of the markets to replay, given as 'asset id/asset id' in either order,
+# or the canonical markets of asset.synonym_markets when markets is None
+def get_book_markets(markets=None):
+    if markets is None:
+        markets = ['/'.join(asset_id_pair) for asset_id_pair in asset.distinct_asset_ids(ags.cube_markets)[1]]
+    return sorted(set(oid.encode_canonical_market(market) for market in markets))
+
+# a sorted list of distinct keys kept as a list of sorted chunks, so adding or removing a key only
+# moves the keys of one chunk. order rates are ratios of amounts, nearly every order is a level
+# of its own and a single sorted list would move the whole side of a deep book on every order
+class SortedKeys():
+    def __init__(self):
+        self.chunks = []
+        self.maxes = []   # the last key of each chunk
+
+    def add(self, key):
+        if not self.chunks:
+            self.chunks.append([key])
+            self.maxes.append(key)
+            return
+        index = bisect_left(self.maxes, key)
+        if index == len(self.maxes):
+            index -= 1
+            self.chunks[index].append(key)
+            self.maxes[index] = key
+        else:
+            insort(self.chunks[index], key)
+        chunk = self.chunks[index]
+        if len(chunk) > 2*sorted_chunk_size:
+            self.chunks[index:index + 1] = [chunk[:sorted_chunk_size], chunk[sorted_chunk_size:]]
+            self.maxes[index:index + 1] = [chunk[sorted_chunk_size - 1], chunk[-1]]
+
+    def remove(self, key):
+        index = bisect_left(self.maxes, key)
+        chunk = self.chunks[index]
+        del chunk[bisect_left(chunk, key)]
+        if chunk:
+            self.maxes[index] = chunk[-1]
+        else:
+            del self.chunks[index]
+            del self.maxes[index]
+
+    # the count smallest keys
+    def first(self, count):
+        keys = []
+        for chunk in self.chunks:
+            keys += chunk[:count - len(keys)]
+            if len(keys) == count:
+                break
+        return keys
+
+# the price levels of one market. each side keeps its level keys sorted with the best level
+# first (bids are keyed by their negated price) and the depth of each level in a dict
+class OrderBook():
+    def __init__(self):
+        self.keys = (SortedKeys(), SortedKeys())
+        self.depths = ({}, {})
+
+    def add(self, side, key, amount):
+        depths = self.depths[side]
+        if key in depths:
+            depths[key] += amount
+        else:
+            depths[key] = amount
+            self.keys[side].add(key)
+
+    def remove(self, side, key, amount):
+        depths = self.depths[side]
+        depths[key] -= amount
+        if depths[key] <= 0:
+            del depths[key]
+            self.keys[side].remove(key)
+
+    # the prices and depths of the best levels of a side
+    def get_levels(self, side, levels):
+        keys = self.keys[side].first(levels)
+        prices = [-key for key in keys] if side == bid_side else keys
+        return prices, [self.depths[side][key] for key in keys]
+
+# the live orders of the replayed markets and their books. an order is a list of its market's
+# book, side, level key, amount left to sell and expiration (ns since the epoch)
+class BookReplay():
+    def __init__(self, market_codes, levels):
+        self.market_codes = market_codes
+        self.levels = levels
+        self.books = {market_code: OrderBook() for market_code in market_codes}
+        self.orders = {}
+        self.expirations = []
+
+    def create(self, limit_code, market_code, side, key, amount, expiration):
+        book = self.books[market_code]
+        self.orders[limit_code] = [book, side, key, amount, expiration]
+        book.add(side, key, amount)
+        heapq.heappush(self.expirations, (expiration, limit_code))
+
+    def fill(self, limit_code, amount):
+        order = self.orders.get(limit_code)
+        if order is None:
+            return
+        amount = min(amount, order[3])
+        order[0].remove(order[1], order[2], amount)
+        order[3] -= amount
+        if order[3] <= 0:
+            del self.orders[limit_code]
+
+    def cancel(self, limit_code):
+        order = self.orders.pop(limit_code, None)
+        if order is not None:
+            order[0].remove(order[1], order[2], order[3])
+
+    # remove the orders that expired by time
+    def expire(self, time):
+        expirations = self.expirations
+        while expirations and expirations[0][0] <= time:
+            expiration, limit_code = heapq.heappop(expirations)
+            order = self.orders.get(limit_code)
+            if order is not None and order[4] == expiration:
+                self.cancel(limit_code)
+
+    # filled and cancelled orders leave their entries in the expiration heap, rebuild the heap
+    # from the live orders when those make up too little of it
+    def compact_expirations(self):
+        if len(self.expirations) > expiration_slack*len(self.orders) + 1024:
+            self.expirations[:] = [(order[4], limit_code) for limit_code, order in self.orders.items()]
+            heapq.heapify(self.expirations)
+
+    # write the snapshot of every market's book into row of the snapshot arrays
+    def snapshot(self, values, row):
+        for market_code in self.market_codes:
+            book = self.books[market_code]
+            for side, side_name in [(bid_side, 'bid'), (ask_side, 'ask')]:
+                prices, depths = book.get_levels(side, self.levels)
+                values[side_name + '_price'][row, :len(prices)] = prices
+                values[side_name + '_depth'][row, :len(depths)] = depths
+            row += 1
+        return row
+
+    def save(self, checkpoint_path, next_day, settings):
+        limit_codes = list(self.orders.keys())
+        orders = list(self.orders.values())
+        book_markets = {id(book): market_code for market_code, book in self.books.items()}
+        with open(checkpoint_path + '.tmp', 'wb') as checkpoint_file:
+            np.savez(checkpoint_file,
+                     settings=np.array(json.dumps(dict(settings, next_day=next_day))),
+                     limit_codes=np.array(limit_codes, dtype=np.int64),
+                     market_codes=np.array([book_markets[id(order[0])] for order in orders], dtype=np.int64),
+                     sides=np.array([order[1] for order in orders], dtype=np.int8),
+                     keys=np.array([order[2] for order in orders], dtype=np.float64),
+                     amounts=np.array([order[3] for order in orders], dtype=np.int64),
+                     expirations=np.array([order[4] for order in orders], dtype=np.int64))
+        replace(checkpoint_path + '.tmp', checkpoint_path)
+
+    # the replay of a checkpoint and the day it stopped before, None when there is no checkpoint
+    # or it was made with other settings
+    @classmethod
+    def load(cls, checkpoint_path, market_codes, levels, settings):
+        if not isfile(checkpoint_path):
+            return None, None
+        with np.load(checkpoint_path) as checkpoint:
+            checkpoint_settings = json.loads(str(checkpoint['settings']))
+            next_day = checkpoint_settings.pop('next_day')
+            if checkpoint_settings != settings:
+                return None, None
+            replay = cls(market_codes, levels)
+            for order in zip(checkpoint['limit_codes'].tolist(), checkpoint['market_codes'].tolist(),
+                             checkpoint['sides'].tolist(), checkpoint['keys'].tolist(),
+                             checkpoint['amounts'].tolist(), checkpoint['expirations'].tolist()):
+                replay.create(*order)
+        return replay, datetime.strptime(next_day, '%Y%m%d')
+
+# the create, fill and cancel events of a day in the order they are applied, as a dict of arrays:
+# event type, time (ns since the epoch), limit order code and for creates the market, side,
+# level key, amount and expiration
+def read_events(day_path, market_codes):
+    creates = ps.read_operations(day_path, limit_order_create_key, create_cols)
+    sell_assets = creates['amount_to_sell.asset_id'].to_numpy(dtype=np.int64)
+    receive_assets = creates['min_to_receive.asset_id'].to_numpy(dtype=np.int64)
+    sell_amounts = creates['amount_to_sell.amount'].to_numpy(dtype=np.int64)
+    receive_amounts = creates['min_to_receive.amount'].to_numpy(dtype=np.int64)
+    sides = np.where(sell_assets < receive_assets, bid_side, ask_side)
+    market_codes_of_creates = oid.encode_canonical_markets(sell_assets, receive_assets)
+    is_resting = np.isin(market_codes_of_creates, market_codes) & ~creates['fill_or_kill'].to_numpy(dtype=bool) & \
+        (sell_amounts > 0) & (receive_amounts > 0)
+    creates = creates[is_resting]
+    sides = sides[is_resting]
+    sell_amounts = sell_amounts[is_resting]
+    receive_amounts = receive_amounts[is_resting]
+    keys = np.where(sides == bid_side, -(sell_amounts/receive_amounts), receive_amounts/sell_amounts)
+    fills = ps.read_operations(day_path, fill_order_key, fill_cols)
+    cancels = ps.read_operations(day_path, limit_order_cancel_key, cancel_cols)
+    frames = [creates, fills, cancels]
+    counts = [len(frame) for frame in frames]
+    events = {
+        'type': np.repeat([create_event, fill_event, cancel_event], counts),
+        'time': np.concatenate([frame['block_time'].to_numpy(dtype='datetime64[ns]').astype(np.int64) for frame in frames]),
+        'operation_id': np.concatenate([frame['operation_id'].to_numpy(dtype=np.int64) for frame in frames]),
+        'limit_code': np.concatenate([oid.parse_object_ids(frame['limit_id'].to_numpy()) for frame in frames]),
+        'market': np.concatenate([market_codes_of_creates[is_resting], np.zeros(counts[1] + counts[2], dtype=np.int64)]),
+        'side': np.concatenate([sides, np.zeros(counts[1] + counts[2], dtype=np.int64)]),
+        'key': np.concatenate([keys, np.zeros(counts[1] + counts[2])]),
+        'amount': np.concatenate([sell_amounts, fills['pays.amount'].to_numpy(dtype=np.int64),
+                                  np.zeros(counts[2], dtype=np.int64)]),
+        'expiration': np.concatenate([creates['expiration'].to_numpy(dtype='datetime64[ns]').astype(np.int64),
+                                      np.zeros(counts[1] + counts[2], dtype=np.int64)])
+    }
+    order = np.lexsort((events['operation_id'], events['time']))
+    return {name: values[order] for name, values in events.items()}
+
+# replay a day's events and return the table of its minute snapshots
+def replay_day(replay, day_path, current_date):
+    events = read_events(day_path, replay.market_codes)
+    # fills and cancels can only find an order that is on the books or created today,
+    # the others (mostly orders of markets not replayed) are dropped before the replay loop
+    is_create = events['type'] == create_event
+    known_codes = np.concatenate([np.fromiter(replay.orders.keys(), dtype=np.int64, count=len(replay.orders)),
+                                  events['limit_code'][is_create]])
+    is_known = is_create | np.isin(events['limit_code'], known_codes)
+    events = {name: values[is_known] for name, values in events.items()}
+    market_cnt = len(replay.market_codes)
+    row_cnt = minutes_per_day*market_cnt
+    values = {side_name + '_' + value_name: np.full((row_cnt, replay.levels), fill_value)
+              for side_name in ['bid', 'ask'] for value_name, fill_value in [('price', np.nan), ('depth', 0)]}
+    day_start = pd.Timestamp(current_date).value
+    minute_ns = 60*10**9
+    # minute m is snapshot once every event before the end of minute m was applied
+    snapshot_ends = np.searchsorted(events['time'], day_start + minute_ns*np.arange(1, minutes_per_day + 1))
+    columns = [events[name].tolist() for name in ['type', 'time', 'limit_code', 'market', 'side', 'key', 'amount', 'expiration']]
+    expirations = replay.expirations
+    event_index = 0
+    row = 0
+    for minute, snapshot_end in enumerate(snapshot_ends.tolist()):
+        for event_type, time, limit_code, market_code, side, key, amount, expiration in \
+                zip(*[column[event_index:snapshot_end] for column in columns]):
+            if expirations and expirations[0][0] <= time:
+                replay.expire(time)
+            if event_type == create_event:
+                if expiration > time:
+                    replay.create(limit_code, market_code, side, key, amount, expiration)
+            elif event_type == fill_event:
+                replay.fill(limit_code, amount)
+            else:
+                replay.cancel(limit_code)
+        event_index = snapshot_end
+        replay.expire(day_start + minute_ns*(minute + 1) - 1)
+        replay.compact_expirations()
+        row = replay.snapshot(values, row)
+    return make_snapshot_table(values, current_date, replay.market_codes, replay.levels)
+
+def make_snapshot_table(values, current_date, market_codes, levels):
+    minute_offsets = pd.to_timedelta(np.repeat(np.arange(minutes_per_day), len(market_codes)), unit='min')
+    columns = {'date': pd.Timestamp(current_date) + minute_offsets,
+               'market': np.tile(np.array(market_codes, dtype=np.int64), minutes_per_day),
+               'bid': values['bid_price'][:, 0], 'ask': values['ask_price'][:, 0],
+               'spread': values['ask_price'][:, 0] - values['bid_price'][:, 0]}
+    for side_name in ['bid', 'ask']:
+        for value_name in ['price', 'depth']:
+            for level in range(levels):
+                columns[side_name + '_' + value_name + '_' + str(level + 1)] = values[side_name + '_' + value_name][:, level]
+    schema = get_book_schema(levels)
+    return pa.Table.from_pydict({field.name: pa.array(np.asarray(columns[field.name]), field.type) for field in schema},
+                                schema=schema)
+
+# replay the loaded days from first_day on and write their snapshots. when the checkpoint of an
+# earlier run with the same markets stopped at a day in the range, the replay resumes from there
+def make_books(first_day, days_to_model, markets=None, levels=book_levels):
+    market_codes = get_book_markets(markets)
+    settings = {'markets': market_codes, 'levels': levels}
+    replay, next_day = BookReplay.load(get_checkpoint_path(), market_codes, levels, settings)
+    last_day = first_day + timedelta(days=days_to_model)
+    if replay is not None and first_day <= next_day <= last_day:
+        logging.info('Resuming the order books at {}'.format(next_day))
+        first_day = next_day
+    else:
+        replay = BookReplay(market_codes, levels)
+    writer = ags.CubeWriter('book', get_book_schema(levels), lambda name, month: get_book_path(month))
+    day_cnt = 0
+    current_date = first_day
+    while current_date < last_day:
+        day_dir, day_path = dmu.get_daydir_daypath(current_date)
+        # stop at the first day the loader has not finished, its directory exists while it is still loading
+        if not ingest_manifest.is_day_complete(day_dir):
+            break
+        logging.info('Replaying order books of {}, {} live orders'.format(current_date, len(replay.orders)))
+        writer.add_day(day_dir, replay_day(replay, day_path, current_date))
+        current_date += timedelta(days=1)
+        day_cnt += 1
+    writer.close()
+    replay.save(get_checkpoint_path(), dmu.get_daydir_daypath(current_date)[0], settings)
+    logging.info('Replayed order books of {} days'.format(day_cnt))
+    return day_cnt
+
+# the snapshots from start up to (not including) end, optionally only of markets
+# (given as 'asset id/asset id' in either order), with the market names decoded, lower asset id first
+def load_books(start=None, end=None, markets=None):
+    month_frames = [pq.read_table(get_book_path(month)).to_pandas()
+                    for month in ags.get_range_months(ags.get_months(dmu.get_aggregate_book_dir()), start, end)]
+    if not month_frames:
+        return pd.DataFrame(columns=get_book_schema(book_levels).names)
+    books = pd.concat(month_frames, ignore_index=True)
+    if start is not None:
+        books = books[books['date'] >= start]
+    if end is not None:
+        books = books[books['date'] < end]
+    if markets is not None:
+        books = books[books['market'].isin(get_book_markets(markets))]
+    return books.assign(market=oid.decode_markets(books['market'].to_numpy())).reset_index(drop=True)
+
+if __name__ == "__main__":
+    first_day     = datetime(2016, 1, 1)   # first day to replay, unless a checkpoint resumes later
+    days_to_model = 940                    # days from first_day on, stops at the first day without data
+    markets       = None                   # 'asset id/asset id' markets, None for the canonical markets
+    make_books(first_day, days_to_model, markets)
@@ -0,0 +1,394 @@
+import logging
+import threading
+from os import fsync
+from os import listdir
+from os import makedirs
+from os import remove
+from os import replace
+from os import rmdir
+from os.path import isdir
+from os.path import isfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import dir_mgmt_utils as dmu
+import operation as bs_ops
+import object_ids as oid
+
+# Writers and readers for a day's operation partitions. Rows are streamed to partial files per
+# operation type in chunks of chunk_rows as they arrive, so memory stays bounded however busy the
+# day is, and the partial files only replace the day's operation files when the writer is closed.
+#
+# Days are stored either as one typed, compressed Parquet file per operation type (the default)
+# or as the original CSV files. read_operations reads either, Parquet files can be read a few
+# columns at a time.
+
+partition_formats = ['parquet', 'csv']
+parquet_compression = 'zstd'
+
+# arrow types of the column types used in col_sources, Parquet has no second resolution timestamps
+# amounts are stored in base units, asset and account ids and markets as their object_ids codes
+arrow_types = {
+    'int': pa.int64(),
+    'float': pa.float64(),
+    'amount': pa.int64(),
+    'datetime': pa.timestamp('ms'),
+    'asset': pa.int64(),
+    'account': pa.int64(),
+    'market': pa.int64(),
+    'bool': pa.bool_(),
+    'str': pa.string()
+}
+
+# path of the partial file an operation type is written to until its day is complete
+def get_part_path(day_path, op_key, partition_format='csv'):
+    return dmu.get_operation_path(day_path, op_key, partition_format) + '.part'
+
+# column names of an operation type as pandas reads them from the CSV files,
+# a repeated name gets a suffix (FillOrder's second account column becomes account.1)
+def partition_column_names(op_class):
+    names = []
+    for col in op_class.cols:
+        name = col
+        suffix = 1
+        while name in names:
+            name = col + '.' + str(suffix)
+            suffix += 1
+        names.append(name)
+    return names
+
+# arrow schema of an operation type's partition, derived from its cols and col_sources
+def partition_schema(op_class):
+    return pa.schema([(name, arrow_types[op_class.col_sources[col][0]])
+                      for name, col in zip(partition_column_names(op_class), op_class.cols)])
+
+# format a row the way np.savetxt(..., delimiter=",", fmt='%s') does
+def format_row(row):
+    return ','.join([str(value) for value in row]) + '\n'
+
+# rows of values lists as an arrow table, the '' written for a missing rate becomes a null
+def rows_to_table(op_class, rows):
+    schema = partition_schema(op_class)
+    columns = list(zip(*rows)) if rows else [[] for col in op_class.cols]
+    arrays = []
+    for values, field in zip(columns, schema):
+        if field.type == pa.float64():
+            values = [None if value == '' else value for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+# a bs_ops.ColumnBatch as an arrow table built from its arrays, the NaN of a missing rate becomes a null
+def batch_to_table(batch):
+    schema = partition_schema(batch.op_class)
+    arrays = []
+    for col, field in zip(batch.op_class.cols, schema):
+        col_type, path = batch.op_class.col_sources[col]
+        arrays.append(pa.array(batch.columns[col], type=field.type, from_pandas=(col_type == 'float' and path is None)))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+# the rows of a buffered piece, a list of rows or a bs_ops.ColumnBatch
+def piece_rows(piece):
+    if isinstance(piece, bs_ops.ColumnBatch):
+        return piece.to_values_lists()
+    return piece
+
+# buffers rows per operation type and hands them to _write_chunk chunk_rows at a time, as a list of
+# pieces that are either lists of rows or bs_ops.ColumnBatch objects
+# subclasses store the chunks and implement checkpoint, close and abort
+class PartitionWriter():
+    partition_format = None
+
+    def __init__(self, day_path, chunk_rows=50000):
+        self.day_path = day_path
+        self.chunk_rows = chunk_rows
+        self.op_counts = {}
+        self.max_operation_id = None
+        self._buffers = {}
+        self._buffered_rows = {}
+        self._lock = threading.Lock()
+
+        if not isdir(day_path):
+            makedirs(day_path, exist_ok=True)
+            logging.warning('created day dir {}'.format(day_path))
+        for op_key in bs_ops.supported_operations.keys():
+            self._buffers[op_key] = []
+            self._buffered_rows[op_key] = 0
+
+    # pick up the row counts from a checkpoint returned by an earlier writer's checkpoint()
+    def _restore(self, checkpoint):
+        self.op_counts = dict(checkpoint['op_counts'])
+        self.max_operation_id = checkpoint['operation_id']
+
+    # add rows (without a header row) for one operation type, writing them out once a chunk is full
+    def append(self, op_key, rows):
+        if len(rows) == 0:
+            return
+        self._append_piece(op_key, rows, len(rows), max(row[0] for row in rows))
+
+    # add a bs_ops.ColumnBatch for one operation type, its arrays are kept until the chunk is written
+    def append_batch(self, op_key, batch):
+        if batch.size == 0:
+            return
+        self._append_piece(op_key, batch, batch.size, int(np.max(batch.columns[batch.op_class.cols[0]])))
+
+    def _append_piece(self, op_key, piece, row_cnt, max_operation_id):
+        with self._lock:
+            self._buffers[op_key].append(piece)
+            self._buffered_rows[op_key] += row_cnt
+            self.op_counts[str(op_key)] = self.op_counts.get(str(op_key), 0) + row_cnt
+            if self.max_operation_id is None or max_operation_id > self.max_operation_id:
+                self.max_operation_id = max_operation_id
+            if self._buffered_rows[op_key] >= self.chunk_rows:
+                self._flush(op_key)
+
+    # add what parse_batch made for each operation type: a list made by bs_ops.make_empty_lists()
+    # with its header row, or a bs_ops.ColumnBatch
+    def append_lists(self, op_lists):
+        for op_key, op_list in op_lists.items():
+            if isinstance(op_list, bs_ops.ColumnBatch):
+                self.append_batch(op_key, op_list)
+            else:
+                self.append(op_key, op_list[1:])
+
+    def _flush(self, op_key):
+        if self._buffered_rows[op_key] == 0:
+            return
+        self._write_chunk(op_key, self._buffers[op_key])
+        self._buffers[op_key] = []
+        self._buffered_rows[op_key] = 0
+
+    # remove the day directory if nothing else is in it
+    def _remove_empty_day(self):
+        if isdir(self.day_path) and len(listdir(self.day_path)) == 0:
+            rmdir(self.day_path)
+
+class CsvPartitionWriter(PartitionWriter):
+    partition_format = 'csv'
+
+    # checkpoint is the state returned by an earlier writer's checkpoint(), the partial files are
+    # cut back to it and the row counts picked up from it. without one, leftover partial files are removed
+    def __init__(self, day_path, chunk_rows=50000, checkpoint=None):
+        PartitionWriter.__init__(self, day_path, chunk_rows)
+
+        for op_key in bs_ops.supported_operations.keys():
+            part_path = get_part_path(day_path, op_key)
+            if checkpoint is not None and str(op_key) in checkpoint['file_sizes']:
+                with open(part_path, 'r+b') as part_file:
+                    part_file.truncate(checkpoint['file_sizes'][str(op_key)])
+            elif isfile(part_path):
+                remove(part_path)
+        if checkpoint is not None:
+            self._restore(checkpoint)
+
+        # start the partial files that don't exist yet with their header row
+        for op_key, op_class in bs_ops.supported_operations.items():
+            part_path = get_part_path(day_path, op_key)
+            if not isfile(part_path):
+                with open(part_path, 'wt') as part_file:
+                    part_file.write(format_row(op_class.cols))
+
+    # only the csv files need the buffered batches as rows
+    def _write_chunk(self, op_key, pieces):
+        with open(get_part_path(self.day_path, op_key), 'at') as part_file:
+            for piece in pieces:
+                part_file.writelines([format_row(row) for row in piece_rows(piece)])
+
+    # write everything buffered and sync it to disk, returns the state to resume from after a crash
+    def checkpoint(self, operation_id):
+        with self._lock:
+            file_sizes = {}
+            for op_key in bs_ops.supported_operations.keys():
+                self._flush(op_key)
+                with open(get_part_path(self.day_path, op_key), 'ab') as part_file:
+                    fsync(part_file.fileno())
+                    file_sizes[str(op_key)] = part_file.tell()
+            return {
+                'operation_id': operation_id,
+                'op_counts': dict(self.op_counts),
+                'file_sizes': file_sizes
+            }
+
+    # write the rest of the rows and rename the partial files to the day's operation files
+    def close(self):
+        self.checkpoint(self.max_operation_id)
+        for op_key in bs_ops.supported_operations.keys():
+            file_path = dmu.get_operation_path(self.day_path, op_key)
+            replace(get_part_path(self.day_path, op_key), file_path)
+            logging.warning(file_path)
+
+    # remove the partial files (and the day directory if nothing else is in it) of a day that
+    # turned out to be empty or failed
+    def abort(self):
+        for op_key in bs_ops.supported_operations.keys():
+            part_path = get_part_path(self.day_path, op_key)
+            if isfile(part_path):
+                remove(part_path)
+        self._remove_empty_day()
+
+# every chunk of an operation type is written to its own small Parquet file in a partial directory,
+# a checkpoint records how many chunks each operation type has. closing the writer copies the
+# chunks, one row group each, into the operation type's Parquet file
+class ParquetPartitionWriter(PartitionWriter):
+    partition_format = 'parquet'
+
+    # checkpoint is the state returned by an earlier writer's checkpoint(), chunks written after it
+    # are removed. without one, leftover partial directories are emptied
+    def __init__(self, day_path, chunk_rows=50000, checkpoint=None):
+        PartitionWriter.__init__(self, day_path, chunk_rows)
+        self._chunk_counts = {}
+
+        for op_key in bs_ops.supported_operations.keys():
+            part_dir = get_part_path(day_path, op_key, 'parquet')
+            chunk_count = 0
+            if checkpoint is not None:
+                chunk_count = checkpoint['chunk_counts'].get(str(op_key), 0)
+            if not isdir(part_dir):
+                makedirs(part_dir)
+            for file_name in listdir(part_dir):
+                if self._chunk_number(file_name) >= chunk_count:
+                    remove(part_dir + '/' + file_name)
+            self._chunk_counts[op_key] = chunk_count
+        if checkpoint is not None:
+            self._restore(checkpoint)
+
+    @staticmethod
+    def _chunk_number(file_name):
+        return int(file_name.split('.')[0].split('-')[1])
+
+    def _chunk_path(self, op_key, chunk_number):
+        return get_part_path(self.day_path, op_key, 'parquet') + '/chunk-' + '{:06d}'.format(chunk_number) + '.parquet'
+
+    def _write_chunk(self, op_key, pieces):
+        op_class = bs_ops.supported_operations[op_key]
+        table = pa.concat_tables([batch_to_table(piece) if isinstance(piece, bs_ops.ColumnBatch)
+                                  else rows_to_table(op_class, piece) for piece in pieces])
+        with open(self._chunk_path(op_key, self._chunk_counts[op_key]), 'wb') as chunk_file:
+            pq.write_table(table, chunk_file, compression=parquet_compression)
+            chunk_file.flush()
+            fsync(chunk_file.fileno())
+        self._chunk_counts[op_key] += 1
+
+    # write everything buffered to chunks, returns the state to resume from after a crash
+    def checkpoint(self, operation_id):
+        with self._lock:
+            for op_key in bs_ops.supported_operations.keys():
+                self._flush(op_key)
+            return {
+                'operation_id': operation_id,
+                'op_counts': dict(self.op_counts),
+                'chunk_counts': {str(op_key): chunk_count for op_key, chunk_count in self._chunk_counts.items()}
+            }
+
+    # write the rest of the rows and combine each operation type's chunks into its Parquet file
+    def close(self):
+        self.checkpoint(self.max_operation_id)
+        for op_key, op_class in bs_ops.supported_operations.items():
+            file_path = dmu.get_operation_path(self.day_path, op_key, 'parquet')
+            part_dir = get_part_path(self.day_path, op_key, 'parquet')
+            with pq.ParquetWriter(file_path + '.tmp', partition_schema(op_class),
+                                  compression=parquet_compression) as parquet_writer:
+                for chunk_number in range(self._chunk_counts[op_key]):
+                    parquet_writer.write_table(pq.read_table(self._chunk_path(op_key, chunk_number)))
+            replace(file_path + '.tmp', file_path)
+            self._remove_part_dir(part_dir)
+            logging.warning(file_path)
+
+    # remove the partial directories (and the day directory if nothing else is in it) of a day that
+    # turned out to be empty or failed
+    def abort(self):
+        for op_key in bs_ops.supported_operations.keys():
+            self._remove_part_dir(get_part_path(self.day_path, op_key, 'parquet'))
+        self._remove_empty_day()
+
+    @staticmethod
+    def _remove_part_dir(part_dir):
+        if isdir(part_dir):
+            for file_name in listdir(part_dir):
+                remove(part_dir + '/' + file_name)
+            rmdir(part_dir)
+
+def make_partition_writer(partition_format, day_path, chunk_rows=50000, checkpoint=None):
+    if partition_format == 'parquet':
+        return ParquetPartitionWriter(day_path, chunk_rows, checkpoint)
+    if partition_format == 'csv':
+        return CsvPartitionWriter(day_path, chunk_rows, checkpoint)
+    raise ValueError('unknown partition format {}, expected one of {}'.format(partition_format, partition_formats))
+
+# format a day's operation type is stored in, None if it has no file
+def get_partition_format(day_path, op_key):
+    for partition_format in partition_formats:
+        if isfile(dmu.get_operation_path(day_path, op_key, partition_format)):
+            return partition_format
+    return None
+
+# path of a day's file of an operation type in whichever format it is stored
+def get_existing_operation_path(day_path, op_key):
+    partition_format = get_partition_format(day_path, op_key)
+    if partition_format is None:
+        raise FileNotFoundError('no operation-{:02d} file in {} in any of the formats {}'.format(
+            op_key, day_path, partition_formats))
+    return partition_format, dmu.get_operation_path(day_path, op_key, partition_format)
+
+# the timestamp columns of a DataFrame of an operation type as datetime64[ns]
+def set_datetime_columns(op_key, operations):
+    schema = partition_schema(bs_ops.supported_operations[op_key])
+    for col in operations.columns:
+        if schema.field(col).type == arrow_types['datetime']:
+            operations[col] = operations[col].astype('datetime64[ns]')
+    return operations
+
+# read one operation type of a day into a DataFrame with the timestamp columns as datetime64[ns]
+# columns limits the read to those columns (named as in partition_column_names),
+# only the requested columns are decoded from a Parquet file
+def read_operations(day_path, op_key, columns=None):
+    partition_format, file_path = get_existing_operation_path(day_path, op_key)
+    if partition_format == 'parquet':
+        operations = pq.read_table(file_path, columns=columns).to_pandas()
+    else:
+        operations = pd.read_csv(file_path, usecols=columns)
+    return set_datetime_columns(op_key, operations)
+
+# the rows at the row offsets rows (sorted) of one operation type of a day, read like read_operations.
+# only the row groups of a Parquet file that hold those rows are read
+def read_operation_rows(day_path, op_key, rows):
+    partition_format, file_path = get_existing_operation_path(day_path, op_key)
+    rows = np.asarray(rows, dtype=np.int64)
+    if partition_format == 'parquet':
+        parquet_file = pq.ParquetFile(file_path)
+        group_sizes = [parquet_file.metadata.row_group(group).num_rows
+                       for group in range(parquet_file.metadata.num_row_groups)]
+        group_starts = np.cumsum([0] + group_sizes)
+        row_groups = np.searchsorted(group_starts, rows, side='right') - 1
+        read_groups = np.unique(row_groups)
+        # where each row group that is read starts in the table of the groups read
+        read_starts = np.cumsum([0] + [group_sizes[group] for group in read_groups[:-1]])
+        table_rows = read_starts[np.searchsorted(read_groups, row_groups)] + rows - group_starts[row_groups]
+        operations = parquet_file.read_row_groups(read_groups.tolist()).take(table_rows).to_pandas()
+    else:
+        operations = pd.read_csv(file_path).iloc[rows].reset_index(drop=True)
+    return set_datetime_columns(op_key, operations)
+
+# the object id and market codes of a DataFrame read by read_operations turned back into strings
+def decode_operations(op_class, operations):
+    for name, col in zip(partition_column_names(op_class), op_class.cols):
+        if name not in operations.columns:
+            continue
+        col_type = op_class.col_sources[col][0]
+        if col_type in bs_ops.object_id_types:
+            operations[name] = oid.decode_object_ids(operations[name].to_numpy())
+        elif col_type == 'market':
+            operations[name] = oid.decode_markets(operations[name].to_numpy())
+    return operations
+
+# write a CSV copy of a day stored as Parquet with the ids written out as strings,
+# the layout the CSV files had before ids were stored as codes
+def export_csv(day_path):
+    for op_key, op_class in bs_ops.supported_operations.items():
+        file_path = dmu.get_operation_path(day_path, op_key, 'csv')
+        operations = pq.read_table(dmu.get_operation_path(day_path, op_key, 'parquet')).to_pandas()
+        operations = decode_operations(op_class, operations)
+        operations.to_csv(file_path + '.tmp', header=op_class.cols, index=False)
+        replace(file_path + '.tmp', file_path)
+        logging.warning(file_path)
@@ -0,0 +1,119 @@
+import math
+import numpy as np
+
+# A KLL quantile sketch: a mergeable summary of a stream of values that answers quantile queries
+# with a rank error of about error*n while keeping O(1/error) values, however many were added.
+#
+# The values sit in levels of compactors. A value at level h stands for 2**h of the original
+# values. When a level grows past its capacity it is sorted and every other value is promoted
+# to the level above, the higher levels get the larger capacities. As long as nothing was
+# compacted the sketch holds every value and its quantiles are exact.
+
+default_error = 0.01
+
+# the compactor size k that gives a rank error of about error
+def error_to_k(error):
+    return max(8, int(math.ceil(1.7/error)))
+
+class KllSketch():
+    def __init__(self, k):
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty(0, dtype=np.float64)]
+        self._offset = 0
+
+    @classmethod
+    def from_values(cls, k, values):
+        sketch = cls(k)
+        sketch.update(values)
+        return sketch
+
+    # add an array of values, NaN values are left out
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.count += len(values)
+        self._compress()
+
+    # add the values of another sketch
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float64))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def copy(self):
+        sketch = KllSketch(self.k)
+        sketch.count = self.count
+        sketch.levels = list(self.levels)
+        sketch._offset = self._offset
+        return sketch
+
+    def is_exact(self):
+        return len(self.levels) == 1
+
+    # the value at quantile q, NaN for an empty sketch. exact sketches interpolate like np.quantile
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        if self.is_exact():
+            return np.quantile(self.levels[0], q)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_values), 2**level, dtype=np.int64)
+                                  for level, level_values in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        ranks = np.cumsum(weights[order])
+        return values[order][min(np.searchsorted(ranks, q*ranks[-1]), len(values) - 1)]
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(math.ceil(self.k*(2/3)**depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float64))
+                values = np.sort(self.levels[level])
+                # an odd value out stays behind, the others are halved into the next level
+                kept = values[:len(values) % 2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1],
+                                                         values[len(kept) + self._offset::2]])
+                self.levels[level] = kept
+                self._offset ^= 1
+                # adding a level lowers the capacity of the levels below, so check again from the bottom
+                level = 0
+            else:
+                level += 1
+
+# pack an array of sketches into flat arrays, to store them with np.savez
+def pack_sketches(sketches):
+    counts = np.array([sketch.count for sketch in sketches], dtype=np.int64)
+    level_counts = np.array([len(sketch.levels) for sketch in sketches], dtype=np.int64)
+    level_sizes = np.array([len(values) for sketch in sketches for values in sketch.levels], dtype=np.int64)
+    values = [values for sketch in sketches for values in sketch.levels]
+    values = np.concatenate(values) if values else np.empty(0, dtype=np.float64)
+    return {'counts': counts, 'level_counts': level_counts, 'level_sizes': level_sizes, 'values': values}
+
+# the sketches of pack_sketches
+def unpack_sketches(k, counts, level_counts, level_sizes, values):
+    sketches = np.empty(len(counts), dtype=object)
+    level_values = np.split(values, np.cumsum(level_sizes)[:-1]) if len(level_sizes) else []
+    level_start = 0
+    for index, (count, level_count) in enumerate(zip(counts, level_counts)):
+        sketch = KllSketch(k)
+        sketch.count = int(count)
+        sketch.levels = list(level_values[level_start:level_start + level_count])
+        level_start += level_count
+        sketches[index] = sketch
+    return sketches
@@ -0,0 +1,56 @@
+import gzip
+import json
+import threading
+from os import remove
+from os import replace
+from os.path import isfile
+
+import dir_mgmt_utils as dmu
+
+# The raw cache keeps every document the loader scanned for a day as gzip compressed NDJSON,
+# one _source per line with the op and operation_result strings already decoded. Replaying a
+# day from the cache gives the parsers exactly what Elasticsearch returned, so a change to the
+# Operation classes can be re-derived from local disk instead of a new scan of the cluster.
+# Only the _source fields in the loader's includes list are kept.
+
+raw_compress_level = 3                                      # gzip level, favours speed over size
+
+def get_raw_day_path(day_dir):
+    return dmu.get_raw_cache_dir() + '/' + day_dir + '.ndjson.gz'
+
+def has_raw_day(day_dir):
+    return isfile(get_raw_day_path(day_dir))
+
+# yield the cached documents of a day in the same shape as Elasticsearch hits
+def read_raw_day(day_dir):
+    with gzip.open(get_raw_day_path(day_dir), 'rt') as raw_file:
+        for line in raw_file:
+            yield {'_source': json.loads(line)}
+
+# writes a day's documents to a partial file that only replaces the cached day on close,
+# batches can be written from several threads (one per sliced scroll)
+class RawCacheWriter():
+    def __init__(self, day_dir):
+        self.day_dir = day_dir
+        self.raw_path = get_raw_day_path(day_dir)
+        self.part_path = self.raw_path + '.part'
+        self.doc_count = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.part_path, 'wt', compresslevel=raw_compress_level)
+
+    def write(self, hits):
+        lines = ''.join([json.dumps(a_json_operation['_source']) + '\n' for a_json_operation in hits])
+        with self._lock:
+            self._file.write(lines)
+            self.doc_count += len(hits)
+
+    # finish the file and make it the day's cached copy
+    def close(self):
+        self._file.close()
+        replace(self.part_path, self.raw_path)
+
+    # throw away a partially written day
+    def abort(self):
+        self._file.close()
+        if isfile(self.part_path):
+            remove(self.part_path)